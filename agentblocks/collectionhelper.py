@@ -78,10 +78,20 @@ def ingest_into_collection(
     If is_new_collection is True, the function will add the "created_at" and "updated_at"
     metadata fields to the collection (overwriting such fields in the passed metadata).
     If is_new_collection is False, it will only add the "updated_at" field, and only if
-    collection_metadata is not None.
+    collection_metadata is not None. If the collection is the currently selected one,
+    the metadata goes through its metadata session instead (to be saved together with
+    other changes when the session is flushed).
     """
     logger.info("Creating new collection and loading data")
 
+    if (
+        not is_new_collection
+        and collection_metadata is not None
+        and collection_name == chat_state.collection_name
+    ):
+        chat_state.save_collection_metadata(collection_metadata)
+        collection_metadata = None
+
     for i in range(2):
         try:
             timestamp = get_timestamp()
@@ -100,7 +110,6 @@ def ingest_into_collection(
                 docs,
                 collection_name=collection_name,
                 openai_api_key=chat_state.openai_api_key,
-                chroma_client=chat_state.vectorstore.client,
                 collection_metadata=full_metadata,
             )
             break  # success
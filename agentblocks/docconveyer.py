@@ -11,10 +11,13 @@ from typing import TypeVar
 from langchain_core.documents import Document
 from pydantic import BaseModel, Field
 
-from utils.lang_utils import ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN, get_num_tokens
+from utils.lang_utils import (
+    ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN,
+    get_num_tokens,
+    split_text_by_tokens,
+)
 from utils.prepare import get_logger
 from utils.type_utils import Doc
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 logger = get_logger()
 
@@ -22,74 +25,51 @@ DocT = TypeVar("DocT", Document, Doc)
 
 
 def _split_doc_based_on_tokens(
-    doc: Document | Doc, max_tokens: float, target_num_chars: int
+    doc: Document | Doc, max_tokens: float
 ) -> list[Document]:
     """
     Helper function for the main function below that definitely splits the provided document.
+
+    The text is tokenized once and partitioned directly by token budget, with each cut
+    moved back to a paragraph, sentence or word boundary (see split_text_by_tokens).
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=target_num_chars,
-        chunk_overlap=0,
-        add_start_index=True,  # metadata will include start_index of snippet in original doc
-    )
-    candidate_new_docs = text_splitter.create_documents(
-        texts=[doc.page_content], metadatas=[doc.metadata]
-    )
     new_docs = []
-
-    # Calculate the number of tokens in each part and split further if needed
-    for maybe_new_doc in candidate_new_docs:
-        maybe_new_doc.metadata["num_tokens"] = get_num_tokens(
-            maybe_new_doc.page_content
-        )
-
-        # If the part is sufficiently small, add it to the list of new docs
-        if maybe_new_doc.metadata["num_tokens"] <= max_tokens:
-            new_docs.append(maybe_new_doc)
+    for start_idx, end_idx, start_token_idx, end_token_idx in split_text_by_tokens(
+        doc.page_content, int(max_tokens)
+    ):
+        part_text = doc.page_content[start_idx:end_idx]
+        if not part_text.strip():
             continue
-
-        # If actual num tokens is X times the target, reduce target_num_chars by ~X
-        new_target_num_chars = min(
-            int(target_num_chars * max_tokens / maybe_new_doc.metadata["num_tokens"]),
-            target_num_chars // 2,
-        )
-
-        # Split the part further and adjust the start index of each snippet
-        new_parts = _split_doc_based_on_tokens(
-            maybe_new_doc, max_tokens, new_target_num_chars
+        new_docs.append(
+            Document(
+                page_content=part_text,
+                metadata=doc.metadata
+                | {
+                    "start_index": start_idx,
+                    "num_tokens": end_token_idx - start_token_idx,
+                },
+            )
         )
-        for new_part in new_parts:
-            new_part.metadata["start_index"] += maybe_new_doc.metadata["start_index"]
-
-        # Add the new parts to the list of new docs
-        new_docs.extend(new_parts)
-
     return new_docs
 
 
 def split_doc_based_on_tokens(doc: DocT, max_tokens: float) -> list[DocT]:
     """
     Split a document into parts based on the number of tokens in each part. Specifically,
-    if the number of tokens in a part (or the original doc) is within max_tokens, then the part is
-    added to the list of new docs. Otherwise, the part is split further. The resulting Document
+    if the number of tokens in the doc is within max_tokens, then the doc is returned as is.
+    Otherwise, it's split into parts of at most max_tokens tokens. The resulting Document
     objects are returned as a list and contain the copy of the metadata from the parent doc, plus
     the "start_index" of its occurrence in the parent doc. The metadata will also include the
     "num_tokens" of the part.
     """
-    # If the doc is too large then don't count tokens, just split it.
+    # If the doc is small enough, count the tokens to see if we need to split
     num_chars = len(doc.page_content)
-    if num_chars / ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN > max_tokens:
-        # Doc almost certainly has more tokens than max_tokens
-        target_num_chars = int(max_tokens * ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN / 2)
-    else:
-        # Count the tokens to see if we need to split
+    if num_chars / ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN <= max_tokens:
         if (num_tokens := get_num_tokens(doc.page_content)) <= max_tokens:
             doc.metadata["num_tokens"] = num_tokens
             return [doc]
-        # Guess the target number of characters for the text splitter
-        target_num_chars = int(num_chars / (num_tokens / max_tokens) / 2)
 
-    documents = _split_doc_based_on_tokens(doc, max_tokens, target_num_chars)
+    documents = _split_doc_based_on_tokens(doc, max_tokens)
     if isinstance(doc, Document):
         return documents
     else:
@@ -3,6 +3,7 @@ from typing import Callable
 from pydantic import BaseModel, Field
 
 from agentblocks.webretrieve import get_content_from_urls
+from utils.prepare import EVICT_UNUSED_LINK_TEXTS
 from utils.type_utils import Doc
 from utils.web import LinkData
 
@@ -83,6 +84,9 @@ class URLConveyer(BaseModel):
                 doc.metadata["num_tokens"] = link_data.num_tokens
             docs.append(doc)
 
+        if EVICT_UNUSED_LINK_TEXTS:  # the texts have been passed on
+            for url in self.urls[self.idx_first_not_done : self.idx_first_not_tried]:
+                self.link_data_dict[url].evict_text()
         self.idx_first_not_done = self.idx_first_not_tried
         return docs
 
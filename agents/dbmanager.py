@@ -1,9 +1,9 @@
 import os
-from datetime import datetime, timezone
 
-from chromadb import Collection
 from icecream import ic
 
+from components.chroma_ddg import ChromaDDG, CollectionDoesNotExist
+from components.collection_catalog import CatalogEntry
 from utils.chat_state import ChatState
 from utils.helpers import (
     DB_COMMAND_HELP_TEMPLATE,
@@ -19,6 +19,7 @@ from utils.input import get_choice_from_dict_menu, get_menu_choice
 from utils.prepare import (
     BYPASS_SETTINGS_RESTRICTIONS_PASSWORD,
     DEFAULT_COLLECTION_NAME,
+    FEDERATED_SEARCH_MAX_COLLECTIONS,
     get_logger,
 )
 from utils.query_parsing import DBCommand
@@ -154,19 +155,14 @@ def get_access_role(
     if cached_access_role.value > AccessRole.NONE.value and access_code is None:
         return cached_access_role
 
-    # If can't be authorized with the simple checks above, check the collection's metadata
-    collection_permissions = chat_state.get_collection_permissions(coll_name_full)
-
-    user_settings = collection_permissions.get_user_settings(chat_state.user_id)
-    code_settings = collection_permissions.get_access_code_settings(access_code)
+    # If can't be authorized with the simple checks above, check the collection's
+    # permissions (cached across requests for a short time, see ACCESS_ROLE_CACHE_TTL)
+    permitted_access_role = chat_state.get_permitted_access_role(
+        coll_name_full, access_code
+    )
 
     # Determine the highest access role available
-    role = max(
-        code_settings.access_role,
-        user_settings.access_role,
-        cached_access_role,
-        key=lambda x: x.value,
-    )
+    role = max(permitted_access_role, cached_access_role, key=lambda x: x.value)
 
     # Store the access role in chat_state for future use within the same session
     # We need this, because the access code is given only once, on load
@@ -299,33 +295,9 @@ def sort_collection_names(
     return tuple(zip(*coll_name_pairs))
 
 
-BASE_DATETIME = datetime(2024, 5, 25, 0, 0, 0, tzinfo=timezone.utc)
 COLLECTION_GROUP_SIZE = 20
 
 
-def sort_collections(collections: list[Collection], user_id: str | None):
-    # TODO: optimize
-    def get_sort_key(collection: Collection):
-        try:
-            updated_at = parse_timestamp(collection.metadata["updated_at"])
-        except (KeyError, TypeError):
-            updated_at = BASE_DATETIME
-
-        is_regular = (
-            collection.name != DEFAULT_COLLECTION_NAME
-        )  # put default coll first
-        return (is_regular, -updated_at.timestamp(), collection.name)  # newest first
-
-    # Sort the collections in reverse chronological order
-    collections = sorted(collections, key=get_sort_key)
-    # coll_groups = [
-    #     collections[i : i + COLLECTION_GROUP_SIZE]
-    #     for i in range(0, len(collections), COLLECTION_GROUP_SIZE)
-    # ]
-    # [get_user_facing_collection_name(user_id, n) for n in coll_names_full]
-    return collections
-
-
 def get_time_str(blah_at: str) -> str:
     return (
         parse_timestamp(blah_at).strftime(DB_CREATED_AT_TIMESTAMP_FORMAT)
@@ -334,42 +306,52 @@ def get_time_str(blah_at: str) -> str:
     )
 
 
-def get_available_collections_str(
-    collections: list[Collection],
-    user_id: str | None,
-    idx_start: int,
-    search_str: str | None = None,
-) -> str:
+def get_collection_entries(
+    chat_state: ChatState, idx_start: int, search_str: str | None = None
+) -> tuple[list[CatalogEntry], str]:
+    """
+    Get up to COLLECTION_GROUP_SIZE + 1 of the user's collections matching the search
+    string (if any), starting from number idx_start + 1, and a description of the
+    filter for the answer.
+    """
+    prefix = substring = None
+    filter_str = ""
     if search_str:
         if search_str.endswith("*"):
             search_str = search_str.rstrip("*")
-            filter_func = lambda name: name.startswith(search_str)  # noqa
             if search_str:
+                prefix = search_str
                 filter_str = f" that begin with `{search_str}`"
         else:
-            filter_func = lambda name: search_str in name  # noqa
+            substring = search_str
             filter_str = f" that contain `{search_str}`"
-    else:
-        filter_str = ""
 
-    entries = []
-    are_there_more = False
-    start_idx_str = f" starting from number {idx_start + 1}" if idx_start else ""
+    entries = chat_state.get_user_collections(
+        offset=idx_start,
+        limit=COLLECTION_GROUP_SIZE + 1,
+        prefix=prefix,
+        substring=substring,
+    )
+    return entries, filter_str
 
-    for i, collection in enumerate(collections[idx_start:], start=idx_start):
-        coll_name_as_shown = get_user_facing_collection_name(user_id, collection.name)
-        if filter_str and not filter_func(coll_name_as_shown):
-            continue
-        if len(entries) >= COLLECTION_GROUP_SIZE:
-            are_there_more = True  # there are more matching collections than we'll show
-            break  # break without adding the current collection
 
-        dt = get_time_str((collection.metadata or {}).get("updated_at"))
-        entries.append(f"| {i+1} | `{coll_name_as_shown[:40]}` | {dt} |")
+def get_available_collections_str(
+    entries: list[CatalogEntry],
+    num_colls: int,
+    idx_start: int,
+    filter_str: str = "",
+) -> str:
+    # If there are more matching collections than we'll show, the last one is extra
+    are_there_more = len(entries) > COLLECTION_GROUP_SIZE
+    entries = entries[:COLLECTION_GROUP_SIZE]
+    start_idx_str = f" starting from number {idx_start + 1}" if idx_start else ""
 
     collections_str = "| # | Collection Name | Last Updated (UTC) |\n|---|---|---|\n"
-    collections_str += "\n".join(entries)
-    num_colls = len(collections)
+    collections_str += "\n".join(
+        f"| {entry.idx + 1} | `{entry.name_as_shown[:40]}` | "
+        f"{get_time_str(entry.updated_at)} |"
+        for entry in entries
+    )
     if not entries:
         return (
             f"No matching collections found. There are {num_colls} "
@@ -409,6 +391,64 @@ def get_db_not_found_str(name: str, access_role: str = "owner") -> str:
     ).replace("  ", " ")
 
 
+def get_vectorstores_to_search(chat_state: ChatState) -> list[ChromaDDG]:
+    """
+    Get the vectorstores of the collections selected with --collections (see
+    extract_collection_names), up to FEDERATED_SEARCH_MAX_COLLECTIONS of them. Names
+    ending with "*" are resolved to the user's matching collections (most recently
+    updated first). Raises CollectionDoesNotExist if a collection doesn't exist or the
+    user doesn't have viewer access to it.
+    """
+    coll_names_full = []
+    for name in chat_state.parsed_query.collection_names:
+        if name.endswith("*"):
+            entries = chat_state.get_user_collections(
+                prefix=name.rstrip("*"), limit=FEDERATED_SEARCH_MAX_COLLECTIONS
+            )
+            coll_names_full += [entry.name for entry in entries]
+            continue
+
+        # Same resolution as for /db use <name>: the user's own collection first
+        coll_name_full = get_full_collection_name(chat_state.user_id, name)
+        if not chat_state.is_user_collection(coll_name_full):
+            if get_access_role(chat_state, name).value < AccessRole.VIEWER.value:
+                raise CollectionDoesNotExist(
+                    f"No viewer access to collection {name}",
+                    user_facing_message=get_db_not_found_str(name, "viewer"),
+                    http_status_code=404,
+                )
+            coll_name_full = name
+        coll_names_full.append(coll_name_full)
+
+    vectorstores = []
+    for coll_name_full in dict.fromkeys(coll_names_full):  # remove duplicates
+        if len(vectorstores) >= FEDERATED_SEARCH_MAX_COLLECTIONS:
+            break
+        if coll_name_full == chat_state.vectorstore.name:
+            vectorstores.append(chat_state.vectorstore)
+        elif vectorstore := chat_state.get_new_vectorstore(
+            coll_name_full, create_if_not_exists=False
+        ):
+            vectorstores.append(vectorstore)
+        else:
+            name = get_user_facing_collection_name(chat_state.user_id, coll_name_full)
+            raise CollectionDoesNotExist(
+                f"Collection {coll_name_full} does not exist",
+                user_facing_message=get_db_not_found_str(name, "viewer"),
+                http_status_code=404,
+            )
+
+    if not vectorstores:
+        raise CollectionDoesNotExist(
+            "No collections match the given names",
+            user_facing_message="None of your collections match the given names. "
+            "Use `/db list` to see available collections.",
+            http_status_code=404,
+        )
+    logger.info(f"Searching collections: {[x.name for x in vectorstores]}")
+    return vectorstores
+
+
 def handle_db_status_command(chat_state: ChatState) -> Props:
     # Get the access role (refresh from db just in case)
     access_role = get_access_role(chat_state)
@@ -447,17 +487,14 @@ def handle_db_status_command(chat_state: ChatState) -> Props:
     return format_nonstreaming_answer(ans)
 
 
-def save_coll_data(chat_state: ChatState, collections: list[Collection]):
-    coll_data = [c.name for c in collections]
-    # for num, collection in enumerate(collections, start=1):
-    #     coll_data.append(collection.name)
-
+def save_coll_data(chat_state: ChatState, entries: list[CatalogEntry]):
+    # Save the full names of the listed collections by their numbers (as strings, so
+    # that the session data can be serialized as is)
+    coll_data = {str(entry.idx + 1): entry.name for entry in entries}
     chat_state.session_data["coll_data"] = coll_data
 
 
-def handle_db_list_command(
-    chat_state: ChatState, collections: list[Collection]
-) -> Props:
+def handle_db_list_command(chat_state: ChatState) -> Props:
     value = chat_state.parsed_query.message
     admin_pwd = BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
 
@@ -480,21 +517,20 @@ def handle_db_list_command(
         except ValueError:
             pass
 
-    save_coll_data(chat_state, collections)
+    entries, filter_str = get_collection_entries(chat_state, idx_start, value)
+    save_coll_data(chat_state, entries[:COLLECTION_GROUP_SIZE])
 
     return format_nonstreaming_answer(
         get_available_collections_str(
-            collections,
-            user_id=chat_state.user_id,
-            search_str=value,
+            entries,
+            num_colls=chat_state.count_user_collections(),
             idx_start=idx_start,
+            filter_str=filter_str,
         )
     )
 
 
-def handle_db_use_command(
-    chat_state: ChatState, collections: list[Collection]
-) -> Props:
+def handle_db_use_command(chat_state: ChatState) -> Props:
     value = chat_state.parsed_query.message
 
     if not value:
@@ -517,22 +553,21 @@ def handle_db_use_command(
         coll_name_to_show = coll_name_full
     else:
         # Not a link. Get the name of the collection to switch to
-        try:
-            # Construct hypothetical full collection name and try to find its index
-            tmp = get_full_collection_name(chat_state.user_id, value)
-            idx = next((i for i, c in enumerate(collections) if c.name == tmp))
-            coll_name_to_show = value  # NOTE: can optimize above by using dict
+        # Construct hypothetical full collection name and check if it's listed
+        tmp = get_full_collection_name(chat_state.user_id, value)
+        if chat_state.is_user_collection(tmp):
+            coll_name_to_show = value
             coll_name_full = tmp
-        except StopIteration:  # collection not found by name
+        else:  # collection not found by name
             try:
                 # See if the user provided an index directly instead of a name
                 idx = int(value) - 1
-                if idx < 0 or idx >= len(collections):
+                if idx < 0 or not (
+                    entries := chat_state.get_user_collections(offset=idx, limit=1)
+                ):
                     raise ValueError
-                coll_name_full = collections[idx].name
-                coll_name_to_show = get_user_facing_collection_name(
-                    chat_state.user_id, coll_name_full
-                )
+                coll_name_full = entries[0].name
+                coll_name_to_show = entries[0].name_as_shown
             except ValueError:
                 # See if it's a non-native collection (shared with user)
                 if get_access_role(chat_state, value).value <= AccessRole.NONE.value:
@@ -626,14 +661,39 @@ def handle_db_rename_command(chat_state: ChatState) -> Props:
     }
 
 
-def get_collection_nums(chat_state: ChatState):
+def get_collection_nums(chat_state: ChatState) -> dict[str, str] | None:
     coll_data = chat_state.session_data.get("coll_data")
-    return coll_data
+    # API clients send back the session data they got, which may still be in the older
+    # format: a list of the full names of the listed collections, starting from #1
+    if isinstance(coll_data, list):
+        return {str(i + 1): name for i, name in enumerate(coll_data)}
+    return coll_data if isinstance(coll_data, dict) else None
+
+
+def get_full_names_by_idxs(
+    chat_state: ChatState, coll_data: dict[str, str], idxs: list[int]
+) -> list[str] | None:
+    """
+    Get the full names of the collections with the given indexes in the user's list of
+    collections, or None if any of them is not in the list. Names saved by the last
+    /db list are used as is; the rest (e.g. beyond the listed page) are looked up in
+    the catalog, the same way as for /db use, with one query for all of them.
+    """
+    missing_idxs = [idx for idx in idxs if str(idx + 1) not in coll_data]
+    full_name_by_num = coll_data
+    if missing_idxs:
+        min_idx = min(missing_idxs)
+        entries = chat_state.get_user_collections(
+            offset=min_idx, limit=max(missing_idxs) - min_idx + 1
+        )
+        full_name_by_num = {str(x.idx + 1): x.name for x in entries} | coll_data
+    try:
+        return [full_name_by_num[str(idx + 1)] for idx in idxs]
+    except KeyError:
+        return None
 
 
-def handle_db_delete_command(
-    chat_state: ChatState, collections: list[Collection]
-) -> Props:
+def handle_db_delete_command(chat_state: ChatState) -> Props:
     value = chat_state.parsed_query.message
     admin_pwd = BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
 
@@ -675,18 +735,17 @@ def handle_db_delete_command(
     #     chat_state.vectorstore.client.reset()
     #     return format_nonstreaming_answer("The entire database has been reset.")
 
-    # Get the full name(s) of the collection(s) to delete
-    try:
-        # Construct hypothetical full collection name and try to find it
-        tmp = get_full_collection_name(chat_state.user_id, value)
-        next((None for c in collections if c.name == tmp))  # check if exists
-        full_names = [tmp]
+    # Get the full name(s) of the collection(s) to delete. First, construct
+    # hypothetical full collection name and try to find it
     # NOTE: there's a small chance of an ambiguity if the user has
     # a collection with the same name as a public collection, or if
     # they have their own collection with the as-shown name of
     # "u-<some other user's id>-<some other user's collection name>".
     # In both cases, the name will be resolved to the user's own collection.
-    except StopIteration:  # collection not found by name
+    tmp = get_full_collection_name(chat_state.user_id, value)
+    if chat_state.is_user_collection(tmp):
+        full_names = [tmp]
+    else:  # collection not found by name
         try:
             # See if the user provided index(es) directly instead of a name
             # NOTE: this takes precedence over non-native collection name such as
@@ -705,7 +764,7 @@ def handle_db_delete_command(
                 min_idx, max_idx = int(leftright[0]) - 1, int(leftright[1]) - 1
                 if (coll_data := get_collection_nums(chat_state)) is None:
                     return format_nonstreaming_answer(RUN_LIST_FIRST_MSG)
-                if min_idx < 1 or max_idx >= len(coll_data) or min_idx > max_idx:
+                if min_idx < 1 or min_idx > max_idx:
                     raise ValueError
                 idxs = list(range(min_idx, max_idx + 1))
             else:
@@ -715,16 +774,15 @@ def handle_db_delete_command(
                 if (coll_data := get_collection_nums(chat_state)) is None:
                     return format_nonstreaming_answer(RUN_LIST_FIRST_MSG)
 
-                # Check that all idxs are valid
-                if any(idx < 1 or idx >= len(coll_data) for idx in idxs):
-                    raise ValueError  # idx == 0 not allowed, it's the default collection
-
-            # One last check:
-            if not idxs:
-                raise ValueError
+            # Check that all idxs are valid
+            if not idxs or any(idx < 1 for idx in idxs):
+                raise ValueError  # idx == 0 not allowed, it's the default collection
 
             # Get the full names of the collections
-            full_names = [coll_data[idx] for idx in idxs]
+            if (
+                full_names := get_full_names_by_idxs(chat_state, coll_data, idxs)
+            ) is None:
+                raise ValueError
         except ValueError:
             # It's a non-native collection (or bad input)
             full_names = [value]
@@ -823,18 +881,15 @@ def handle_db_command(chat_state: ChatState) -> Props:
             )
 
     # Handle the command
-    collections = chat_state.get_user_collections()
-    collections = sort_collections(collections, chat_state.user_id)  # need user_id?
-
     if command == DBCommand.STATUS:
         return handle_db_status_command(chat_state)
     if command == DBCommand.LIST:
-        return handle_db_list_command(chat_state, collections)
+        return handle_db_list_command(chat_state)
     if command == DBCommand.USE:
-        return handle_db_use_command(chat_state, collections)
+        return handle_db_use_command(chat_state)
     if command == DBCommand.RENAME:
         return handle_db_rename_command(chat_state)
     if command == DBCommand.DELETE:
-        return handle_db_delete_command(chat_state, collections)
+        return handle_db_delete_command(chat_state)
     # Should never happen
     raise ValueError(f"Invalid /db subcommand: {command}")
@@ -12,6 +12,7 @@ from agentblocks.websearch import (
     get_links_from_queries,
     get_web_search_queries_from_prompt,
 )
+from components.research_state_store import ResearchStateNotFoundError
 from utils.chat_state import ChatState
 from utils.helpers import DELIMITER40, format_nonstreaming_answer, get_timestamp
 from utils.prepare import CONTEXT_LENGTH, get_logger
@@ -559,13 +560,14 @@ def get_new_heatseek_response(chat_state: ChatState) -> JSONishDict:
     # Perform main Heatseek workflow
     full_reply = run_main_heatseek_workflow(chat_state, hs_data)
 
-    # Save agent state into ChromaDB
+    # Save agent state into ChromaDB (the research state store)
+    hs_data_id = chat_state.research_state_store.save_state(
+        hs_data, hs_data.url_conveyer.link_data_dict.values()
+    )
     vectorstore = ingest_into_collection(
         docs=[],
         collection_name=construct_new_collection_name(query, chat_state),
-        collection_metadata={
-            "agent_data": json.dumps({"hs": hs_data.model_dump_json()})
-        },
+        collection_metadata={"agent_data": json.dumps({"hs_id": hs_data_id})},
         chat_state=chat_state,
         is_new_collection=True,
         retry_with_random_name=True,
@@ -595,11 +597,13 @@ def get_heatseek_in_progress_response(
     # Perform main Heatseek workflow
     full_reply = run_main_heatseek_workflow(chat_state, hs_data, init_reply)
 
-    # Save agent state into ChromaDB
-    chat_state.save_agent_data(
-        {"hs": hs_data.model_dump_json()},
-        use_cached_metadata=True,
+    # Save agent state into ChromaDB (the research state store)
+    hs_data_id = chat_state.research_state_store.save_state(
+        hs_data,
+        hs_data.url_conveyer.link_data_dict.values(),
+        record_id=chat_state.get_agent_data().get("hs_id"),
     )
+    chat_state.save_agent_data({"hs_id": hs_data_id})
 
     return {"answer": full_reply}
 
@@ -609,11 +613,19 @@ def get_research_heatseek_response(chat_state: ChatState) -> Props:
     if chat_state.message:
         return get_new_heatseek_response(chat_state)
 
-    hs_data = chat_state.get_agent_data(use_cached_metadata=True).get("hs")
-    # NOTE: We are using use_cached_metadata=True because metadata was fetched in the
-    # call to get_rr_data in the get_research_response function
+    agent_data = chat_state.get_agent_data()
+    if hs_data_id := agent_data.get("hs_id"):
+        # The texts of fetched pages are not loaded: they were all passed on to
+        # doc_conveyer before the state was saved
+        if not (hs_data_dict := chat_state.research_state_store.load_state(hs_data_id)):
+            logger.error(f"Heatseek state record {hs_data_id} not found")
+            raise ResearchStateNotFoundError(f"Record {hs_data_id} not found")
+        hs_data = HeatseekData.model_validate(hs_data_dict)
+    elif hs_data_json := agent_data.get("hs"):  # older style
+        hs_data = HeatseekData.model_validate_json(hs_data_json)
+    else:
+        hs_data = None
     if hs_data:
-        hs_data = HeatseekData.model_validate_json(hs_data)
         return get_heatseek_in_progress_response(chat_state, hs_data)
 
     return format_nonstreaming_answer(
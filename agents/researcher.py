@@ -32,7 +32,7 @@ from utils.lang_utils import (
     get_num_tokens_in_texts,
     limit_tokens_in_texts,
 )
-from utils.prepare import CONTEXT_LENGTH, get_logger
+from utils.prepare import CONTEXT_LENGTH, EVICT_UNUSED_LINK_TEXTS, get_logger
 from utils.prompts import (
     ITERATIVE_REPORT_IMPROVER_PROMPT,
     QUERY_GENERATOR_PROMPT,
@@ -42,7 +42,13 @@ from utils.prompts import (
 )
 from utils.query_parsing import ParsedQuery, ResearchCommand
 from utils.strings import extract_json
-from utils.type_utils import AccessRole, ChatMode, OperationMode, Props
+from utils.type_utils import (
+    RR_DATA_RECORD_ID_METADATA_KEY,
+    AccessRole,
+    ChatMode,
+    OperationMode,
+    Props,
+)
 from langchain_core.documents import Document
 
 logger = get_logger()
@@ -313,12 +319,18 @@ def get_initial_researcher_response(chat_state: ChatState) -> Props:
         if link_data.num_tokens is not None:
             metadata["num_tokens"] = link_data.num_tokens
         docs.append(Document(page_content=link_data.text, metadata=metadata))
+    if EVICT_UNUSED_LINK_TEXTS:
+        rr_data.evict_unused_link_texts()
 
     # Ingest documents into ChromaDB
     vectorstore = ingest_into_collection(
         collection_name=construct_new_collection_name(rr_data.query, chat_state),
         docs=docs,
-        collection_metadata={"rr_data": rr_data.model_dump_json()},
+        collection_metadata={
+            RR_DATA_RECORD_ID_METADATA_KEY: chat_state.research_state_store.save_state(
+                rr_data, rr_data.link_data_dict.values()
+            )
+        },
         chat_state=chat_state,
         is_new_collection=True,
         retry_with_random_name=True,
@@ -347,7 +359,6 @@ MAX_ITERATIONS_IF_OWN_KEY = 126
 def get_iterative_researcher_response(chat_state: ChatState) -> Props:
     """Process "iterate" and "more" commands."""
     # Check for editor access
-    # NOTE: can cache collection metadata for get_rr_data
     if get_access_role(chat_state).value < AccessRole.EDITOR.value:
         return format_invalid_input_answer(
             NO_EDITOR_ACCESS_MSG, NO_EDITOR_ACCESS_STATUS
@@ -359,7 +370,7 @@ def get_iterative_researcher_response(chat_state: ChatState) -> Props:
         task_type = ResearchCommand.MORE  # we were routed here from main handler
 
     # Get rr_data from the collection metadata (using metadata cached upstream)
-    rr_data: ResearchReportData = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data: ResearchReportData = chat_state.get_rr_data()
 
     # Fix for older style collections
     if not rr_data.base_reports and rr_data.main_report:
@@ -442,6 +453,7 @@ def get_iterative_researcher_response(chat_state: ChatState) -> Props:
         if rr_data.link_data_dict[link].num_tokens is None:
             links_to_count_tokens_for.append(link)
 
+    rr_data.load_link_texts(links_to_include)
     texts_to_include = [rr_data.link_data_dict[x].text for x in links_to_include]
 
     # Update rr_data once again to reflect the links about to be processed
@@ -567,23 +579,17 @@ def get_iterative_researcher_response(chat_state: ChatState) -> Props:
             metadata["num_tokens"] = link_data.num_tokens
         docs.append(Document(page_content=link_data.text, metadata=metadata))
 
-    # Ingest documents into collection
+    # Save rr_data and ingest documents into collection
+    logger.info(f"Saving rr_data and ingesting {len(docs)} new documents.")
+    chat_state.save_rr_data(rr_data)  # "updated_at" is updated when flushed
     if docs:
-        logger.info("Ingesting new documents and saving rr_data.")
-        collection_metadata = chat_state.get_cached_collection_metadata()
-        collection_metadata["rr_data"] = rr_data.model_dump_json()
         ingest_into_collection(
             collection_name=chat_state.collection_name,
             docs=docs,
-            collection_metadata=collection_metadata,
+            collection_metadata=None,
             chat_state=chat_state,
             is_new_collection=False,
         )
-    else:
-        logger.info("No new documents to ingest. Saving rr_data.")
-        chat_state.save_rr_data(rr_data)  # this updates "updated_at" field
-        # NOTE: could also save a metadata fetch if we used the cached metadata and
-        # used ingest_into_collection like above
     logger.info("Finished saving data.")
 
     return {"answer": answer, "source_links": links_to_include}
@@ -620,15 +626,12 @@ def get_report_combiner_response(chat_state: ChatState) -> Props:
         ]
 
     # Check for editor access
-    # NOTE: can cache collection metadata for get_rr_data
     if get_access_role(chat_state).value < AccessRole.EDITOR.value:
         return format_invalid_input_answer(
             NO_EDITOR_ACCESS_MSG, NO_EDITOR_ACCESS_STATUS
         )
 
-    rr_data: ResearchReportData | None = chat_state.get_rr_data(
-        use_cached_metadata=True
-    )
+    rr_data: ResearchReportData | None = chat_state.get_rr_data()
     if not rr_data:
         return format_invalid_input_answer(INVALID_COMBINE_MSG, INVALID_COMBINE_STATUS)
 
@@ -746,7 +749,7 @@ def get_research_view_response(chat_state: ChatState) -> Props:
             rr_data.get_sources(report)
         )
 
-    rr_data: ResearchReportData = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data: ResearchReportData = chat_state.get_rr_data()
     num_base_reports = len(rr_data.base_reports)
 
     num_obtained_ok_links = sum(
@@ -810,14 +813,13 @@ def get_research_view_response(chat_state: ChatState) -> Props:
 
 def get_research_set_response(chat_state: ChatState) -> Props:
     # Check for editor access
-    # NOTE: can cache collection metadata for get_rr_data
     if get_access_role(chat_state).value < AccessRole.EDITOR.value:
         return format_invalid_input_answer(
             NO_EDITOR_ACCESS_MSG, NO_EDITOR_ACCESS_STATUS
         )
 
     parsed_query = chat_state.parsed_query
-    rr_data: ResearchReportData = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data: ResearchReportData = chat_state.get_rr_data()
     is_set_query = parsed_query.research_params.task_type == ResearchCommand.SET_QUERY
 
     # Update rr_data with the new query or report type
@@ -827,7 +829,7 @@ def get_research_set_response(chat_state: ChatState) -> Props:
         rr_data.report_type = parsed_query.message
 
     # Save new rr_data in chat_state (which saves it in the database) and return
-    chat_state.save_rr_data(rr_data, use_cached_metadata=True)
+    chat_state.save_rr_data(rr_data)
 
     # Return the response
     if is_set_query:
@@ -874,14 +876,13 @@ def update_search_queries_and_links(
 
 def get_research_set_search_queries_response(chat_state: ChatState) -> Props:
     # Check for editor access
-    # NOTE: can cache collection metadata for get_rr_data
     if get_access_role(chat_state).value < AccessRole.EDITOR.value:
         return format_invalid_input_answer(
             NO_EDITOR_ACCESS_MSG, NO_EDITOR_ACCESS_STATUS
         )
 
     parsed_query = chat_state.parsed_query
-    rr_data: ResearchReportData = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data: ResearchReportData = chat_state.get_rr_data()
     new_queries = json.loads(parsed_query.message)  # validated by the parser
 
     # Update search queries and links
@@ -889,7 +890,7 @@ def get_research_set_search_queries_response(chat_state: ChatState) -> Props:
         return format_nonstreaming_answer(tmp["early_exit_msg"])
 
     # Save new rr_data in chat_state (which saves it in the database) and return
-    chat_state.save_rr_data(rr_data, use_cached_metadata=True)
+    chat_state.save_rr_data(rr_data)
 
     # Return the response
     return format_nonstreaming_answer(
@@ -903,7 +904,7 @@ def get_research_set_search_queries_response(chat_state: ChatState) -> Props:
 def auto_update_search_queries_and_links(chat_state: ChatState) -> Props:
     # We have checked for editor access upstream
 
-    rr_data = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data = chat_state.get_rr_data()
 
     # Construct query generator chain and inputs
     inputs = {
@@ -947,7 +948,7 @@ def auto_update_search_queries_and_links(chat_state: ChatState) -> Props:
         return early_exit_obj  # {"early_exit_msg": WEB_SEARCH_API_ISSUE_MSG}
 
     # Save new rr_data in chat_state (which saves it in the database) and return
-    chat_state.save_rr_data(rr_data, use_cached_metadata=True)
+    chat_state.save_rr_data(rr_data)
 
     return {"analysis": analysis, "rr_data": rr_data}
 
@@ -983,7 +984,7 @@ def get_research_clear_response(chat_state: ChatState):
             NO_EDITOR_ACCESS_MSG, NO_EDITOR_ACCESS_STATUS
         )
 
-    rr_data = chat_state.get_rr_data(use_cached_metadata=True)
+    rr_data = chat_state.get_rr_data()
 
     rr_data.base_reports = []
     rr_data.combined_reports = []
@@ -1001,7 +1002,7 @@ def get_research_clear_response(chat_state: ChatState):
     rr_data.processed_links = []
 
     # Save new rr_data in chat_state (which saves it in the database) and return
-    chat_state.save_rr_data(rr_data, use_cached_metadata=True)
+    chat_state.save_rr_data(rr_data)
     return format_nonstreaming_answer(
         "All reports have been cleared. The collection still contains the "
         "previously fetched content, which can be used to generate a new report "
@@ -1159,9 +1160,7 @@ def get_researcher_response(chat_state: ChatState) -> Props:
 #         # If it's way too long, first just shorten it mechanically
 #         # NOTE: can instead chunk it
 #         if num_tokens > max_tokens_final_context:
-#             text = limit_tokens_in_text(
-#                 text, max_tokens_final_context, slow_down_factor=0
-#             )
+#             text, _ = limit_tokens_in_text(text, max_tokens_final_context)
 #         print("SHORTENING:", link)
 #         print("CONTENT:", text)
 #         print(DELIMITER)
@@ -1,4 +1,6 @@
-from pydantic import BaseModel, Field, model_validator
+from typing import Callable
+
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
 
 from utils.web import LinkData
 
@@ -28,6 +30,9 @@ class ResearchReportData(BaseModel):
     num_links_from_latest_queries: int | None = None
     evaluation: str | None = None
 
+    # Loads link texts that are not loaded yet (see ChatState.get_rr_data)
+    _link_text_loader: Callable[[list[LinkData]], None] | None = PrivateAttr(None)
+
     @model_validator(mode="after")
     def validate(self):
         if self.num_links_from_latest_queries is None:
@@ -39,6 +44,18 @@ class ResearchReportData(BaseModel):
         # All unprocessed links are from the latest queries so we just subtract
         return self.num_links_from_latest_queries - len(self.unprocessed_links)
 
+    def load_link_texts(self, links: list[str]) -> None:
+        """Make sure the texts of the given links are loaded."""
+        if self._link_text_loader is not None:
+            self._link_text_loader([self.link_data_dict[x] for x in links])
+
+    def evict_unused_link_texts(self) -> None:
+        """Drop the texts of links that failed or have been processed and ingested."""
+        processed_links = set(self.processed_links)
+        for link, link_data in self.link_data_dict.items():
+            if link_data.error or (link_data.is_ingested and link in processed_links):
+                link_data.evict_text()
+
     def is_base_report(self, id: str) -> bool:
         return not id.startswith("c")
 
@@ -149,9 +149,7 @@ def handle_share_command(chat_state: ChatState) -> Props:
                     "Apologies, Dmitriy hasn't implemented this share subcommand for me yet."
                 )
 
-        chat_state.save_collection_permissions(
-            collection_permissions, use_cached_metadata=True
-        )
+        chat_state.save_collection_permissions(collection_permissions)
         return format_nonstreaming_answer(ans)
 
     return format_nonstreaming_answer(
@@ -2,9 +2,11 @@
 The FastAPI server that enables API access to DocDocGo.
 """
 
+import asyncio
 import json
 import os
 import traceback
+from contextlib import asynccontextmanager
 from typing import Annotated
 
 from fastapi import Body, FastAPI, File, Form, HTTPException, UploadFile
@@ -19,11 +21,13 @@ from agents.dbmanager import (
     get_user_facing_collection_name,
 )
 from components.chroma_ddg import get_vectorstore_using_openai_api_key
-from docdocgo import get_bot_response, get_source_links
+from docdocgo import aget_bot_response, get_source_links
 from utils.chat_state import AgentDataDict, ChatState, ScheduledQueries
 from utils.helpers import DELIMITER
 from utils.ingest import extract_text, format_ingest_failure
+from utils.lang_utils import preload_tiktoken_encodings
 from utils.prepare import (
+    ALLOWED_MODELS,
     BYPASS_SETTINGS_RESTRICTIONS,
     BYPASS_SETTINGS_RESTRICTIONS_PASSWORD,
     DEFAULT_COLLECTION_NAME,
@@ -46,7 +50,15 @@ from utils.type_utils import (
 
 logger = get_logger()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the tokenizers at server start rather than on the first request
+    preload_tiktoken_encodings(ALLOWED_MODELS)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow all domains/origins
 app.add_middleware(
@@ -212,10 +224,13 @@ async def handle_chat_or_ingest_request(
             scheduled_queries.add_to_front(parsed_query)
             parsed_query = parse_query("/upload")
 
-        # Initialize vectorstore and chat state
+        # Initialize vectorstore and chat state (loading the collection and checking
+        # access make sync chromadb calls, so they are run in a worker thread)
         try:
-            vectorstore = get_vectorstore_using_openai_api_key(
-                collection_name, openai_api_key=openai_api_key
+            vectorstore = await asyncio.to_thread(
+                get_vectorstore_using_openai_api_key,
+                collection_name,
+                openai_api_key=openai_api_key,
             )
         except Exception as e:
             return ChatResponseData(
@@ -244,14 +259,14 @@ async def handle_chat_or_ingest_request(
         )
 
         # Validate (and cache, for this request) the user's access level
-        access_role = get_access_role(chat_state)
+        access_role = await asyncio.to_thread(get_access_role, chat_state)
         if access_role.value <= AccessRole.NONE.value:
             return ChatResponseData(
                 content="Apologies, you do not have access to the collection."
             )
 
         # Get the bot's response
-        result = get_bot_response(chat_state)
+        result = await aget_bot_response(chat_state)
     except DDGError as e:
         print(traceback.format_exc())
         user_msg = (
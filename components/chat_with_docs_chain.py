@@ -1,16 +1,29 @@
 """Chain for chatting with a vector database."""
 from __future__ import annotations
 
-import inspect
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Callable
 from langchain.chains.base import Chain
 from langchain.chains.llm import LLMChain
+from pydantic import BaseModel
 
 from components.llm import get_llm_from_prompt_llm_chain
 from utils import lang_utils
+from utils.algo import get_jaccard_similarity
 from utils.helpers import DELIMITER
-from utils.prepare import CONTEXT_LENGTH
+from utils.prepare import (
+    CONDENSE_QUESTION_MODE,
+    CONTEXT_LENGTH,
+    QUERY_FUSION,
+    SPECULATIVE_RETRIEVAL,
+    SPECULATIVE_RETRIEVAL_MIN_SIMILARITY,
+    get_logger,
+)
+from utils.query_analysis import check_if_query_needs_condensing, get_words
 from utils.type_utils import CallbacksOrNone, JSONish, PairwiseChatHistory
 from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
 from langchain_core.documents import Document
@@ -18,6 +31,107 @@ from langchain_core.language_models import BaseLanguageModel
 from langchain_core.messages import BaseMessage
 from langchain_core.retrievers import BaseRetriever
 
+logger = get_logger()
+
+
+class SpeculativeRetrievalStats(BaseModel):
+    num_hits: int = 0
+    num_misses: int = 0
+    time_saved: float = 0.0  # seconds
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hits / ((self.num_hits + self.num_misses) or 1)
+
+
+class CondenseQuestionStats(BaseModel):
+    num_condensed: int = 0
+    num_skipped: int = 0
+    total_condense_time: float = 0.0  # seconds, for the condensed queries
+
+    @property
+    def skip_rate(self) -> float:
+        return self.num_skipped / ((self.num_skipped + self.num_condensed) or 1)
+
+    @property
+    def avg_condense_time(self) -> float:
+        return self.total_condense_time / (self.num_condensed or 1)
+
+    @property
+    def estimated_time_saved(self) -> float:
+        return self.num_skipped * self.avg_condense_time
+
+
+# Stats for all chains in this worker
+speculative_retrieval_stats = SpeculativeRetrievalStats()
+condense_question_stats = CondenseQuestionStats()
+stats_lock = threading.Lock()
+speculative_retrieval_executor = ThreadPoolExecutor(
+    thread_name_prefix="speculative-retrieval"
+)
+
+
+def record_speculative_retrieval(
+    is_hit: bool, similarity: float, time_saved: float
+) -> None:
+    """Update the speculative retrieval stats and log the outcome."""
+    stats = speculative_retrieval_stats
+    with stats_lock:
+        if is_hit:
+            stats.num_hits += 1
+            stats.time_saved += time_saved
+        else:
+            stats.num_misses += 1
+        logger.info(
+            f"Speculative retrieval {'hit' if is_hit else 'miss'} "
+            f"(query similarity {similarity:.2f}), saved {time_saved:.2f}s. "
+            f"Total: {stats.num_hits}/{stats.num_hits + stats.num_misses} hits, "
+            f"saved {stats.time_saved:.2f}s"
+        )
+
+
+def record_condense_question(condense_time: float | None, reason: str) -> None:
+    """
+    Update the condense question stats (condense_time is None if condensing was
+    skipped) and log the outcome.
+    """
+    stats = condense_question_stats
+    with stats_lock:
+        if condense_time is None:
+            stats.num_skipped += 1
+        else:
+            stats.num_condensed += 1
+            stats.total_condense_time += condense_time
+        logger.info(
+            f"{'Skipped' if condense_time is None else 'Condensed'} query ({reason}). "
+            f"Total: skipped {stats.num_skipped}/"
+            f"{stats.num_skipped + stats.num_condensed}, "
+            f"est. saved {stats.estimated_time_saved:.2f}s"
+        )
+
+
+def log_discarded_speculative_retrieval(future: Future | asyncio.Task) -> None:
+    """
+    Done callback for a speculative retrieval whose results aren't used: logs its
+    error, if any (once running, it can't be cancelled, so it's left to finish).
+    """
+    if not future.cancelled() and (e := future.exception()) is not None:
+        logger.warning(f"Discarded speculative retrieval failed: {e!r}")
+
+
+def call_and_time(func: Callable, *args, **kwargs) -> tuple[Any, float]:
+    """Call a function and return its result and how long the call took."""
+    t_start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t_start
+
+
+async def await_and_time(coro) -> tuple[Any, float]:
+    """Await a coroutine and return its result and how long it took."""
+    t_start = time.perf_counter()
+    res = await coro
+    return res, time.perf_counter() - t_start
+
 
 class ChatWithDocsChain(Chain):
     """
@@ -52,6 +166,20 @@ class ChatWithDocsChain(Chain):
             question as part of the final result. Default is False.
         get_chat_history (Callable[[PairwiseChatHistory], str] | None): An optional
             function to get a string of the chat history. Default is None.
+        speculative_retrieval (bool): Whether to start retrieval for the raw user
+            query while the standalone query is being generated. If the standalone
+            query turns out to be close enough to the raw query, the speculative
+            results are used; otherwise, retrieval is redone for the standalone query.
+        speculative_retrieval_min_similarity (float): Min lexical (Jaccard)
+            similarity between the raw and standalone queries to use the
+            speculative results.
+        condense_question_mode (str): "always" to always generate a standalone query
+            when there is chat history, or "heuristic" to skip it for queries that
+            rules and lexical cues deem self-contained.
+        query_fusion (bool): Whether to retrieve docs for both the standalone query
+            and the raw user query (when they differ) and fuse the results. The
+            retriever must accept the `extra_queries` parameter (see
+            ChromaDDGRetriever). Speculative retrieval is not used in this mode.
     """
 
     qa_from_docs_chain: Any  # res of get_prompt_llm_chain (Chain causes pydantic error)
@@ -75,6 +203,11 @@ class ChatWithDocsChain(Chain):
     return_generated_question: bool = False
     format_chat_history: Callable[[PairwiseChatHistory], Any] | None = None
 
+    speculative_retrieval: bool = SPECULATIVE_RETRIEVAL
+    speculative_retrieval_min_similarity: float = SPECULATIVE_RETRIEVAL_MIN_SIMILARITY
+    condense_question_mode: str = CONDENSE_QUESTION_MODE
+    query_fusion: bool = QUERY_FUSION
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -99,15 +232,10 @@ class ChatWithDocsChain(Chain):
             res.append("generated_question")
         return res
 
-    def _limit_token_count_in_docs(
-        self,
-        docs: list[Document],
-        max_tokens: int,
-        llm_for_token_counting: BaseLanguageModel,
-    ) -> tuple[list[Document], int]:
-        """Reduce the number of tokens in the documents below the limit."""
-
-        # Get the number of tokens in each document
+    def _get_token_counts_in_docs(
+        self, docs: list[Document], llm_for_token_counting: BaseLanguageModel
+    ) -> list[int]:
+        """Get the number of tokens in each document."""
         try:
             # When using ChromaDDGRetriever, the number of tokens is already cached
             token_counts = [doc.metadata["num_tokens"] for doc in docs]
@@ -117,36 +245,18 @@ class ChatWithDocsChain(Chain):
                 [doc.page_content for doc in docs],
                 llm_for_token_counting,
             )
-
-        # Reduce the number of documents until we're below the limit
-        token_count = sum(token_counts)
-        num_docs = len(docs)
-        print("TOKEN COUNT:", token_count)
+        print("TOKEN COUNT:", sum(token_counts))
         print(DELIMITER)
-        while token_count > max_tokens and num_docs:
-            num_docs -= 1
-            token_count -= token_counts[num_docs]
-
-        return docs[:num_docs], token_count
+        return token_counts
 
-    def _call(
-        self,
-        inputs: JSONish,
-        run_manager: CallbackManagerForChainRun | None = None,  # TODO consider removing
-    ) -> JSONish:
-        """Run the chain."""
-
-        # _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
-        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
-
-        _format_chat_history = (
-            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
-        )
-
-        # Get user's query and chat history from inputs
-        user_query = inputs["question"]
+    def _get_token_budget_allocator(
+        self, inputs: JSONish
+    ) -> lang_utils.TokenBudgetAllocator:
+        """
+        Get the chat history from the inputs and return a token budget allocator
+        for it, which initially limits it and counts the tokens in each message pair.
+        """
         chat_history = inputs["chat_history"]
-        search_kwargs = inputs.get("search_params", {})  # e.g. {"filter": {...}}
 
         # Convert chat history to unified format (PairwiseChatHistory)
         # (it could instead be a list of messages, in which case we convert it)
@@ -161,74 +271,123 @@ class ChatWithDocsChain(Chain):
         chat_history_token_limit = max(
             self.max_tokens_limit_rephrase, self.max_tokens_limit_qa
         )
-        llm_for_token_counting = get_llm_from_prompt_llm_chain(self.qa_from_docs_chain)
-
-        chat_history, chat_history_token_counts = lang_utils.limit_chat_history(
+        return lang_utils.TokenBudgetAllocator(
             chat_history,
             max_token_limit=chat_history_token_limit,
-            llm_for_token_counting=llm_for_token_counting,
+            llm_for_token_counting=get_llm_from_prompt_llm_chain(
+                self.qa_from_docs_chain
+            ),
         )
 
-        # Generate a standalone query using chat history
-        if not chat_history:
-            standalone_query = user_query  # no chat history to rephrase
-        else:
-            chat_history_for_rephrasing, _ = lang_utils.limit_chat_history(
-                chat_history,
-                max_token_limit=self.max_tokens_limit_rephrase,
-                cached_token_counts=chat_history_token_counts,
-                llm_for_token_counting=llm_for_token_counting,
-            )
-
-            standalone_query = self.query_generator_chain.invoke(
-                {
-                    "question": user_query,
-                    "chat_history": _format_chat_history(chat_history_for_rephrasing),
-                }
-                # callbacks=_run_manager.get_child(),
-            )["text"]
+    def _get_query_generator_inputs(
+        self, user_query: str, token_budget: lang_utils.TokenBudgetAllocator
+    ) -> dict[str, str]:
+        """Get the inputs for the standalone query generator."""
+        _format_chat_history = (
+            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
+        )
+        chat_history_for_rephrasing, _ = token_budget.limit_chat_history(
+            self.max_tokens_limit_rephrase
+        )
+        return {
+            "question": user_query,
+            "chat_history": _format_chat_history(chat_history_for_rephrasing),
+        }
 
-        # Get relevant documents using the standalone query
-        docs = self.retriever.get_relevant_documents(
-            standalone_query,
-            # callbacks=_run_manager.get_child(),
-            **search_kwargs,
+    def _needs_condensing(
+        self, user_query: str, chat_history: PairwiseChatHistory
+    ) -> tuple[bool, str]:
+        """
+        Decide whether to generate a standalone query. Returns the verdict and the
+        reason for it.
+        """
+        if not chat_history:
+            return False, "no chat history"
+        if self.condense_question_mode != "heuristic":
+            return True, f"condense question mode is {self.condense_question_mode}"
+        return check_if_query_needs_condensing(user_query, chat_history)
+
+    def _plan_condensing(
+        self, user_query: str, chat_history: PairwiseChatHistory
+    ) -> tuple[bool, bool, str]:
+        """
+        Decide whether to generate a standalone query and whether to start retrieval
+        for the raw query while it's generated. Returns both verdicts and the reason
+        for the first one (skipped condensing is recorded in the stats here).
+        """
+        needs_condensing, reason = self._needs_condensing(user_query, chat_history)
+        if not needs_condensing and chat_history:
+            record_condense_question(None, reason)
+        speculate = (
+            needs_condensing and self.speculative_retrieval and not self.query_fusion
         )
+        return needs_condensing, speculate, reason
 
-        # Find limited token number for chat history
-        # token_count_chat = 0
-        # for token_count in reversed(chat_history_token_counts):
-        #     token_count_chat += token_count
-        #     if token_count_chat > self.max_tokens_limit_chat:
-        #         token_count_chat -= token_count  # undo
-        #         break
-        _, new_chat_hist_token_counts = lang_utils.limit_chat_history(
-            chat_history,
-            max_token_limit=self.max_tokens_limit_chat,
-            llm_for_token_counting=llm_for_token_counting,
-            cached_token_counts=chat_history_token_counts,
+    def _check_speculation(
+        self, user_query: str, standalone_query: str
+    ) -> tuple[bool, float]:
+        """
+        Check if the results of the speculative retrieval for the raw user query can be
+        used for the standalone query. Returns the verdict and the similarity.
+        """
+        if standalone_query.strip() == user_query.strip():
+            return True, 1.0
+        similarity = get_jaccard_similarity(
+            set(get_words(user_query)), set(get_words(standalone_query))
         )
-        # NOTE The only difference between new and old token counts (apart from length)
-        # is that the very first message pair may have been shortened.
-        token_count_chat = sum(new_chat_hist_token_counts)
-
-        # Reduce number of docs to fit in overall token limit
-        max_tokens_limit_docs = self.max_tokens_limit_qa - token_count_chat
-        docs, token_count_docs = self._limit_token_count_in_docs(
-            docs, max_tokens_limit_docs, llm_for_token_counting
+        return similarity >= self.speculative_retrieval_min_similarity, similarity
+
+    @staticmethod
+    def _finish_speculation(
+        speculative_docs_future: Future | asyncio.Task,
+        is_hit: bool,
+        similarity: float,
+        condense_time: float,
+        retrieval_time: float,
+    ) -> None:
+        """
+        Record the outcome of speculative retrieval. On a miss, cancel the retrieval
+        if it hasn't started yet; otherwise it finishes in the background and its error,
+        if any, is logged.
+        """
+        if not is_hit:
+            speculative_docs_future.cancel()
+            speculative_docs_future.add_done_callback(
+                log_discarded_speculative_retrieval
+            )
+        record_speculative_retrieval(
+            is_hit, similarity, min(condense_time, retrieval_time)
         )
 
-        # Reevaluate limit for chat history (maybe can fit more) and limit it
-        chat_history_for_qa, _ = lang_utils.limit_chat_history(
-            chat_history,
-            max_token_limit=self.max_tokens_limit_qa - token_count_docs,
-            llm_for_token_counting=llm_for_token_counting,
-            cached_token_counts=chat_history_token_counts,
+    def _get_retrieval_kwargs(
+        self, inputs: JSONish, user_query: str, standalone_query: str
+    ) -> dict[str, Any]:
+        """Get the kwargs to pass to the retriever along with the standalone query."""
+        search_kwargs = inputs.get("search_params", {})  # e.g. {"filter": {...}}
+        if self.query_fusion and standalone_query.strip() != user_query.strip():
+            return search_kwargs | {"extra_queries": [user_query]}
+        return search_kwargs
+
+    def _get_qa_inputs(
+        self,
+        inputs: JSONish,
+        token_budget: lang_utils.TokenBudgetAllocator,
+        docs: list[Document],
+    ) -> tuple[dict[str, Any], list[Document]]:
+        """
+        Limit the chat history and docs to fit in the token limits and prepare the
+        inputs for the chat/qa chain. Returns the inputs and the docs that were kept.
+        """
+        chat_history_for_qa, num_docs, _ = token_budget.allocate(
+            self._get_token_counts_in_docs(docs, token_budget.llm_for_token_counting),
+            max_tokens_limit_qa=self.max_tokens_limit_qa,
+            max_tokens_limit_chat=self.max_tokens_limit_chat,
         )
+        docs = docs[:num_docs]
 
         # Prepare inputs for the chat_with_docs prompt
         qa_inputs = {
-            "question": user_query,
+            "question": inputs["question"],
             "coll_name": inputs.get("coll_name", "<UNKNOWN>"),
             "chat_history": lang_utils.pairwise_chat_history_to_msg_list(
                 chat_history_for_qa
@@ -243,11 +402,12 @@ class ChatWithDocsChain(Chain):
                 context += ":"
             context += f"\n\n{doc.page_content}\n-------------\n\n"
         qa_inputs["context"] = context
+        return qa_inputs, docs
 
-        # Submit limited docs and chat history to the chat/qa chain
-        answer = self.qa_from_docs_chain.invoke(qa_inputs, {"callbacks": callbacks})
-
-        # Format and return the answer
+    def _get_output(
+        self, answer: str, docs: list[Document], standalone_query: str
+    ) -> dict[str, Any]:
+        """Format the output of the chain."""
         output = {self.output_key: answer}
         if self.return_source_documents:
             output["source_documents"] = docs
@@ -255,46 +415,142 @@ class ChatWithDocsChain(Chain):
             output["generated_question"] = standalone_query
         return output
 
+    def _call(
+        self,
+        inputs: JSONish,
+        run_manager: CallbackManagerForChainRun | None = None,  # TODO consider removing
+    ) -> JSONish:
+        """Run the chain."""
+
+        # _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
+
+        # Get user's query and chat history from inputs
+        user_query = inputs["question"]
+        token_budget = self._get_token_budget_allocator(inputs)
+        needs_condensing, speculate, reason = self._plan_condensing(
+            user_query, token_budget.chat_history
+        )
+
+        # Start retrieval for the raw query while the standalone query is generated.
+        # NOTE: The speculative retrieval uses a copy of the retriever because it
+        # may still be running when we retrieve docs for the standalone query.
+        if speculate:
+            speculative_docs_future = speculative_retrieval_executor.submit(
+                call_and_time,
+                self.retriever.model_copy().get_relevant_documents,
+                user_query,
+                **inputs.get("search_params", {}),
+            )
+
+        # Generate a standalone query using chat history (if needed)
+        standalone_query, condense_time = user_query, 0.0
+        if needs_condensing:
+            query_generator_output, condense_time = call_and_time(
+                self.query_generator_chain.invoke,
+                self._get_query_generator_inputs(user_query, token_budget),
+            )
+            standalone_query = query_generator_output["text"]
+            record_condense_question(condense_time, reason)
+
+        # Use the speculative results if the standalone query is close enough to the
+        # raw query. NOTE: On a miss, a speculative retrieval that's already running
+        # can't be stopped, so a miss costs a full extra retrieval.
+        docs = None
+        if speculate:
+            is_hit, similarity = self._check_speculation(user_query, standalone_query)
+            docs, retrieval_time = (
+                speculative_docs_future.result() if is_hit else (None, 0.0)
+            )
+            self._finish_speculation(
+                speculative_docs_future,
+                is_hit,
+                similarity,
+                condense_time,
+                retrieval_time,
+            )
+
+        # Get relevant documents using the standalone query (and the raw query, if
+        # using query fusion)
+        if docs is None:
+            docs = self.retriever.get_relevant_documents(
+                standalone_query,
+                # callbacks=_run_manager.get_child(),
+                **self._get_retrieval_kwargs(inputs, user_query, standalone_query),
+            )
+
+        # Limit docs and chat history and submit them to the chat/qa chain
+        qa_inputs, docs = self._get_qa_inputs(inputs, token_budget, docs)
+        answer = self.qa_from_docs_chain.invoke(qa_inputs, {"callbacks": callbacks})
+
+        # Format and return the answer
+        return self._get_output(answer, docs, standalone_query)
+
     async def _acall(
         self,
-        inputs: dict[str, Any],
+        inputs: JSONish,
         run_manager: AsyncCallbackManagerForChainRun | None = None,
-    ) -> dict[str, Any]:
-        raise NotImplementedError("Async version (_acall) not implemented yet.")
-        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
-        question = inputs["question"]
-        get_chat_history = (
-            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
+    ) -> JSONish:
+        """Run the chain asynchronously (same steps as in _call)."""
+
+        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
+
+        # Get user's query and chat history from inputs
+        user_query = inputs["question"]
+        token_budget = self._get_token_budget_allocator(inputs)
+        needs_condensing, speculate, reason = self._plan_condensing(
+            user_query, token_budget.chat_history
         )
-        chat_history_str = get_chat_history(inputs["chat_history"])
-        if chat_history_str:
-            callbacks = _run_manager.get_child()
-            new_question = await self.query_generator_chain.arun(
-                question=question, chat_history=chat_history_str, callbacks=callbacks
+
+        # Start retrieval for the raw query while the standalone query is generated
+        # (using a copy of the retriever, as in _call)
+        if speculate:
+            speculative_docs_task = asyncio.create_task(
+                await_and_time(
+                    self.retriever.model_copy().ainvoke(
+                        user_query, **inputs.get("search_params", {})
+                    )
+                )
             )
-        else:
-            new_question = question
-        accepts_run_manager = (
-            "run_manager" in inspect.signature(self._aget_docs).parameters
-        )
-        if accepts_run_manager:
-            docs = await self._aget_docs(new_question, inputs, run_manager=_run_manager)
-        else:
-            docs = await self._aget_docs(new_question, inputs)  # type: ignore[call-arg]
-
-        new_inputs = inputs.copy()
-        if self.rephrase_question:
-            new_inputs["question"] = new_question
-        new_inputs["chat_history"] = chat_history_str
-        answer = await self.qa_from_docs_chain.arun(
-            input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+
+        # Generate a standalone query using chat history (if needed)
+        standalone_query, condense_time = user_query, 0.0
+        if needs_condensing:
+            query_generator_output, condense_time = await await_and_time(
+                self.query_generator_chain.ainvoke(
+                    self._get_query_generator_inputs(user_query, token_budget)
+                )
+            )
+            standalone_query = query_generator_output["text"]
+            record_condense_question(condense_time, reason)
+
+        # Use the speculative results if the standalone query is close enough
+        docs = None
+        if speculate:
+            is_hit, similarity = self._check_speculation(user_query, standalone_query)
+            docs, retrieval_time = (
+                (await speculative_docs_task) if is_hit else (None, 0.0)
+            )
+            self._finish_speculation(
+                speculative_docs_task, is_hit, similarity, condense_time, retrieval_time
+            )
+
+        # Get relevant documents using the standalone query (and the raw query, if
+        # using query fusion)
+        if docs is None:
+            docs = await self.retriever.ainvoke(
+                standalone_query,
+                **self._get_retrieval_kwargs(inputs, user_query, standalone_query),
+            )
+
+        # Limit docs and chat history and submit them to the chat/qa chain
+        qa_inputs, docs = self._get_qa_inputs(inputs, token_budget, docs)
+        answer = await self.qa_from_docs_chain.ainvoke(
+            qa_inputs, {"callbacks": callbacks}
         )
-        output: dict[str, Any] = {self.output_key: answer}
-        if self.return_source_documents:
-            output["source_documents"] = docs
-        if self.return_generated_question:
-            output["generated_question"] = new_question
-        return output
+
+        # Format and return the answer
+        return self._get_output(answer, docs, standalone_query)
 
     def save(self, file_path: Path | str) -> None:
         if self.format_chat_history:
@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 from typing import Any, Callable, Optional
 
 from chromadb import ClientAPI, Collection, HttpClient, PersistentClient
@@ -6,17 +8,25 @@ from chromadb.api.types import Where  # , WhereDocument
 from chromadb.config import Settings
 from langchain_community.vectorstores.chroma import _results_to_docs_and_scores
 from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
 
+from components.collection_catalog import get_collection_catalog
 from components.openai_embeddings_ddg import get_openai_embeddings
+from utils.cache_utils import LRUCache, get_attached_cache
 from utils.prepare import (
+    ACCESS_ROLE_CACHE_MAX_ITEMS,
+    ACCESS_ROLE_CACHE_TTL,
+    CHROMA_CLIENT_HEALTH_CHECK_INTERVAL,
     CHROMA_SERVER_AUTHN_CREDENTIALS,
     CHROMA_SERVER_HOST,
     CHROMA_SERVER_HTTP_PORT,
+    COLLECTION_CACHE_MAX_ITEMS,
+    COLLECTION_METADATA_TTL,
     USE_CHROMA_VIA_HTTP,
     VECTORDB_DIR,
     get_logger,
 )
-from utils.type_utils import DDGError
+from utils.type_utils import AccessRole, DDGError
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 
@@ -29,6 +39,114 @@ class CollectionDoesNotExist(DDGError):
     pass  # REVIEW
 
 
+def get_collection_cache(client: ClientAPI) -> LRUCache:
+    """
+    Get the cache of the client's collection handles (which include the collections'
+    metadata), shared across requests. Keys are collection names, values are (time
+    fetched, collection or None if the collection doesn't exist). The cache is attached
+    to the client, so a client that replaces it (see ChromaClientPool) starts afresh.
+    """
+    return get_attached_cache(
+        client,
+        "collection_cache",
+        lambda: LRUCache(max_size=COLLECTION_CACHE_MAX_ITEMS, name="collections"),
+    )
+
+
+def get_collection_cached(client: ClientAPI, collection_name: str) -> Collection:
+    """
+    Get a collection handle (without an embedding function), reusing the one in the
+    collection cache if it was fetched less than COLLECTION_METADATA_TTL seconds ago.
+    Raises CollectionDoesNotExist if the collection does not exist (which is cached
+    for the same time).
+    """
+    collection_cache = get_collection_cache(client)
+    if (cached := collection_cache.get(collection_name)) is not None:
+        fetched_at, collection = cached
+        if time.monotonic() - fetched_at < COLLECTION_METADATA_TTL:
+            if collection is None:
+                raise CollectionDoesNotExist()
+            return collection
+
+    try:
+        collection = client.get_collection(collection_name, embedding_function=None)
+    except Exception as e:  # Exception: {ValueError: "Collection 'test' does not exist"}
+        logger.info(f"Failed to get collection {collection_name}: {str(e)}")
+        if "does not exist" not in str(e):
+            raise e
+        collection_cache.put(collection_name, (time.monotonic(), None))
+        raise CollectionDoesNotExist()
+    cache_collection(client, collection)
+    return collection
+
+
+def cache_collection(client: ClientAPI, collection: Collection) -> None:
+    """Put a freshly fetched or created collection handle in the collection cache."""
+    get_collection_cache(client).put(collection.name, (time.monotonic(), collection))
+
+
+def invalidate_cached_collection(client: ClientAPI, collection_name: str) -> None:
+    """
+    Remove a collection's handle (or the fact it doesn't exist) from the cache, along
+    with the access roles cached for it.
+    """
+    get_collection_cache(client).pop(collection_name)
+    invalidate_cached_access_roles(client, collection_name)
+
+
+def get_access_role_cache(client: ClientAPI) -> LRUCache:
+    """
+    Get the cache of the access roles given by the client's collections' permissions to
+    users and access codes, shared across requests (so that e.g. stateless API requests
+    don't have to fetch and parse the permissions each time). Keys are collection names,
+    values are dicts mapping (user id, access code) to (time determined, access role).
+    Like the collection cache, it's attached to the client.
+    """
+    return get_attached_cache(
+        client,
+        "access_role_cache",
+        lambda: LRUCache(max_size=ACCESS_ROLE_CACHE_MAX_ITEMS, name="access roles"),
+    )
+
+
+def get_cached_permitted_access_role(
+    client: ClientAPI,
+    collection_name: str,
+    user_id: str | None,
+    access_code: str | None,
+) -> AccessRole | None:
+    """
+    Get the access role that the collection's permissions give the user or the access
+    code (whichever is higher), if it was cached less than ACCESS_ROLE_CACHE_TTL
+    seconds ago, otherwise None.
+    """
+    roles = get_access_role_cache(client).get(collection_name) or {}
+    if (cached := roles.get((user_id, access_code))) is not None:
+        cached_at, access_role = cached
+        if time.monotonic() - cached_at < ACCESS_ROLE_CACHE_TTL:
+            return access_role
+    return None
+
+
+def cache_permitted_access_role(
+    client: ClientAPI,
+    collection_name: str,
+    user_id: str | None,
+    access_code: str | None,
+    access_role: AccessRole,
+) -> None:
+    """Cache the access role that the collection's permissions give the user/code."""
+    access_role_cache = get_access_role_cache(client)
+    roles = dict(access_role_cache.get(collection_name) or {})  # values are immutable
+    roles[(user_id, access_code)] = (time.monotonic(), access_role)
+    access_role_cache.put(collection_name, roles)
+
+
+def invalidate_cached_access_roles(client: ClientAPI, collection_name: str) -> None:
+    """Remove the access roles cached for a collection."""
+    get_access_role_cache(client).pop(collection_name)
+
+
 class ChromaDDG(Chroma):
     """
     Modified Chroma vectorstore for DocDocGo.
@@ -39,6 +157,10 @@ class ChromaDDG(Chroma):
     which allows us to pass the 'where_document' parameter.
     2. __init__ is overridden to allow the option of using get_collection (which doesn't create
     a collection if it doesn't exist) rather than always using get_or_create_collection (which does).
+    3. Async similarity search embeds the query asynchronously (rather than running the whole
+    sync search in an executor) and only runs the chromadb query in an executor.
+    4. Several queries can be searched for at once, embedded in one batch and sent to
+    chromadb in a single request (similarity_search_many_with_score).
     """
 
     def __init__(
@@ -74,15 +196,12 @@ class ChromaDDG(Chroma):
                 embedding_function=None,
                 metadata=collection_metadata,
             )
+            cache_collection(self._client, self._collection)
+            get_collection_catalog(self._client).on_collection_saved(
+                self.name, self._collection.metadata
+            )
         else:
-            try:
-                self._collection = self._client.get_collection(
-                    name=collection_name,
-                    embedding_function=None,
-                )
-            except Exception as e:
-                logger.info(f"Failed to get collection {collection_name}: {str(e)}")
-                raise CollectionDoesNotExist() if "does not exist" in str(e) else e
+            self._collection = get_collection_cached(self._client, collection_name)
 
     def __bool__(self) -> bool:
         """Always return True to avoid ambiguity of what False could mean."""
@@ -107,26 +226,72 @@ class ChromaDDG(Chroma):
         """Get locally cached metadata for the underlying chromadb collection."""
         return self._collection.metadata
 
-    def fetch_collection_metadata(self) -> dict[str, Any]:
-        """Fetch metadata for the underlying chromadb collection."""
+    def fetch_collection_metadata(self, use_cache: bool = True) -> dict[str, Any]:
+        """
+        Fetch metadata for the underlying chromadb collection. If use_cache is True, it
+        can be up to COLLECTION_METADATA_TTL seconds old (unless it was changed by this
+        process), otherwise it's fetched from the database.
+        """
         logger.info(f"Fetching metadata for collection {self.name}")
-        self._collection = self._client.get_collection(
-            self.name, embedding_function=self._collection._embedding_function
-        )
+        if not use_cache:
+            invalidate_cached_collection(self._client, self.name)
+        self._collection = get_collection_cached(self._client, self.name)
         logger.info(f"Fetched metadata for collection {self.name}")
         return self._collection.metadata
 
     def save_collection_metadata(self, metadata: dict[str, Any]) -> None:
         """Set metadata for the underlying chromadb collection."""
         self._collection.modify(metadata=metadata)
+        invalidate_cached_collection(self._client, self.name)
+        get_collection_catalog(self._client).on_collection_saved(self.name, metadata)
 
     def rename_collection(self, new_name: str) -> None:
         """Rename the underlying chromadb collection."""
+        old_name = self.name
         self._collection.modify(name=new_name)
+        invalidate_cached_collection(self._client, old_name)
+        invalidate_cached_collection(self._client, new_name)
+        catalog = get_collection_catalog(self._client)
+        catalog.on_collection_deleted(old_name)
+        catalog.on_collection_saved(new_name, self._collection.metadata)
 
     def delete_collection(self, collection_name: str) -> None:
         """Delete the underlying chromadb collection."""
         self._client.delete_collection(collection_name)
+        invalidate_cached_collection(self._client, collection_name)
+        get_collection_catalog(self._client).on_collection_deleted(collection_name)
+
+    def get_chunks_by_position(
+        self, chunk_ranges: list[tuple[str, int, int]]
+    ) -> list[Document]:
+        """
+        Fetch chunks by their position in their parent documents. Each range is a
+        tuple (parent_id, start_chunk_idx, end_chunk_idx), with end_chunk_idx not
+        included. All ranges are fetched in a single request.
+
+        Only works for collections whose chunks have the "chunk_idx" metadata field.
+        """
+        clauses = [
+            {
+                "$and": [
+                    {"parent_id": parent_id},
+                    {"chunk_idx": {"$gte": start_chunk_idx}},
+                    {"chunk_idx": {"$lt": end_chunk_idx}},
+                ]
+            }
+            for parent_id, start_chunk_idx, end_chunk_idx in chunk_ranges
+            if start_chunk_idx < end_chunk_idx
+        ]
+        if not clauses:
+            return []
+
+        # NOTE: Chroma requires at least two clauses in an "$or"
+        where = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+        rsp = self._collection.get(where=where, include=["documents", "metadatas"])
+        return [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(rsp["documents"], rsp["metadatas"])
+        ]
 
     def similarity_search_with_score(
         self,
@@ -150,31 +315,246 @@ class ChromaDDG(Chroma):
             the query text and cosine distance in float for each.
         """
 
-        # Determine if the passed kwargs contain a 'where_document' parameter
-        # If so, we'll pass it to the __query_collection method
-        try:
-            possible_where_document_kwarg = {"where_document": kwargs["where_document"]}
-        except KeyError:
-            possible_where_document_kwarg = {}
-
         # Query by text or embedding, depending on whether an embedding function is present
         if self._embedding_function is None:
             results = self._Chroma__query_collection(
                 query_texts=[query],
                 n_results=k,
                 where=filter,
-                **possible_where_document_kwarg,
+                **get_where_document_kwarg(kwargs),
             )
-        else:
-            query_embedding = self._embedding_function.embed_query(query)
+            return _results_to_docs_and_scores(results)
+
+        query_embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(
+            query_embedding, k, filter, **kwargs
+        )
+
+    async def asimilarity_search_with_score(
+        self,
+        query: str,
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        Async version of similarity_search_with_score. The query is embedded
+        asynchronously and the chromadb query is run in an executor.
+        """
+        if self._embedding_function is None:
+            return await run_in_executor(
+                None, self.similarity_search_with_score, query, k, filter, **kwargs
+            )
+
+        query_embedding = await self._embedding_function.aembed_query(query)
+        return await run_in_executor(
+            None,
+            self.similarity_search_by_vector_with_score,
+            query_embedding,
+            k,
+            filter,
+            **kwargs,
+        )
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        Same as similarity_search_with_score, but takes the query's embedding
+        instead of the query text.
+        """
+        results = self._Chroma__query_collection(
+            query_embeddings=[embedding],
+            n_results=k,
+            where=filter,
+            **get_where_document_kwarg(kwargs),
+        )
+        return _results_to_docs_and_scores(results)
+
+    def similarity_search_many_with_score(
+        self,
+        queries: list[str],
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        Same as similarity_search_with_score, but for several queries at once: they
+        are embedded in one batch and sent to chromadb in a single request. Returns
+        the docs and distances for each query.
+        """
+        if self._embedding_function is None:
             results = self._Chroma__query_collection(
-                query_embeddings=[query_embedding],
+                query_texts=queries,
                 n_results=k,
                 where=filter,
-                **possible_where_document_kwarg,
+                **get_where_document_kwarg(kwargs),
             )
+            return get_docs_and_scores_for_each_query(results)
 
-        return _results_to_docs_and_scores(results)
+        query_embeddings = self._embedding_function.embed_documents(queries)
+        return self.similarity_search_by_vectors_with_score(
+            query_embeddings, k, filter, **kwargs
+        )
+
+    async def asimilarity_search_many_with_score(
+        self,
+        queries: list[str],
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[list[tuple[Document, float]]]:
+        """Async version of similarity_search_many_with_score."""
+        if self._embedding_function is None:
+            return await run_in_executor(
+                None,
+                self.similarity_search_many_with_score,
+                queries,
+                k,
+                filter,
+                **kwargs,
+            )
+
+        query_embeddings = await self._embedding_function.aembed_documents(queries)
+        return await run_in_executor(
+            None,
+            self.similarity_search_by_vectors_with_score,
+            query_embeddings,
+            k,
+            filter,
+            **kwargs,
+        )
+
+    def similarity_search_by_vectors_with_score(
+        self,
+        embeddings: list[list[float]],
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        Same as similarity_search_many_with_score, but takes the queries' embeddings
+        instead of the query texts.
+        """
+        results = self._Chroma__query_collection(
+            query_embeddings=embeddings,
+            n_results=k,
+            where=filter,
+            **get_where_document_kwarg(kwargs),
+        )
+        return get_docs_and_scores_for_each_query(results)
+
+
+class MetadataConflictError(DDGError):
+    """Exception raised when collection metadata was changed by another writer."""
+
+    default_user_facing_message = (
+        "Apologies, the collection was modified by another request at the same time. "
+        "Please try again."
+    )
+    default_http_status_code = 409
+
+
+class CollectionMetadataSession:
+    """
+    Unit of work for a collection's metadata: the metadata is loaded once, changes are
+    tracked by key and saved in a single write when the session is flushed.
+
+    Concurrency control is optimistic, with "updated_at" as the version: if it changed
+    since the metadata was loaded, the changes are merged into the latest metadata,
+    unless another writer changed one of the same keys, in which case flushing raises
+    MetadataConflictError. NOTE: Chroma has no compare-and-swap, so a write landing
+    between our re-fetch and our write can still be lost.
+    """
+
+    def __init__(self, vectorstore: ChromaDDG) -> None:
+        self.vectorstore = vectorstore
+        self._loaded_metadata: dict[str, Any] | None = None
+        self._changes: dict[str, Any] = {}
+        self._is_dirty = False  # even with no changed keys, "updated_at" must be set
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._is_dirty
+
+    def get_metadata(self) -> dict[str, Any]:
+        """Get (a copy of) the metadata, including the changes that are not saved yet."""
+        if self._loaded_metadata is None:
+            self._loaded_metadata = self.vectorstore.fetch_collection_metadata() or {}
+        return self._loaded_metadata | self._changes
+
+    def update(self, metadata: dict[str, Any]) -> None:
+        """
+        Record the keys of the given metadata whose values have changed (a value of
+        None means the key should be removed).
+        """
+        self._is_dirty = True
+        current_metadata = self.get_metadata()
+        for key, value in metadata.items():
+            if key != "updated_at" and current_metadata.get(key) != value:
+                self._changes[key] = value
+
+    def flush(self, timestamp: str) -> None:
+        """
+        Save the changes (if any) in one write, setting "updated_at" to the given
+        timestamp, and start over (the metadata will be reloaded when next needed).
+        """
+        if self._is_dirty:
+            loaded_metadata = self._loaded_metadata
+            latest_metadata = self.vectorstore.fetch_collection_metadata(False) or {}
+            if latest_metadata.get("updated_at") != loaded_metadata.get("updated_at"):
+                conflicting_keys = [
+                    k
+                    for k in self._changes
+                    if latest_metadata.get(k) != loaded_metadata.get(k)
+                ]
+                if conflicting_keys:
+                    self._reset()
+                    raise MetadataConflictError(
+                        f"Metadata keys {conflicting_keys} of collection "
+                        f"{self.vectorstore.name} were modified concurrently"
+                    )
+            new_metadata = latest_metadata | self._changes | {"updated_at": timestamp}
+            self.vectorstore.save_collection_metadata(
+                {k: v for k, v in new_metadata.items() if v is not None}
+            )
+        self._reset()
+
+    def _reset(self) -> None:
+        self._loaded_metadata, self._changes, self._is_dirty = None, {}, False
+
+
+def get_where_document_kwarg(kwargs: dict[str, Any]) -> dict[str, Any]:
+    """
+    Determine if the passed kwargs contain a 'where_document' parameter. If so, return
+    a dict with just that parameter (to pass to the __query_collection method).
+    """
+    try:
+        return {"where_document": kwargs["where_document"]}
+    except KeyError:
+        return {}
+
+
+def get_docs_and_scores_for_each_query(
+    results: dict[str, Any]
+) -> list[list[tuple[Document, float]]]:
+    """
+    Convert the results of a chromadb query with several query texts or embeddings
+    to a list of (doc, distance) pairs for each query.
+    """
+    return [
+        [
+            (Document(page_content=text, metadata=metadata or {}), distance)
+            for text, metadata, distance in zip(texts, metadatas, distances)
+        ]
+        for texts, metadatas, distances in zip(
+            results["documents"], results["metadatas"], results["distances"]
+        )
+    ]
 
 
 def exists_collection(
@@ -182,21 +562,26 @@ def exists_collection(
     client: ClientAPI,
 ) -> bool:
     """
-    Check if a collection exists.
+    Check if a collection exists (using the collection cache, see
+    get_collection_cached).
     """
     # NOTE: Alternative: return collection_name in {x.name for x in client.list_collections()}
     try:
-        client.get_collection(collection_name)
+        get_collection_cached(client, collection_name)
         return True
-    except Exception as e: # Exception: {ValueError: "Collection 'test' does not exist"}
-        if "does not exist" in str(e):
-            return False  # collection does not exist
-        raise e
+    except CollectionDoesNotExist:
+        return False
 
 
-def initialize_client(use_chroma_via_http: bool = USE_CHROMA_VIA_HTTP) -> ClientAPI:
+def initialize_client(
+    use_chroma_via_http: bool = USE_CHROMA_VIA_HTTP,
+    persist_directory: str | None = None,
+) -> ClientAPI:
     """
-    Initialize a chroma client.
+    Initialize a chroma client. If not using Chroma via HTTP, the database is in
+    persist_directory (by default, VECTORDB_DIR).
+
+    NOTE: Normally, a client should be obtained from chroma_client_pool instead.
     """
     if use_chroma_via_http:
         return HttpClient(
@@ -209,19 +594,126 @@ def initialize_client(use_chroma_via_http: bool = USE_CHROMA_VIA_HTTP) -> Client
                 anonymized_telemetry=False,
             ),
         )
-    if not isinstance(VECTORDB_DIR, str) or not os.path.isdir(VECTORDB_DIR):
+    persist_directory = persist_directory or VECTORDB_DIR
+    if not isinstance(persist_directory, str) or not os.path.isdir(persist_directory):
         # NOTE: interestingly, isdir(None) returns True, hence the additional check
-        raise ValueError(f"Invalid chromadb path: {VECTORDB_DIR}")
+        raise ValueError(f"Invalid chromadb path: {persist_directory}")
 
-    return PersistentClient(VECTORDB_DIR, settings=Settings(anonymized_telemetry=False))
+    return PersistentClient(
+        persist_directory, settings=Settings(anonymized_telemetry=False)
+    )
     # return Client(Settings(chroma_db_impl="duckdb+parquet", persist_directory=path))
 
 
+class ChromaClientPool:
+    """
+    Process-wide pool of chroma clients, one per configuration (the server's host, port
+    and credentials if using Chroma via HTTP, or the database directory otherwise).
+    The clients are shared across requests and threads; an HTTP client keeps its
+    connections to the server alive between requests.
+
+    A client that hasn't been used for health_check_interval seconds is checked with a
+    heartbeat before being handed out and is replaced with a new one if that fails. The
+    check (and any reconnection) is done without holding the pool's lock, under a lock
+    for just that configuration, so a slow heartbeat only delays requests that need the
+    same client.
+    """
+
+    def __init__(
+        self, health_check_interval: float = CHROMA_CLIENT_HEALTH_CHECK_INTERVAL
+    ):
+        self.health_check_interval = health_check_interval
+        self._clients: dict[tuple, ClientAPI] = {}
+        self._last_used_at: dict[tuple, float] = {}
+        self._config_locks: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_config_key(
+        use_chroma_via_http: bool, persist_directory: str | None
+    ) -> tuple:
+        """Get the key identifying a client configuration."""
+        if use_chroma_via_http:
+            return (
+                "http",
+                CHROMA_SERVER_HOST,
+                CHROMA_SERVER_HTTP_PORT,
+                CHROMA_SERVER_AUTHN_CREDENTIALS,
+            )
+        return ("persistent", os.path.abspath(persist_directory or VECTORDB_DIR))
+
+    def _get_fresh_client(self, key: tuple) -> ClientAPI | None:
+        """
+        Get the pooled client for the given configuration if it was used recently
+        enough not to need a health check (marking it as used), otherwise None.
+        Must be called with the pool's lock held.
+        """
+        client = self._clients.get(key)
+        now = time.monotonic()
+        if client is None or now - self._last_used_at[key] > self.health_check_interval:
+            return None
+        self._last_used_at[key] = now
+        return client
+
+    def get_client(
+        self,
+        use_chroma_via_http: bool = USE_CHROMA_VIA_HTTP,
+        persist_directory: str | None = None,
+    ) -> ClientAPI:
+        """
+        Get the shared client for the given configuration, creating it (or recreating
+        it, if it failed its health check) if needed.
+        """
+        key = self.get_config_key(use_chroma_via_http, persist_directory)
+        with self._lock:
+            if (client := self._get_fresh_client(key)) is not None:
+                return client
+            config_lock = self._config_locks.setdefault(key, threading.Lock())
+
+        with config_lock:
+            # Another thread may have checked or replaced the client in the meantime
+            with self._lock:
+                if (client := self._get_fresh_client(key)) is not None:
+                    return client
+                client = self._clients.get(key)
+
+            if client is not None and not self.is_healthy(client):
+                logger.warning(f"Chroma client for {key[:2]} is unhealthy, reconnecting")
+                client = None
+            if client is None:
+                client = initialize_client(use_chroma_via_http, persist_directory)
+
+            with self._lock:
+                self._clients[key] = client
+                self._last_used_at[key] = time.monotonic()
+            return client
+
+    @staticmethod
+    def is_healthy(client: ClientAPI) -> bool:
+        """Check whether a client can reach its database."""
+        try:
+            client.heartbeat()
+            return True
+        except Exception as e:
+            logger.warning(f"Chroma heartbeat failed: {e}")
+            return False
+
+    def clear(self) -> None:
+        """Remove all clients from the pool (new ones are created when needed)."""
+        with self._lock:
+            self._clients.clear()
+            self._last_used_at.clear()
+
+
+chroma_client_pool = ChromaClientPool()
+
+
 def ensure_chroma_client(client: ClientAPI | None = None) -> ClientAPI:
     """
-    Ensure that a chroma client is initialized and return it.
+    Ensure that a chroma client is initialized and return it (if no client is passed,
+    the shared client from chroma_client_pool is returned).
     """
-    return client or initialize_client()
+    return client or chroma_client_pool.get_client()
 
 
 def get_vectorstore_using_openai_api_key(
@@ -1,15 +1,47 @@
-from typing import Any, ClassVar
+import asyncio
+from typing import Any, ClassVar, Sequence
 
 from chromadb.api.types import Where, WhereDocument
 from langchain_core.documents import Document
 from pydantic import Field
 
+from utils.algo import reciprocal_rank_fusion, remove_duplicates_keep_order
+from utils.async_utils import execute_func_map_in_threads
+from utils.cache_utils import LRUCache
 from utils.helpers import DELIMITER, lin_interpolate
-from utils.lang_utils import expand_chunks
-from utils.prepare import CONTEXT_LENGTH, EMBEDDINGS_MODEL_NAME
+from utils.lang_utils import expand_chunks, get_chunk_fetcher_from_parents
+from utils.prepare import (
+    CONTEXT_LENGTH,
+    EMBEDDINGS_MODEL_NAME,
+    PARENT_DOC_CACHE_MAX_BYTES,
+    get_logger,
+)
 from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
 from langchain_core.language_models import BaseLanguageModel
-from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
+
+logger = get_logger()
+
+
+def get_size_of_cached_parent(value: tuple[str, Document | dict[int, Document]]) -> int:
+    """Approximate size in bytes of a cached parent doc or of its cached chunks."""
+    _, parent_or_chunks = value
+    docs = (
+        parent_or_chunks.values()
+        if isinstance(parent_or_chunks, dict)
+        else [parent_or_chunks]
+    )
+    return sum(len(doc.page_content) + 200 for doc in docs)  # 200 for metadata etc.
+
+
+# Cache of parent docs (older collections) or of the fetched chunks of parent docs.
+# Keys are (collection id, parent id), values are (collection version, parent or chunks)
+parent_cache = LRUCache(
+    max_size=PARENT_DOC_CACHE_MAX_BYTES,
+    get_size=get_size_of_cached_parent,
+    name="parent docs",
+)
 
 
 class ChromaDDGRetriever(VectorStoreRetriever):
@@ -21,6 +53,12 @@ class ChromaDDGRetriever(VectorStoreRetriever):
     `get_relevant_documents` method. These parameters are used to filter the
     documents by their metadata and contained text, respectively.
 
+    It also supports query fusion: if `extra_queries` (other versions of the query,
+    e.g. the raw user query when the query is the standalone query generated from it)
+    are passed to `get_relevant_documents`, all versions are embedded in one batch
+    and searched for in a single chromadb request, and the results are fused with
+    reciprocal rank fusion (see _fuse) before being pared down and expanded.
+
     NOTE: even though the underlying vectorstore is not explicitly required to
     be a ChromaDDG, it must be a vectorstore that supports the `where` and
     `where_document` parameters in its `similarity_search`-type methods.
@@ -47,8 +85,7 @@ class ChromaDDGRetriever(VectorStoreRetriever):
     max_total_tokens: int = int(CONTEXT_LENGTH * 0.5)  # consistent with ChatWithDocsChain
     max_average_tokens_per_chunk: int = int(max_total_tokens / k_max)
 
-    # get_relevant_documents() must return only docs, but we'll save scores here
-    similarities: list = Field(default_factory=list)
+    rrf_k: int = 60  # constant in reciprocal rank fusion (higher = flatter weights)
 
     allowed_search_types: ClassVar[tuple[str]] = (
         "similarity",
@@ -57,6 +94,36 @@ class ChromaDDGRetriever(VectorStoreRetriever):
         "similarity_ddg",
     )
 
+    def _get_search_kwargs(
+        self,
+        filter: Where | None,
+        where_document: WhereDocument | None,
+        kwargs: dict[str, Any],
+    ) -> dict[str, Any]:
+        # Combine global search kwargs with per-query search params passed here
+        search_kwargs = self.search_kwargs | kwargs
+        if filter is not None:
+            search_kwargs["filter"] = filter
+        if where_document is not None:
+            search_kwargs["where_document"] = where_document
+
+        if self.search_type == "similarity_ddg":
+            assert str(type(self.vectorstore)).endswith("ChromaDDG'>"), "Bad vectorstore"
+
+            # First, get more docs than we need, then we'll pare them down
+            # NOTE this is because apparently Chroma can miss even the most relevant doc
+            # if k (num docs to return) is not high (e.g. "Who is Big Keetie?", k = 10)
+            # k_overshot = max(k := search_kwargs["k"], self.k_overshot)
+            # score_threshold_overshot = min(
+            #     score_threshold := search_kwargs["score_threshold"],
+            #     self.score_threshold_overshot,
+            # )  # usually simply 0
+            search_kwargs |= {
+                "k": self.k_overshot,
+                "score_threshold": self.score_threshold_overshot,
+            }
+        return search_kwargs
+
     def _get_relevant_documents(
         self,
         query: str,
@@ -64,14 +131,10 @@ class ChromaDDGRetriever(VectorStoreRetriever):
         run_manager: CallbackManagerForRetrieverRun,
         filter: Where | None = None,  # For metadata (Langchain naming convention)
         where_document: WhereDocument | None = None,  # Filter by text in document
+        extra_queries: list[str] | None = None,  # Other versions of the query to fuse
         **kwargs: Any,  # For additional search params
     ) -> list[Document]:
-        # Combine global search kwargs with per-query search params passed here
-        search_kwargs = self.search_kwargs | kwargs
-        if filter is not None:
-            search_kwargs["filter"] = filter
-        if where_document is not None:
-            search_kwargs["where_document"] = where_document
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
 
         # Perform search depending on search type
         if self.search_type == "similarity":
@@ -83,30 +146,117 @@ class ChromaDDGRetriever(VectorStoreRetriever):
 
         # Main search method used by DocDocGo
         assert self.search_type == "similarity_ddg", "Invalid search type"
-        assert str(type(self.vectorstore)).endswith("ChromaDDG'>"), "Bad vectorstore"
-
-        # First, get more docs than we need, then we'll pare them down
-        # NOTE this is because apparently Chroma can miss even the most relevant doc
-        # if k (num docs to return) is not high (e.g. "Who is Big Keetie?", k = 10)
-        # k_overshot = max(k := search_kwargs["k"], self.k_overshot)
-        # score_threshold_overshot = min(
-        #     score_threshold := search_kwargs["score_threshold"],
-        #     self.score_threshold_overshot,
-        # )  # usually simply 0
-
-        docs_and_similarities_overshot = (
-            self.vectorstore.similarity_search_with_relevance_scores(
-                query,
-                **(
-                    search_kwargs
-                    | {
-                        "k": self.k_overshot,
-                        "score_threshold": self.score_threshold_overshot,
-                    }
-                ),
+        queries = remove_duplicates_keep_order([query] + (extra_queries or []))
+        if len(queries) == 1:
+            docs_and_similarities_overshot = (
+                self.vectorstore.similarity_search_with_relevance_scores(
+                    query, **search_kwargs
+                )
             )
-        )
+        else:
+            results = self.vectorstore.similarity_search_many_with_score(
+                queries, **search_kwargs
+            )
+            docs_and_similarities_overshot = self._fuse(
+                self._to_relevance_scores(results), **search_kwargs
+            )
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+        return self._expand(chunks)
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        filter: Where | None = None,  # For metadata (Langchain naming convention)
+        where_document: WhereDocument | None = None,  # Filter by text in document
+        extra_queries: list[str] | None = None,  # Other versions of the query to fuse
+        **kwargs: Any,  # For additional search params
+    ) -> list[Document]:
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
+
+        # Perform search depending on search type
+        if self.search_type == "similarity":
+            return await self.vectorstore.asimilarity_search(query, **search_kwargs)
+        elif self.search_type == "mmr":
+            return await self.vectorstore.amax_marginal_relevance_search(
+                query, **search_kwargs
+            )
+
+        # Main search method used by DocDocGo (same steps as in the sync version)
+        assert self.search_type == "similarity_ddg", "Invalid search type"
+        queries = remove_duplicates_keep_order([query] + (extra_queries or []))
+        if len(queries) == 1:
+            docs_and_similarities_overshot = (
+                await self.vectorstore.asimilarity_search_with_relevance_scores(
+                    query, **search_kwargs
+                )
+            )
+        else:
+            results = await self.vectorstore.asimilarity_search_many_with_score(
+                queries, **search_kwargs
+            )
+            docs_and_similarities_overshot = self._fuse(
+                self._to_relevance_scores(results), **search_kwargs
+            )
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+
+        # Fetching neighboring chunks or parents is done with sync chromadb calls
+        return await run_in_executor(None, self._expand, chunks)
+
+    def _to_relevance_scores(
+        self, results: list[list[tuple[Document, float]]]
+    ) -> list[list[tuple[Document, float]]]:
+        """Convert the distances in the results for each query to relevance scores."""
+        relevance_score_fn = self.vectorstore._select_relevance_score_fn()
+        return [
+            [(doc, relevance_score_fn(score)) for doc, score in docs_and_scores]
+            for docs_and_scores in results
+        ]
+
+    def _fuse(
+        self,
+        results: list[list[tuple[Document, float]]],
+        k: int,
+        score_threshold: float,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        Fuse the docs and relevance scores found for each version of the query (best
+        first) into one list of k docs, using reciprocal rank fusion. Docs with the
+        same text are treated as one doc, and each doc is given its highest relevance
+        score for any of the queries, so that it can be pared down as usual.
+        """
+        best_doc_and_similarity_by_text: dict[str, tuple[Document, float]] = {}
+        rankings = []
+        for docs_and_similarities in results:
+            ranking = []
+            for doc, sim in docs_and_similarities:
+                if sim < score_threshold:
+                    break
+                text = doc.page_content
+                best = best_doc_and_similarity_by_text.get(text)
+                if best is None or sim > best[1]:
+                    best_doc_and_similarity_by_text[text] = (doc, sim)
+                ranking.append(text)
+            rankings.append(remove_duplicates_keep_order(ranking))
 
+        fused_texts_and_scores = reciprocal_rank_fusion(rankings, self.rrf_k)[:k]
+        if self.verbose:
+            print(f"Fused results for {len(results)} queries:")
+            for text, score in fused_texts_and_scores:
+                print(f"[RRF SCORE: {score:.4f}] {repr(text[:60])}")
+        return [best_doc_and_similarity_by_text[x] for x, _ in fused_texts_and_scores]
+
+    def _pare_down(
+        self, docs_and_similarities_overshot: list[tuple[Document, float]]
+    ) -> tuple[list[Document], list[float]]:
+        """
+        Pare down the initially retrieved docs based on their similarity scores.
+        Return the kept docs and their similarity scores. (The scores are returned
+        rather than saved on the retriever, since the same retriever can be used by
+        several requests at once.)
+        """
         if self.verbose:
             for doc, sim in docs_and_similarities_overshot:
                 print(f"[SIMILARITY: {sim:.2f}] {repr(doc.page_content[:60])}")
@@ -114,7 +264,7 @@ class ChromaDDGRetriever(VectorStoreRetriever):
 
         # Now, pare down the results
         chunks: list[Document] = []
-        self.similarities: list[float] = []
+        similarities: list[float] = []
         for k, (doc, sim) in enumerate(docs_and_similarities_overshot, start=1):
             # If we've already found enough docs, stop
             if k > self.k_max:
@@ -135,16 +285,21 @@ class ChromaDDGRetriever(VectorStoreRetriever):
 
             # Otherwise, add the doc to the list and keep going
             chunks.append(doc)
-            self.similarities.append(sim)
+            similarities.append(sim)
 
         if self.verbose:
             print(f"After paring down: {len(chunks)} docs.")
             if chunks:
                 print(
-                    f"Similarities from {self.similarities[-1]:.2f} to {self.similarities[0]:.2f}"
+                    f"Similarities from {similarities[-1]:.2f} to {similarities[0]:.2f}"
                 )
             print(DELIMITER)
+        return chunks, similarities
 
+    def _expand(self, chunks: list[Document]) -> list[Document]:
+        """
+        Expand the pared down chunks by adding neighboring chunks from their parents.
+        """
         # Get the parent documents for the chunks
         try:
             print("METADATAS:")
@@ -154,29 +309,288 @@ class ChromaDDGRetriever(VectorStoreRetriever):
         except KeyError:
             # If it's an older collection, without parent docs, just return the chunks
             return chunks
-        unique_parent_ids = list(set(parent_ids))
-        rsp = self.vectorstore.collection.get(unique_parent_ids)
 
-        parent_docs_by_id = {
-            id: Document(page_content=text, metadata=metadata)
-            for id, text, metadata in zip(
-                rsp["ids"], rsp["documents"], rsp["metadatas"]
+        if all("chunk_idx" in chunk.metadata for chunk in chunks):
+            # Chunks know their position, so we can fetch just the neighboring chunks
+            fetch_chunks = self.get_chunks_by_position
+        else:
+            # Older collection, without chunk positions - fetch and split the parents
+            chunks, fetch_chunks = get_chunk_fetcher_from_parents(
+                chunks, self.get_parent_docs(list(set(parent_ids)))
             )
-        }
 
-        # Expand chunks using the parent docs
+        # Expand chunks using their neighboring chunks
         max_total_tokens = min(
             self.max_total_tokens, self.max_average_tokens_per_chunk * len(chunks)
         )
         expanded_chunks = expand_chunks(
             chunks,
-            parent_docs_by_id,
+            fetch_chunks,
             max_total_tokens,
             llm_for_token_counting=self.llm_for_token_counting,
         )
         return expanded_chunks
 
+    def _get_parent_cache_key_and_version(self, parent_id: str) -> tuple[tuple, str]:
+        # Parents and chunks are never modified in place, but we still invalidate
+        # cached items when the collection is updated, to be safe
+        coll_metadata = self.vectorstore.get_cached_collection_metadata() or {}
+        return (
+            (str(self.vectorstore.collection.id), parent_id),
+            coll_metadata.get("updated_at", ""),
+        )
+
+    def get_parent_docs(self, parent_ids: list[str]) -> dict[str, Document]:
+        """
+        Get parent documents by their ids, using the parent cache when possible.
+        """
+        parent_docs_by_id = {}
+        for parent_id in parent_ids:
+            key, version = self._get_parent_cache_key_and_version(parent_id)
+            cached_version, parent_doc = parent_cache.get(key, (None, None))
+            if cached_version == version and isinstance(parent_doc, Document):
+                parent_docs_by_id[parent_id] = parent_doc
+
+        if ids_to_fetch := [x for x in parent_ids if x not in parent_docs_by_id]:
+            rsp = self.vectorstore.collection.get(ids_to_fetch)
+            for id, text, metadata in zip(
+                rsp["ids"], rsp["documents"], rsp["metadatas"]
+            ):
+                parent_doc = Document(page_content=text, metadata=metadata)
+                parent_docs_by_id[id] = parent_doc
+                key, version = self._get_parent_cache_key_and_version(id)
+                parent_cache.put(key, (version, parent_doc))
+        return parent_docs_by_id
+
+    def get_chunks_by_position(
+        self, chunk_ranges: list[tuple[str, int, int]]
+    ) -> list[Document]:
+        """
+        Get chunks by their position in their parent documents (see the method of
+        the same name in ChromaDDG), using the parent cache when possible.
+        """
+        # Determine which chunks we already have and which ones we need to fetch
+        cached_chunks_by_parent_id: dict[str, dict[int, Document]] = {}
+        ranges_to_fetch = []
+        for parent_id, start_chunk_idx, end_chunk_idx in chunk_ranges:
+            if parent_id not in cached_chunks_by_parent_id:
+                key, version = self._get_parent_cache_key_and_version(parent_id)
+                cached_version, chunks = parent_cache.get(key, (None, None))
+                cached_chunks_by_parent_id[parent_id] = (
+                    chunks
+                    if cached_version == version and isinstance(chunks, dict)
+                    else {}
+                )
+            cached_chunks = cached_chunks_by_parent_id[parent_id]
+
+            # Fetch each run of consecutive missing chunks as a separate range
+            missing_start_idx = None
+            for i in range(start_chunk_idx, end_chunk_idx + 1):
+                if i < end_chunk_idx and i not in cached_chunks:
+                    if missing_start_idx is None:
+                        missing_start_idx = i
+                elif missing_start_idx is not None:
+                    ranges_to_fetch.append((parent_id, missing_start_idx, i))
+                    missing_start_idx = None
+
+        # Fetch the missing chunks and update the cache (without modifying cached dicts)
+        if ranges_to_fetch:
+            fetched_chunks_by_parent_id: dict[str, dict[int, Document]] = {}
+            for chunk in self.vectorstore.get_chunks_by_position(ranges_to_fetch):
+                fetched_chunks_by_parent_id.setdefault(
+                    chunk.metadata["parent_id"], {}
+                )[chunk.metadata["chunk_idx"]] = chunk
+            for parent_id, fetched_chunks in fetched_chunks_by_parent_id.items():
+                chunks = cached_chunks_by_parent_id[parent_id] | fetched_chunks
+                cached_chunks_by_parent_id[parent_id] = chunks
+                key, version = self._get_parent_cache_key_and_version(parent_id)
+                parent_cache.put(key, (version, chunks))
+
+        logger.debug(f"Parent cache stats: {parent_cache.get_stats()}")
+        return [
+            chunks[i]
+            for parent_id, start_chunk_idx, end_chunk_idx in chunk_ranges
+            for i in range(start_chunk_idx, end_chunk_idx)
+            if i in (chunks := cached_chunks_by_parent_id[parent_id])
+        ]
+
+
+class FederatedChromaDDGRetriever(ChromaDDGRetriever):
+    """
+    A ChromaDDGRetriever that searches several collections at once: the vectorstore
+    and the extra_vectorstores (all ChromaDDG, with the same embeddings model).
+
+    The query is embedded once and the collections are queried concurrently. Each
+    collection's distances are converted to relevance scores with the collection's own
+    relevance function (which depends on its distance metric), so that the results can
+    be merged into one list, which is then pared down as in ChromaDDGRetriever. The
+    kept chunks are expanded within their collections, each collection getting a share
+    of the token budget proportional to its number of chunks.
+
+    With query fusion (see ChromaDDGRetriever), each collection is queried for all
+    versions of the query in one request, the results are merged for each version and
+    the merged results are then fused.
+
+    Only the "similarity_ddg" search type is supported.
+    """
+
+    extra_vectorstores: list[VectorStore] = Field(default_factory=list)
+
+    @property
+    def vectorstores(self) -> list[VectorStore]:
+        return [self.vectorstore] + self.extra_vectorstores
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        filter: Where | None = None,  # For metadata (Langchain naming convention)
+        where_document: WhereDocument | None = None,  # Filter by text in document
+        extra_queries: list[str] | None = None,  # Other versions of the query to fuse
+        **kwargs: Any,  # For additional search params
+    ) -> list[Document]:
+        assert self.search_type == "similarity_ddg", "Invalid search type"
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
+        queries = remove_duplicates_keep_order([query] + (extra_queries or []))
+
+        # Embed the queries once (in one batch), then query all collections
+        # concurrently, each with a single request for all queries
+        if (embeddings := self.vectorstore.embeddings) is None:
+            search = lambda vs: vs.similarity_search_many_with_score(  # noqa
+                queries, **search_kwargs
+            )
+        else:
+            query_embeddings = embeddings.embed_documents(queries)
+            search = lambda vs: vs.similarity_search_by_vectors_with_score(  # noqa
+                query_embeddings, **search_kwargs
+            )
+        results = execute_func_map_in_threads(search, self.vectorstores)
+
+        docs_and_similarities_overshot = self._merge_and_fuse(results, **search_kwargs)
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+        return self._expand_federated(chunks)
+
     async def _aget_relevant_documents(
-        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        filter: Where | None = None,  # For metadata (Langchain naming convention)
+        where_document: WhereDocument | None = None,  # Filter by text in document
+        extra_queries: list[str] | None = None,  # Other versions of the query to fuse
+        **kwargs: Any,  # For additional search params
     ) -> list[Document]:
-        raise NotImplementedError("Asynchronous retrieval not yet supported.")
+        assert self.search_type == "similarity_ddg", "Invalid search type"
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
+        queries = remove_duplicates_keep_order([query] + (extra_queries or []))
+
+        # Same steps as in the sync version (chromadb calls are run in an executor)
+        if (embeddings := self.vectorstore.embeddings) is None:
+            results = await asyncio.gather(
+                *(
+                    vs.asimilarity_search_many_with_score(queries, **search_kwargs)
+                    for vs in self.vectorstores
+                )
+            )
+        else:
+            query_embeddings = await embeddings.aembed_documents(queries)
+            results = await asyncio.gather(
+                *(
+                    run_in_executor(
+                        None,
+                        vs.similarity_search_by_vectors_with_score,
+                        query_embeddings,
+                        **search_kwargs,
+                    )
+                    for vs in self.vectorstores
+                )
+            )
+
+        docs_and_similarities_overshot = self._merge_and_fuse(results, **search_kwargs)
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+        return await run_in_executor(None, self._expand_federated, chunks)
+
+    def _merge_and_fuse(
+        self,
+        results: list[list[list[tuple[Document, float]]]],
+        k: int,
+        score_threshold: float,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        Merge the results from each collection for each version of the query (see
+        _merge), then fuse the merged results for the different versions (see _fuse).
+        """
+        merged_results = [
+            self._merge(results_for_query, k, score_threshold)
+            for results_for_query in zip(*results)
+        ]
+        if len(merged_results) == 1:
+            return merged_results[0]
+        return self._fuse(merged_results, k, score_threshold)
+
+    def _merge(
+        self,
+        results: Sequence[list[tuple[Document, float]]],
+        k: int,
+        score_threshold: float,
+    ) -> list[tuple[Document, float]]:
+        """
+        Merge the docs and distances from each collection into one list of the k docs
+        with the highest relevance scores (skipping docs with the same text as a more
+        relevant one). The name of each doc's collection is added to its metadata
+        (under "collection"), so that the doc can be expanded within that collection.
+        """
+        docs_and_similarities = []
+        for vectorstore, docs_and_scores in zip(self.vectorstores, results):
+            relevance_score_fn = vectorstore._select_relevance_score_fn()
+            for doc, score in docs_and_scores:
+                doc = Document(
+                    page_content=doc.page_content,
+                    metadata=doc.metadata | {"collection": vectorstore.name},
+                )
+                docs_and_similarities.append((doc, relevance_score_fn(score)))
+        docs_and_similarities.sort(key=lambda x: x[1], reverse=True)
+
+        merged = []
+        seen_texts = set()
+        for doc, sim in docs_and_similarities:
+            if len(merged) >= k or sim < score_threshold:
+                break
+            if doc.page_content not in seen_texts:
+                seen_texts.add(doc.page_content)
+                merged.append((doc, sim))
+        return merged
+
+    def _expand_federated(self, chunks: list[Document]) -> list[Document]:
+        """
+        Expand the pared down chunks within their collections (see _expand), found by
+        the "collection" metadata set in _merge. The collections' chunks are returned
+        in the order of their most relevant chunks.
+        """
+        vectorstore_by_name = {vs.name: vs for vs in self.vectorstores}
+        chunks_by_collection: dict[str, list[Document]] = {}
+        for chunk in chunks:
+            chunks_by_collection.setdefault(chunk.metadata["collection"], []).append(
+                chunk
+            )
+
+        def expand(collection_name: str) -> list[Document]:
+            vectorstore_chunks = chunks_by_collection[collection_name]
+            retriever = ChromaDDGRetriever(
+                vectorstore=vectorstore_by_name[collection_name],
+                search_type=self.search_type,
+                llm_for_token_counting=self.llm_for_token_counting,
+                verbose=self.verbose,
+                max_total_tokens=(
+                    self.max_total_tokens * len(vectorstore_chunks) // len(chunks)
+                ),
+                max_average_tokens_per_chunk=self.max_average_tokens_per_chunk,
+            )
+            return retriever._expand(vectorstore_chunks)
+
+        expanded_chunks_lists = execute_func_map_in_threads(
+            expand, list(chunks_by_collection)
+        )
+        return [chunk for x in expanded_chunks_lists for chunk in x]
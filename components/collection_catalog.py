@@ -0,0 +1,302 @@
+import bisect
+import heapq
+import threading
+import time
+from datetime import datetime, timezone
+from itertools import islice, takewhile
+from typing import Any, Iterable, NamedTuple
+
+from chromadb import ClientAPI
+
+from utils.cache_utils import get_attached_cache
+from utils.helpers import (
+    PRIVATE_COLLECTION_FULL_PREFIX_LENGTH,
+    PRIVATE_COLLECTION_PREFIX,
+    parse_timestamp,
+)
+from utils.prepare import (
+    COLLECTION_CATALOG_REFRESH_INTERVAL,
+    DEFAULT_COLLECTION_NAME,
+    RESEARCH_STATE_COLLECTION_NAME,
+    get_logger,
+)
+
+logger = get_logger()
+
+# Used as the last update time of collections that don't have one
+BASE_DATETIME = datetime(2024, 5, 25, 0, 0, 0, tzinfo=timezone.utc)
+
+# (is not the default collection, -last update timestamp, full name)
+SortKey = tuple[bool, float, str]
+
+
+class CatalogEntry(NamedTuple):
+    """A collection in a listing of collections, with its index in the listing."""
+
+    idx: int
+    name: str
+    name_as_shown: str
+    updated_at: str | None
+
+
+def get_owner_prefix(collection_name: str) -> str | None:
+    """
+    Get the prefix of a private collection's name that identifies its owner (e.g.
+    "u-abcdef"), or None if the collection is public.
+    """
+    if collection_name.startswith(PRIVATE_COLLECTION_PREFIX):
+        return collection_name[:PRIVATE_COLLECTION_FULL_PREFIX_LENGTH]
+
+
+def get_name_as_shown(collection_name: str, owner_prefix: str | None) -> str:
+    """
+    Get the name of a collection as shown to the user with the given owner prefix
+    (without the prefix if the collection is theirs).
+    """
+    # Old collections: u-abcdef<name>, new collections: u-abcdef-<name>
+    if owner_prefix and collection_name.startswith(owner_prefix):
+        return collection_name[len(owner_prefix) :].lstrip("-")
+    return collection_name
+
+
+def get_sort_key(collection_name: str, updated_at: str | None) -> SortKey:
+    """
+    Get the key to sort collections by: the default collection first, then the most
+    recently updated ones, then by name.
+    """
+    try:
+        timestamp = parse_timestamp(updated_at).timestamp()
+    except (TypeError, ValueError):
+        timestamp = BASE_DATETIME.timestamp()
+    return (collection_name != DEFAULT_COLLECTION_NAME, -timestamp, collection_name)
+
+
+def remove_from_sorted_list(sorted_list: list, item: Any) -> None:
+    idx = bisect.bisect_left(sorted_list, item)
+    if idx < len(sorted_list) and sorted_list[idx] == item:
+        del sorted_list[idx]
+
+
+class CollectionCatalog:
+    """
+    In-memory catalog of the collections in a Chroma database, so that listing or
+    searching a user's collections doesn't require fetching and sorting all of them.
+    Collections are indexed by owner prefix (None for public collections), both in the
+    order they are listed in (see get_sort_key) and by name as shown to the owner.
+
+    A user's listing consists of the collections with their owner prefix plus some
+    extra collections they have access to (e.g. the default collection or collections
+    shared with them), given by name.
+
+    The catalog is loaded with list_collections() on first use and updated by ChromaDDG
+    when this process creates, updates, renames or deletes a collection. Changes made by
+    other processes are picked up when it's reloaded, every refresh_interval seconds.
+    """
+
+    def __init__(
+        self,
+        client: ClientAPI,
+        refresh_interval: float = COLLECTION_CATALOG_REFRESH_INTERVAL,
+    ):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loaded_at: float | None = None
+
+        self._updated_at_by_name: dict[str, str | None] = {}
+        self._sort_keys_by_owner: dict[str | None, list[SortKey]] = {}
+        # Sorted (name as shown to the owner, full name) pairs, for prefix search
+        self._names_by_owner: dict[str | None, list[tuple[str, str]]] = {}
+
+    def _ensure_loaded(self) -> None:
+        if (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.refresh_interval
+        ):
+            return
+
+        t_start = time.monotonic()
+        self._updated_at_by_name = {
+            c.name: (c.metadata or {}).get("updated_at")
+            for c in self.client.list_collections()
+            if c.name != RESEARCH_STATE_COLLECTION_NAME
+        }
+        self._sort_keys_by_owner = {}
+        self._names_by_owner = {}
+        for name, updated_at in self._updated_at_by_name.items():
+            owner_prefix = get_owner_prefix(name)
+            self._sort_keys_by_owner.setdefault(owner_prefix, []).append(
+                get_sort_key(name, updated_at)
+            )
+            self._names_by_owner.setdefault(owner_prefix, []).append(
+                (get_name_as_shown(name, owner_prefix), name)
+            )
+        for sorted_list in self._sort_keys_by_owner.values():
+            sorted_list.sort()
+        for sorted_list in self._names_by_owner.values():
+            sorted_list.sort()
+
+        self._loaded_at = time.monotonic()
+        logger.info(
+            f"Loaded catalog of {len(self._updated_at_by_name)} collections "
+            f"in {self._loaded_at - t_start:.2f}s"
+        )
+
+    def _add(self, name: str, updated_at: str | None) -> None:
+        self._updated_at_by_name[name] = updated_at
+        owner_prefix = get_owner_prefix(name)
+        bisect.insort(
+            self._sort_keys_by_owner.setdefault(owner_prefix, []),
+            get_sort_key(name, updated_at),
+        )
+        bisect.insort(
+            self._names_by_owner.setdefault(owner_prefix, []),
+            (get_name_as_shown(name, owner_prefix), name),
+        )
+
+    def _remove(self, name: str) -> None:
+        if name not in self._updated_at_by_name:
+            return
+        updated_at = self._updated_at_by_name.pop(name)
+        owner_prefix = get_owner_prefix(name)
+        remove_from_sorted_list(
+            self._sort_keys_by_owner[owner_prefix], get_sort_key(name, updated_at)
+        )
+        remove_from_sorted_list(
+            self._names_by_owner[owner_prefix],
+            (get_name_as_shown(name, owner_prefix), name),
+        )
+
+    def on_collection_saved(self, name: str, metadata: dict[str, Any] | None) -> None:
+        """Record that a collection was created or its metadata was updated."""
+        if name == RESEARCH_STATE_COLLECTION_NAME:
+            return
+        with self._lock:
+            if self._loaded_at is not None:  # otherwise it will be loaded as is
+                self._remove(name)
+                self._add(name, (metadata or {}).get("updated_at"))
+
+    def on_collection_deleted(self, name: str) -> None:
+        """Record that a collection was deleted (or renamed)."""
+        with self._lock:
+            if self._loaded_at is not None:
+                self._remove(name)
+
+    def _get_listing(
+        self, owner_prefix: str | None, extra_names: Iterable[str]
+    ) -> tuple[list[SortKey], list[SortKey]]:
+        """
+        Get the sorted keys of the collections with the given owner prefix and of the
+        extra collections (those of them that exist and don't have that prefix).
+        """
+        owner_keys = self._sort_keys_by_owner.get(owner_prefix, [])
+        extra_keys = sorted(
+            get_sort_key(name, self._updated_at_by_name[name])
+            for name in set(extra_names)
+            if name in self._updated_at_by_name
+            and get_owner_prefix(name) != owner_prefix
+        )
+        return owner_keys, extra_keys
+
+    def _make_entry(self, idx: int, name: str, owner_prefix: str | None):
+        return CatalogEntry(
+            idx=idx,
+            name=name,
+            name_as_shown=get_name_as_shown(name, owner_prefix),
+            updated_at=self._updated_at_by_name[name],
+        )
+
+    def count(self, owner_prefix: str | None, extra_names: Iterable[str] = ()) -> int:
+        """Get the number of collections in a listing (see list_collections)."""
+        with self._lock:
+            self._ensure_loaded()
+            owner_keys, extra_keys = self._get_listing(owner_prefix, extra_names)
+            return len(owner_keys) + len(extra_keys)
+
+    def is_listed(
+        self, name: str, owner_prefix: str | None, extra_names: Iterable[str] = ()
+    ) -> bool:
+        """Check if a collection is in a listing (see list_collections)."""
+        with self._lock:
+            self._ensure_loaded()
+            return name in self._updated_at_by_name and (
+                get_owner_prefix(name) == owner_prefix or name in extra_names
+            )
+
+    def list_collections(
+        self,
+        owner_prefix: str | None,
+        extra_names: Iterable[str] = (),
+        offset: int = 0,
+        limit: int | None = None,
+    ) -> list[CatalogEntry]:
+        """
+        List the collections with the given owner prefix and the extra collections
+        with the given names, in order (see get_sort_key), from the given offset.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            keys = heapq.merge(*self._get_listing(owner_prefix, extra_names))
+            stop = None if limit is None else offset + limit
+            return [
+                self._make_entry(idx, key[2], owner_prefix)
+                for idx, key in enumerate(islice(keys, offset, stop), start=offset)
+            ]
+
+    def search(
+        self,
+        owner_prefix: str | None,
+        extra_names: Iterable[str] = (),
+        *,
+        prefix: str | None = None,
+        substring: str = "",
+        offset: int = 0,
+        limit: int | None = None,
+    ) -> list[CatalogEntry]:
+        """
+        Get the collections in a listing (see list_collections), from the given offset,
+        whose names as shown start with the given prefix (if given) or otherwise
+        contain the given substring. The entries have their indexes in the listing.
+        """
+        if prefix is not None:
+            is_match = lambda name: name.startswith(prefix)  # noqa
+        else:
+            is_match = lambda name: substring in name  # noqa
+
+        with self._lock:
+            self._ensure_loaded()
+            owner_keys, extra_keys = self._get_listing(owner_prefix, extra_names)
+            names = self._names_by_owner.get(owner_prefix, [])
+            if prefix is not None:
+                start = bisect.bisect_left(names, (prefix,))
+                matches = takewhile(
+                    lambda x: is_match(x[0]), islice(names, start, None)
+                )
+            else:
+                matches = (x for x in names if is_match(x[0]))
+
+            # The names as shown of the extra collections are their full names
+            keys = [get_sort_key(n, self._updated_at_by_name[n]) for _, n in matches]
+            keys += [key for key in extra_keys if is_match(key[2])]
+            keys.sort()
+
+            entries = []
+            for key in keys:
+                idx = bisect.bisect_left(owner_keys, key)
+                idx += bisect.bisect_left(extra_keys, key)
+                if idx < offset:
+                    continue
+                if limit is not None and len(entries) >= limit:
+                    break
+                entries.append(self._make_entry(idx, key[2], owner_prefix))
+            return entries
+
+
+def get_collection_catalog(client: ClientAPI) -> CollectionCatalog:
+    """
+    Get the shared CollectionCatalog for the given client (attached to the client, so
+    it lives as long as the client does).
+    """
+    return get_attached_cache(
+        client, "collection_catalog", lambda: CollectionCatalog(client)
+    )
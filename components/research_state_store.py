@@ -0,0 +1,293 @@
+import hashlib
+import json
+import uuid
+from typing import Any, Iterable
+
+from chromadb import ClientAPI, Collection
+from pydantic import BaseModel
+
+from utils.cache_utils import LRUCache, get_attached_cache
+from utils.prepare import (
+    RESEARCH_STATE_COLLECTION_NAME,
+    RESEARCH_STATE_COMPACTION_INTERVAL,
+    get_logger,
+)
+from utils.type_utils import DDGError
+from utils.web import LinkData
+
+logger = get_logger()
+
+# Chroma requires an embedding for each record; we only ever get records by id
+FAKE_EMBEDDING = [1.0]
+
+# Max number of last saved (or loaded) states kept in memory to compute deltas against
+SAVED_STATE_CACHE_MAX_ITEMS = 1000
+
+
+class ResearchStateNotFoundError(DDGError):
+    """Exception raised when a research state referred to by a collection is missing."""
+
+    default_user_facing_message = (
+        "Apologies, I couldn't find the saved state of the research in this collection."
+    )
+
+
+def get_state_delta(old_state: dict[str, Any], new_state: dict[str, Any]) -> dict:
+    """
+    Get the changes between two versions of a state (as dicts, e.g. from model_dump),
+    field by field: lists that were appended to or cut at the front are recorded as
+    such, dicts that only gained or changed items as those items, and anything else as
+    the new value. Fields that didn't change are left out.
+    """
+    delta = {}
+    for key, value in new_state.items():
+        old_value = old_state.get(key)
+        if value == old_value:
+            continue
+        if isinstance(value, list) and isinstance(old_value, list):
+            num_old = len(old_value)
+            if value[:num_old] == old_value:
+                delta[key] = {"extend": value[num_old:]}
+                continue
+            num_cut = num_old - len(value)
+            if num_cut > 0 and old_value[num_cut:] == value:
+                delta[key] = {"cut_front": num_cut}
+                continue
+        elif (
+            isinstance(value, dict)
+            and isinstance(old_value, dict)
+            and old_value.keys() <= value.keys()
+        ):
+            delta[key] = {
+                "update": {k: v for k, v in value.items() if old_value.get(k) != v}
+            }
+            continue
+        delta[key] = {"set": value}
+    return delta
+
+
+def apply_state_delta(state: dict[str, Any], delta: dict) -> None:
+    """Apply a delta from get_state_delta to a state (in place)."""
+    for key, change in delta.items():
+        if "extend" in change:
+            state[key] = state[key] + change["extend"]
+        elif "cut_front" in change:
+            state[key] = state[key][change["cut_front"] :]
+        elif "update" in change:
+            state[key] = state[key] | change["update"]
+        else:
+            state[key] = change["set"]
+
+
+class ResearchStateStore:
+    """
+    Store for the state of research agents (e.g. ResearchReportData), kept in a
+    dedicated Chroma collection rather than in the metadata of the collection the
+    research is for (which is fetched, parsed and rewritten much more often). It has:
+
+    1. A compact record for each saved state, with everything but the texts of the
+    fetched pages (report structure, link states, etc.), followed by a journal of
+    changes: each save appends just the delta from the previous save, and every
+    compaction_interval saves the state is written in full again (a new "generation"
+    of the record), after which the old journal entries are deleted.
+    2. The page texts, content-addressed (the id is the text's hash), so each text is
+    stored once and is only loaded when needed.
+
+    Deltas are computed against the last state this worker saved or loaded for the
+    record; if it doesn't have it (e.g. after a restart), or if the record was saved by
+    another worker since then (its generation or number of journal entries changed), it
+    writes the full state. So, as before journaling, concurrent saves of the same state
+    mean that the last writer wins with a complete state.
+    NOTE: A save made by another worker between that check and the write is not
+    detected.
+    """
+
+    def __init__(
+        self,
+        client: ClientAPI,
+        compaction_interval: int = RESEARCH_STATE_COMPACTION_INTERVAL,
+    ):
+        self.client = client
+        self.compaction_interval = compaction_interval
+        self._collection: Collection | None = None
+
+        # Values are (generation, number of journal entries, state)
+        self.saved_states = LRUCache(
+            max_size=SAVED_STATE_CACHE_MAX_ITEMS, name="research_states"
+        )
+
+    @property
+    def collection(self) -> Collection:
+        if self._collection is None:
+            self._collection = self.client.get_or_create_collection(
+                RESEARCH_STATE_COLLECTION_NAME, embedding_function=None
+            )
+        return self._collection
+
+    def _upsert(
+        self,
+        ids: list[str],
+        documents: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+    ) -> None:
+        self.collection.upsert(
+            ids=ids,
+            embeddings=[FAKE_EMBEDDING] * len(ids),
+            documents=documents,
+            metadatas=metadatas,
+        )
+
+    @staticmethod
+    def get_text_id(text_hash: str) -> str:
+        return f"text-{text_hash}"
+
+    def save_link_texts(self, link_datas: Iterable[LinkData]) -> None:
+        """
+        Store the texts of the given LinkData objects that aren't stored yet (and set
+        their text_hash).
+        """
+        new_link_datas = [
+            x for x in link_datas if not x.text_hash and x.text_compressed is not None
+        ]
+        if not new_link_datas:
+            return
+
+        texts_by_id: dict[str, str] = {}
+        for link_data in new_link_datas:
+            link_data.text_hash = hashlib.sha256(link_data.text.encode()).hexdigest()
+            texts_by_id[self.get_text_id(link_data.text_hash)] = link_data.text
+
+        # Skip texts that are already stored (e.g. from another research)
+        stored_ids = self.collection.get(ids=list(texts_by_id), include=[])["ids"]
+        for id in stored_ids:
+            del texts_by_id[id]
+        if texts_by_id:
+            self._upsert(list(texts_by_id), list(texts_by_id.values()))
+        logger.info(f"Stored {len(texts_by_id)} new texts ({len(new_link_datas)} links)")
+
+    def load_link_texts(self, link_datas: Iterable[LinkData]) -> None:
+        """Load the texts of the given LinkData objects that haven't been loaded yet."""
+        link_datas_by_id: dict[str, list[LinkData]] = {}
+        for link_data in link_datas:
+            if link_data.text_compressed is None and link_data.text_hash:
+                id = self.get_text_id(link_data.text_hash)
+                link_datas_by_id.setdefault(id, []).append(link_data)
+        if not link_datas_by_id:
+            return
+
+        res = self.collection.get(ids=list(link_datas_by_id), include=["documents"])
+        for id, text in zip(res["ids"], res["documents"]):
+            for link_data in link_datas_by_id[id]:
+                link_data.text = text
+        logger.info(f"Loaded {len(res['ids'])} texts")
+
+    def save_state(
+        self,
+        state: BaseModel,
+        link_datas: Iterable[LinkData],
+        record_id: str | None = None,
+    ) -> str:
+        """
+        Save the given state under the given record id (or a new one, if not given),
+        with the texts of the given LinkData objects (which should be part of the
+        state) stored separately. Returns the record id.
+        """
+        self.save_link_texts(link_datas)
+        state_dict = state.model_dump(
+            mode="json", context={"exclude_stored_texts": True}
+        )
+        saved = self.saved_states.get(record_id) if record_id else None
+
+        # Append the changes to the journal, unless it's time to compact it or the
+        # journal has changed since this worker last saved or loaded the state
+        if saved is not None and saved[1] + 1 < self.compaction_interval:
+            generation, num_entries, saved_state = saved
+            if not (delta := get_state_delta(saved_state, state_dict)):
+                return record_id
+            entry_id = f"{record_id}-{generation}-{num_entries}"
+            if self._is_journal_unchanged(record_id, generation, entry_id):
+                self._upsert(
+                    [entry_id],
+                    [json.dumps(delta)],
+                    [{"record_id": record_id, "generation": generation}],
+                )
+                self.saved_states.put(
+                    record_id, (generation, num_entries + 1, state_dict)
+                )
+                return record_id
+            logger.warning(f"State {record_id} was saved elsewhere, writing it in full")
+
+        # Write the full state as a new generation of the record
+        is_new_record = record_id is None
+        record_id = record_id or f"state-{uuid.uuid4().hex}"
+        generation = uuid.uuid4().hex[:8]
+        self._upsert(
+            [record_id], [json.dumps(state_dict)], [{"generation": generation}]
+        )
+        self.saved_states.put(record_id, (generation, 0, state_dict))
+        if not is_new_record:  # delete the previous generation's journal
+            self.collection.delete(
+                where={
+                    "$and": [
+                        {"record_id": record_id},
+                        {"generation": {"$ne": generation}},
+                    ]
+                }
+            )
+        return record_id
+
+    def _is_journal_unchanged(
+        self, record_id: str, generation: str, next_entry_id: str
+    ) -> bool:
+        """
+        Check that the record is still at the given generation and that its journal
+        doesn't have the given next entry yet, i.e. that no other worker saved the
+        state since this one last saved or loaded it.
+        """
+        res = self.collection.get(ids=[record_id, next_entry_id], include=["metadatas"])
+        generation_by_id = {
+            id: (metadata or {}).get("generation")
+            for id, metadata in zip(res["ids"], res["metadatas"])
+        }
+        return (
+            next_entry_id not in generation_by_id
+            and generation_by_id.get(record_id) == generation
+        )
+
+    def load_state(self, record_id: str) -> dict[str, Any] | None:
+        """
+        Load the state saved under the given id (without the stored texts, see
+        load_link_texts), or None if there's no such record.
+        """
+        res = self.collection.get(ids=[record_id], include=["documents", "metadatas"])
+        if not res["ids"]:
+            return None
+        state = json.loads(res["documents"][0])
+
+        # Apply the changes from the journal (records saved before journaling was
+        # introduced have no generation and no journal)
+        if generation := (res["metadatas"][0] or {}).get("generation"):
+            journal = self.collection.get(
+                where={
+                    "$and": [{"record_id": record_id}, {"generation": generation}]
+                },
+                include=["documents"],
+            )
+            entries = sorted(
+                zip(journal["ids"], journal["documents"]),
+                key=lambda x: int(x[0].rsplit("-", 1)[1]),
+            )
+            for _, delta_json in entries:
+                apply_state_delta(state, json.loads(delta_json))
+            self.saved_states.put(record_id, (generation, len(entries), state))
+        return state
+
+
+def get_research_state_store(client: ClientAPI) -> ResearchStateStore:
+    """
+    Get the shared ResearchStateStore for the given client (attached to the client, so
+    it lives as long as the client does).
+    """
+    return get_attached_cache(
+        client, "research_state_store", lambda: ResearchStateStore(client)
+    )
@@ -1,17 +1,25 @@
+import asyncio
 import os
-from typing import Any
+from typing import Any, Callable
 
 from langchain.chains import LLMChain
 
 from _prepare_env import is_env_loaded
-from agents.dbmanager import get_user_facing_collection_name, handle_db_command
+from agents.dbmanager import (
+    get_user_facing_collection_name,
+    get_vectorstores_to_search,
+    handle_db_command,
+)
 from agents.exporter import get_exporter_response
 from agents.ingester_summarizer import get_ingester_summarizer_response
 from agents.researcher import get_researcher_response, get_websearcher_response
 from agents.share_manager import handle_share_command
 from components.chat_with_docs_chain import ChatWithDocsChain
 from components.chroma_ddg import ChromaDDG, get_vectorstore_using_openai_api_key
-from components.chroma_ddg_retriever import ChromaDDGRetriever
+from components.chroma_ddg_retriever import (
+    ChromaDDGRetriever,
+    FederatedChromaDDGRetriever,
+)
 from components.llm import get_llm, get_llm_from_prompt_llm_chain, get_prompt_llm_chain
 from utils.algo import remove_duplicates_keep_order
 from utils.chat_state import ChatState
@@ -22,10 +30,18 @@ from utils.helpers import (
     INTRO_ASCII_ART,
     MAIN_BOT_PREFIX,
 )
-from utils.lang_utils import pairwise_chat_history_to_msg_list
+from utils.lang_utils import (
+    pairwise_chat_history_to_msg_list,
+    preload_tiktoken_encodings,
+)
 
 # Load environment variables
-from utils.prepare import DEFAULT_COLLECTION_NAME, DEFAULT_OPENAI_API_KEY, get_logger
+from utils.prepare import (
+    ALLOWED_MODELS,
+    DEFAULT_COLLECTION_NAME,
+    DEFAULT_OPENAI_API_KEY,
+    get_logger,
+)
 from utils.prompts import (
     CHAT_WITH_DOCS_PROMPT,
     CONDENSE_QUESTION_PROMPT,
@@ -41,18 +57,104 @@ logger = get_logger()
 default_vectorstore = None  # can move to chat_state
 
 
-def get_bot_response(chat_state: ChatState):
+def get_docs_chat_chain_and_inputs(
+    chat_state: ChatState,
+) -> tuple[ChatWithDocsChain, dict[str, Any]] | None:
+    """
+    If the chat mode is one where we chat with docs (/kb, /details, /quotes or /help
+    with a message), return the chain to use and its inputs. Otherwise, return None.
+    """
     global default_vectorstore
     chat_mode_val = (
         chat_state.chat_mode.value
     )  # use value due to Streamlit code reloading
+    # Search the collections selected with --collections, if any, or the current one
+    vectorstores = [chat_state.vectorstore]
+    if chat_state.parsed_query.collection_names and chat_mode_val in {
+        ChatMode.CHAT_WITH_DOCS_COMMAND_ID.value,
+        ChatMode.DETAILS_COMMAND_ID.value,
+        ChatMode.QUOTES_COMMAND_ID.value,
+    }:
+        vectorstores = get_vectorstores_to_search(chat_state)
+    kwargs = {"vectorstore": vectorstores[0], "extra_vectorstores": vectorstores[1:]}
+
     if chat_mode_val == ChatMode.CHAT_WITH_DOCS_COMMAND_ID.value:  # /kb command
-        chat_chain = get_docs_chat_chain(chat_state)
+        chat_chain = get_docs_chat_chain(chat_state, **kwargs)
     elif chat_mode_val == ChatMode.DETAILS_COMMAND_ID.value:  # /details command
-        chat_chain = get_docs_chat_chain(chat_state, prompt_qa=QA_PROMPT_SUMMARIZE_KB)
+        chat_chain = get_docs_chat_chain(
+            chat_state, prompt_qa=QA_PROMPT_SUMMARIZE_KB, **kwargs
+        )
     elif chat_mode_val == ChatMode.QUOTES_COMMAND_ID.value:  # /quotes command
-        chat_chain = get_docs_chat_chain(chat_state, prompt_qa=QA_PROMPT_QUOTES)
-    elif chat_mode_val == ChatMode.WEB_COMMAND_ID.value:  # /web command
+        chat_chain = get_docs_chat_chain(
+            chat_state, prompt_qa=QA_PROMPT_QUOTES, **kwargs
+        )
+    elif (
+        chat_mode_val == ChatMode.HELP_COMMAND_ID.value  # /help command
+        and chat_state.parsed_query.message
+    ):
+        # Use the default vectorstore to get help
+        if default_vectorstore is None:
+            # Can happen in API mode or due to Streamlit's code reloading
+            default_vectorstore = chat_state.get_new_vectorstore(
+                DEFAULT_COLLECTION_NAME, create_if_not_exists=False
+            )
+        chat_chain = get_docs_chat_chain(chat_state, vectorstore=default_vectorstore)
+        return chat_chain, {
+            "question": chat_state.message,
+            "coll_name": DEFAULT_COLLECTION_NAME,
+            "chat_history": chat_state.chat_history,
+        }
+    else:
+        return None
+
+    return chat_chain, {
+        "question": chat_state.message,
+        "coll_name": ", ".join(
+            get_user_facing_collection_name(chat_state.user_id, vs.name)
+            for vs in vectorstores
+        ),
+        "chat_history": chat_state.chat_history,
+        "search_params": chat_state.search_params,
+    }
+
+
+def get_bot_response(chat_state: ChatState):
+    """
+    Get the bot's response to the current query. Changes to the collection's metadata
+    made while responding are saved in one write at the end (even if there's an error,
+    to keep the progress made, as before they were saved right away).
+    """
+    try:
+        res = _get_bot_response(chat_state)
+    except Exception as e:
+        flush_collection_metadata_after_error(chat_state, e)
+        raise
+    chat_state.flush_collection_metadata()
+    return res
+
+
+def flush_collection_metadata_after_error(chat_state: ChatState, error: Exception):
+    """
+    Save the pending changes to the collection's metadata after responding failed with
+    the given error. If saving fails too (e.g. with a MetadataConflictError), the
+    original error is raised, with the saving error as its cause.
+    """
+    try:
+        chat_state.flush_collection_metadata()
+    except Exception as flush_error:
+        raise error from flush_error
+
+
+def _get_bot_response(chat_state: ChatState):
+    # Chat with docs (/kb, /details, /quotes, /help with a message)
+    if (chain_and_inputs := get_docs_chat_chain_and_inputs(chat_state)) is not None:
+        chat_chain, inputs = chain_and_inputs
+        return chat_chain.invoke(inputs)
+
+    chat_mode_val = (
+        chat_state.chat_mode.value
+    )  # use value due to Streamlit code reloading
+    if chat_mode_val == ChatMode.WEB_COMMAND_ID.value:  # /web command
         return get_websearcher_response(chat_state)
     elif chat_mode_val == ChatMode.SUMMARIZE_COMMAND_ID.value:  # /summarize command
         return get_ingester_summarizer_response(chat_state)
@@ -80,27 +182,8 @@ def get_bot_response(chat_state: ChatState):
     elif chat_mode_val == ChatMode.SHARE_COMMAND_ID.value:  # /share command
         return handle_share_command(chat_state)
     elif chat_mode_val == ChatMode.HELP_COMMAND_ID.value:  # /help command
-        if not chat_state.parsed_query.message:
-            return {"answer": HELP_MESSAGE, "needs_print": True}
-
-        # Temporarily switch to the default vectorstore to get help
-        saved_vectorstore = chat_state.vectorstore
-        if default_vectorstore is None:
-            # Can happen in API mode or due to Streamlit's code reloading
-            default_vectorstore = chat_state.get_new_vectorstore(
-                DEFAULT_COLLECTION_NAME, create_if_not_exists=False
-            )
-        chat_state.vectorstore = default_vectorstore
-        chat_chain = get_docs_chat_chain(chat_state)
-        res = chat_chain.invoke(
-            {
-                "question": chat_state.message,
-                "coll_name": DEFAULT_COLLECTION_NAME,
-                "chat_history": chat_state.chat_history,
-            }
-        )
-        chat_state.vectorstore = saved_vectorstore
-        return res
+        # (a /help command with a message is handled above)
+        return {"answer": HELP_MESSAGE, "needs_print": True}
     elif chat_mode_val == ChatMode.INGEST_COMMAND_ID.value:  # /ingest command
         # If a URL is given, fetch and ingest it. Otherwise, upload local docs
         if (
@@ -120,16 +203,59 @@ def get_bot_response(chat_state: ChatState):
         # Should never happen
         raise ValueError(f"Invalid chat mode: {chat_state.chat_mode}")
 
-    return chat_chain.invoke(
-        {
-            "question": chat_state.message,
-            "coll_name": get_user_facing_collection_name(
-                chat_state.user_id, chat_state.vectorstore.name
-            ),
-            "chat_history": chat_state.chat_history,
-            "search_params": chat_state.search_params,
-        }
+
+async def aget_bot_response(chat_state: ChatState):
+    """
+    Async version of get_bot_response. Chatting with docs (/kb, /details, /quotes,
+    /help with a message) is async, so that many such requests can be served
+    concurrently on one event loop. Sync chromadb calls (getting the collections
+    selected with --collections, saving metadata changes) and other commands, which
+    are sync, are run in a worker thread, but only when needed.
+    """
+    try:
+        res = await _aget_bot_response(chat_state)
+    except Exception as e:
+        await run_in_thread_if(
+            chat_state.has_unsaved_metadata_changes,
+            flush_collection_metadata_after_error,
+            chat_state,
+            e,
+        )
+        raise
+    await run_in_thread_if(
+        chat_state.has_unsaved_metadata_changes, chat_state.flush_collection_metadata
+    )
+    return res
+
+
+async def run_in_thread_if(condition: bool, func: Callable, *args: Any) -> Any:
+    """Run a function in a worker thread if the condition is True, otherwise inline."""
+    return await asyncio.to_thread(func, *args) if condition else func(*args)
+
+
+def needs_db_calls_for_docs_chat_chain(chat_state: ChatState) -> bool:
+    """
+    Check if getting the chain to chat with docs requires chromadb calls: to get the
+    collections selected with --collections, or the default collection for /help.
+    """
+    return bool(chat_state.parsed_query.collection_names) or (
+        default_vectorstore is None
+        and chat_state.chat_mode.value == ChatMode.HELP_COMMAND_ID.value
+    )
+
+
+async def _aget_bot_response(chat_state: ChatState):
+    chain_and_inputs = await run_in_thread_if(
+        needs_db_calls_for_docs_chat_chain(chat_state),
+        get_docs_chat_chain_and_inputs,
+        chat_state,
     )
+    if chain_and_inputs is None:
+        # Other commands are sync throughout (LLM calls, web requests, chromadb)
+        return await asyncio.to_thread(_get_bot_response, chat_state)
+
+    chat_chain, inputs = chain_and_inputs
+    return await chat_chain.ainvoke(inputs)
 
 
 def get_source_links(result_from_chain: dict[str, Any]) -> list[str]:
@@ -156,10 +282,16 @@ def get_source_links(result_from_chain: dict[str, Any]) -> list[str]:
 def get_docs_chat_chain(
     chat_state: ChatState,
     prompt_qa=CHAT_WITH_DOCS_PROMPT,
+    vectorstore: ChromaDDG | None = None,
+    extra_vectorstores: list[ChromaDDG] | None = None,
 ):
     """
-    Create a chain to respond to queries using a vectorstore of documents.
+    Create a chain to respond to queries using a vectorstore of documents
+    (by default, the vectorstore in the chat state), or several vectorstores if
+    extra_vectorstores are provided (see FederatedChromaDDGRetriever).
     """
+    vectorstore = vectorstore or chat_state.vectorstore
+
     # Initialize chain for query generation from chat history
     llm_for_q_generation = get_llm(
         settings=chat_state.bot_settings.model_copy(update={"temperature": 0}),
@@ -172,8 +304,8 @@ def get_docs_chat_chain(
     )  # need it to be an object that exposes easy access to the underlying llm
 
     # Initialize retriever from the provided vectorstore
-    if not isinstance(chat_state.vectorstore, ChromaDDG):
-        type_str = str(type(chat_state.vectorstore))
+    if not isinstance(vectorstore, ChromaDDG):
+        type_str = str(type(vectorstore))
         if not type_str.endswith("ChromaDDG'>"):
             raise ValueError("Invalid vectorstore type: " + type_str)
         print(
@@ -181,12 +313,21 @@ def get_docs_chat_chain(
             "instance of ChromaDDG, but its type is: " + type_str
         )
 
-    retriever = ChromaDDGRetriever(
-        vectorstore=chat_state.vectorstore,
-        search_type="similarity_ddg",
-        llm_for_token_counting=None,  # will be assigned in a moment
-        verbose=bool(os.getenv("PRINT_SIMILARITIES")),
-    )
+    if extra_vectorstores:
+        retriever = FederatedChromaDDGRetriever(
+            vectorstore=vectorstore,
+            extra_vectorstores=extra_vectorstores,
+            search_type="similarity_ddg",
+            llm_for_token_counting=None,  # will be assigned in a moment
+            verbose=bool(os.getenv("PRINT_SIMILARITIES")),
+        )
+    else:
+        retriever = ChromaDDGRetriever(
+            vectorstore=vectorstore,
+            search_type="similarity_ddg",
+            llm_for_token_counting=None,  # will be assigned in a moment
+            verbose=bool(os.getenv("PRINT_SIMILARITIES")),
+        )
     # retriever = VectorStoreRetriever(vectorstore=chat_state.vectorstore)
     # search_kwargs={
     #     "k": num_docs_max,
@@ -252,6 +393,9 @@ def do_intro_tasks(
             )
 
     logger.info("Successfully loaded the vector database")
+
+    # Load the tokenizers now rather than on the first request
+    preload_tiktoken_encodings(ALLOWED_MODELS)
     return vectorstore
 
 
@@ -0,0 +1,121 @@
+"""
+Micro-benchmark for expand_chunks on large parent documents.
+
+Compares the time taken by expand_chunks (with and without the optional exact recount
+of tokens) with the cost of the previous approach of re-tokenizing the whole growing
+span at every expansion step, and reports how far the estimated token counts are from
+the exact ones.
+
+Run from the root of the repo with: python -m eval.bench_expand_chunks
+"""
+
+import random
+import time
+
+from _prepare_env import is_env_loaded
+from utils.lang_utils import expand_chunks, get_num_tokens
+from utils.rag import split_text_into_positioned_chunks
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+NUM_PARENTS = 4
+NUM_PARAGRAPHS_PER_PARENT = 1500  # ~0.5M characters per parent
+NUM_BASE_CHUNKS = 10
+MAX_AVG_TOKENS_PER_CHUNK = 800  # as in ChromaDDGRetriever
+NUM_RUNS = 5
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from "
+    "at which but have an they you were her she there one all we their can has more "
+    "retrieval chunk token document embedding vector parent neighbor expansion"
+).split()
+
+
+def make_parent_text(rng: random.Random) -> str:
+    paragraphs = []
+    for _ in range(NUM_PARAGRAPHS_PER_PARENT):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 120))]
+        paragraphs.append(" ".join(words).capitalize() + ".")
+    return "\n\n".join(paragraphs)
+
+
+def get_naive_cost(expanded_chunks, chunks_by_parent_id) -> float:
+    """
+    Time taken to re-tokenize the whole growing span at every expansion step,
+    for the same final spans (this is what expansion used to do).
+    """
+    t_start = time.perf_counter()
+    for chunk in expanded_chunks:
+        parent_chunks = chunks_by_parent_id[chunk.metadata["parent_id"]]
+        start_idx = chunk.metadata["start_index"]
+        end_idx = start_idx + len(chunk.page_content)
+        span_chunks = [
+            x for x in parent_chunks if start_idx <= x.metadata["start_index"] < end_idx
+        ]
+        for i in range(1, len(span_chunks) + 1):
+            span_end_idx = span_chunks[i - 1].metadata["start_index"] + len(
+                span_chunks[i - 1].page_content
+            )
+            get_num_tokens(chunk.page_content[: span_end_idx - start_idx])
+    return time.perf_counter() - t_start
+
+
+def main():
+    rng = random.Random(42)
+    chunks_by_parent_id = {
+        f"parent-{i}": split_text_into_positioned_chunks(
+            make_parent_text(rng), {"parent_id": f"parent-{i}"}
+        )
+        for i in range(NUM_PARENTS)
+    }
+    all_chunks = [x for chunks in chunks_by_parent_id.values() for x in chunks]
+    print(
+        f"{NUM_PARENTS} parents, {len(all_chunks)} chunks, "
+        f"{sum(len(x.page_content) for x in all_chunks)} characters in chunks"
+    )
+
+    def fetch_chunks(chunk_ranges):
+        return [
+            chunk
+            for parent_id, start_chunk_idx, end_chunk_idx in chunk_ranges
+            for chunk in chunks_by_parent_id[parent_id][start_chunk_idx:end_chunk_idx]
+        ]
+
+    max_total_tokens = MAX_AVG_TOKENS_PER_CHUNK * NUM_BASE_CHUNKS
+    get_num_tokens("warm up the tokenizer")
+
+    times, times_with_recount, times_naive, errors = [], [], [], []
+    for _ in range(NUM_RUNS):
+        base_chunks = rng.sample(all_chunks, NUM_BASE_CHUNKS)
+
+        t_start = time.perf_counter()
+        expanded_chunks = expand_chunks(base_chunks, fetch_chunks, max_total_tokens)
+        times.append(time.perf_counter() - t_start)
+
+        t_start = time.perf_counter()
+        expand_chunks(base_chunks, fetch_chunks, max_total_tokens, recount_tokens=True)
+        times_with_recount.append(time.perf_counter() - t_start)
+
+        times_naive.append(get_naive_cost(expanded_chunks, chunks_by_parent_id))
+
+        for chunk in expanded_chunks:
+            exact_num_tokens = get_num_tokens(chunk.page_content)
+            errors.append(abs(chunk.metadata["num_tokens"] - exact_num_tokens))
+
+    print(f"expand_chunks: {1000 * sum(times) / NUM_RUNS:.1f} ms/run")
+    print(
+        "expand_chunks with exact recount: "
+        f"{1000 * sum(times_with_recount) / NUM_RUNS:.1f} ms/run"
+    )
+    print(
+        "re-tokenizing the growing spans (previous approach, tokenization only): "
+        f"{1000 * sum(times_naive) / NUM_RUNS:.1f} ms/run"
+    )
+    print(
+        f"Token count estimate error: max {max(errors)}, "
+        f"mean {sum(errors) / len(errors):.2f} tokens per expanded chunk"
+    )
+
+
+if __name__ == "__main__":
+    main()
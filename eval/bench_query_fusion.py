@@ -0,0 +1,215 @@
+"""
+Benchmark for query fusion in ChromaDDGRetriever.
+
+Builds a synthetic collection of docs, each about one of several topics and one of
+several aspects of it, and asks follow-up questions about a topic's aspect. As in a
+chat, there are two versions of each question: the standalone query from the condenser
+(names the topic but only sometimes keeps the aspect, as condensing can lose details)
+and the raw user query (describes the aspect but only hints at the topic). The relevant
+docs are those about both.
+
+Compares the recall of the top 10 docs retrieved for the standalone query alone (the
+default) with that of fusing the results for both versions, done either sequentially
+(one embeddings call and one chromadb request per version) or batched (one of each for
+all versions, as ChromaDDGRetriever does), and reports the recall gained per extra ms.
+As in ChromaDDGRetriever, K_OVERSHOT docs are retrieved for each version.
+Embeddings are bag-of-words vectors; each embeddings call is delayed to simulate the
+round trip to an embeddings API.
+
+Run from the root of the repo with: python -m eval.bench_query_fusion
+"""
+
+import hashlib
+import math
+import random
+import shutil
+import tempfile
+import time
+
+from chromadb import PersistentClient
+from chromadb.config import Settings
+from langchain_core.embeddings import Embeddings
+
+from _prepare_env import is_env_loaded
+from components.chroma_ddg import ChromaDDG
+from components.chroma_ddg_retriever import ChromaDDGRetriever
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+NUM_TOPICS = 30
+NUM_ASPECTS = 6
+NUM_DOCS_PER_TOPIC_ASPECT = 4
+NUM_FILLER_WORDS_PER_DOC = 10
+NUM_QUESTIONS = 100
+PROB_CONDENSER_KEEPS_ASPECT = 0.5
+NUM_DIMENSIONS = 512
+EMBEDDINGS_CALL_LATENCY = 0.05  # seconds, simulated
+K = 10  # number of docs to compute recall for
+K_OVERSHOT = ChromaDDGRetriever.model_fields["k_overshot"].default
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from "
+    "at which but have an they you were her she there one all we their can has more"
+).split()
+
+
+class BagOfWordsEmbeddings(Embeddings):
+    """Normalized hashed word counts, with a fixed delay for each call."""
+
+    num_calls = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.num_calls += 1
+        time.sleep(EMBEDDINGS_CALL_LATENCY)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    @staticmethod
+    def _embed(text: str) -> list[float]:
+        vector = [0.0] * NUM_DIMENSIONS
+        for word in text.split():
+            word_hash = int(hashlib.md5(word.encode()).hexdigest(), 16)
+            vector[word_hash % NUM_DIMENSIONS] += 1
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+
+def make_words(prefix: str, num_words: int) -> list[str]:
+    return [f"{prefix}{i}" for i in range(num_words)]
+
+
+def make_corpus(rng: random.Random):
+    """Get the docs (as (text, topic, aspect)) and the words of each topic/aspect."""
+    topic_words = [make_words(f"topic{t}w", 8) for t in range(NUM_TOPICS)]
+    aspect_words = [make_words(f"aspect{a}w", 8) for a in range(NUM_ASPECTS)]
+    docs = []
+    for t in range(NUM_TOPICS):
+        for a in range(NUM_ASPECTS):
+            for _ in range(NUM_DOCS_PER_TOPIC_ASPECT):
+                words = rng.sample(topic_words[t], 3) + rng.sample(aspect_words[a], 3)
+                words += [rng.choice(WORDS) for _ in range(NUM_FILLER_WORDS_PER_DOC)]
+                rng.shuffle(words)
+                docs.append((" ".join(words), t, a))
+    return docs, topic_words, aspect_words
+
+
+def make_questions(rng: random.Random, topic_words, aspect_words):
+    """Get (standalone query, raw query, topic, aspect) for each question."""
+    questions = []
+    for _ in range(NUM_QUESTIONS):
+        t, a = rng.randrange(NUM_TOPICS), rng.randrange(NUM_ASPECTS)
+        keeps_aspect = rng.random() < PROB_CONDENSER_KEEPS_ASPECT
+        standalone_query = " ".join(
+            ["what", "about", "the"]
+            + rng.sample(topic_words[t], 3)
+            + (rng.sample(aspect_words[a], 2) if keeps_aspect else [])
+        )
+        raw_query = " ".join(
+            ["and", "its"]
+            + rng.sample(topic_words[t], 1)
+            + rng.sample(aspect_words[a], 3)
+        )
+        questions.append((standalone_query, raw_query, t, a))
+    return questions
+
+
+def search_single(retriever: ChromaDDGRetriever, queries: list[str]):
+    return retriever._to_relevance_scores(
+        [retriever.vectorstore.similarity_search_with_score(queries[0], K_OVERSHOT)]
+    )[0]
+
+
+def search_sequentially(retriever: ChromaDDGRetriever, queries: list[str]):
+    results = [
+        retriever.vectorstore.similarity_search_with_score(query, K_OVERSHOT)
+        for query in queries
+    ]
+    return retriever._fuse(retriever._to_relevance_scores(results), K_OVERSHOT, -1)
+
+
+def search_batched(retriever: ChromaDDGRetriever, queries: list[str]):
+    results = retriever.vectorstore.similarity_search_many_with_score(
+        queries, K_OVERSHOT
+    )
+    return retriever._fuse(retriever._to_relevance_scores(results), K_OVERSHOT, -1)
+
+
+def run(
+    retriever: ChromaDDGRetriever, embeddings: BagOfWordsEmbeddings, questions
+) -> None:
+    stats = {}
+    fused_results = {}
+    for name, search in [
+        ("standalone query only", search_single),
+        ("fusion, sequential", search_sequentially),
+        ("fusion, batched", search_batched),
+    ]:
+        num_relevant_found = 0
+        embeddings.num_calls = 0
+        t_start = time.perf_counter()
+        for standalone_query, raw_query, t, a in questions:
+            docs_and_similarities = search(retriever, [standalone_query, raw_query])
+            fused_results.setdefault(name, []).append(
+                [doc.page_content for doc, _ in docs_and_similarities]
+            )
+            num_relevant_found += sum(
+                doc.metadata["topic"] == t and doc.metadata["aspect"] == a
+                for doc, _ in docs_and_similarities[:K]
+            )
+        ms_per_question = 1000 * (time.perf_counter() - t_start) / NUM_QUESTIONS
+        recall = num_relevant_found / (NUM_QUESTIONS * NUM_DOCS_PER_TOPIC_ASPECT)
+        stats[name] = (recall, ms_per_question)
+        print(f"{name}:")
+        print(f"    recall@{K}: {recall:.3f}")
+        print(f"    ms/question: {ms_per_question:.1f}")
+        print(f"    embeddings calls/question: {embeddings.num_calls / NUM_QUESTIONS}")
+
+    base_recall, base_ms = stats["standalone query only"]
+    for name in ["fusion, sequential", "fusion, batched"]:
+        recall, ms = stats[name]
+        print(
+            f"Recall gained per extra ms, {name}: "
+            f"{(recall - base_recall) / max(ms - base_ms, 1e-3):.4f}"
+        )
+    is_same = fused_results["fusion, sequential"] == fused_results["fusion, batched"]
+    print(f"Sequential and batched fusion give the same results: {is_same}")
+
+
+def main():
+    rng = random.Random(42)
+    docs, topic_words, aspect_words = make_corpus(rng)
+    questions = make_questions(rng, topic_words, aspect_words)
+    print(
+        f"{len(docs)} docs, {NUM_QUESTIONS} questions, "
+        f"{NUM_DOCS_PER_TOPIC_ASPECT} relevant docs each, "
+        f"simulated embeddings call latency: {1000 * EMBEDDINGS_CALL_LATENCY:.0f} ms"
+    )
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        client = PersistentClient(db_dir, settings=Settings(anonymized_telemetry=False))
+        embeddings = BagOfWordsEmbeddings()
+        vectorstore = ChromaDDG(
+            collection_name="bench-query-fusion",
+            client=client,
+            create_if_not_exists=True,
+            embedding_function=embeddings,
+        )
+        vectorstore.add_texts(
+            [text for text, _, _ in docs],
+            metadatas=[{"topic": t, "aspect": a} for _, t, a in docs],
+        )
+        retriever = ChromaDDGRetriever(
+            vectorstore=vectorstore,
+            search_type="similarity_ddg",
+            llm_for_token_counting=None,
+        )
+        run(retriever, embeddings, questions)
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
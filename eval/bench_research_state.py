@@ -0,0 +1,142 @@
+"""
+Benchmark for saving the state of a long research in the ResearchStateStore.
+
+Simulates 100 research iterations, each of which loads the ResearchReportData (as a new
+request would), processes a few links, fetches a few new ones, appends a report and
+saves it. Compares saving the full record every time (compaction interval of 1) with
+journaling the changes (the configured compaction interval), and reports the amount of
+data written and the time taken per iteration, as well as the size the state would have
+in collection metadata (where it used to be kept, with the page texts).
+
+Run from the root of the repo with: python -m eval.bench_research_state
+"""
+
+import random
+import shutil
+import tempfile
+import time
+
+from chromadb import PersistentClient
+from chromadb.config import Settings
+
+from _prepare_env import is_env_loaded
+from agents.researcher_data import Report, ResearchReportData
+from components.research_state_store import ResearchStateStore
+from utils.prepare import RESEARCH_STATE_COMPACTION_INTERVAL
+from utils.web import LinkData
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+NUM_ITERATIONS = 100
+NUM_LINKS_PER_ITERATION = 5
+NUM_WORDS_PER_PAGE = 3000
+NUM_WORDS_PER_REPORT = 600
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from "
+    "at which but have an they you were her she there one all we their can has more "
+    "retrieval chunk token document embedding vector parent neighbor expansion"
+).split()
+
+
+class CountingResearchStateStore(ResearchStateStore):
+    """ResearchStateStore that counts the state records and bytes it writes."""
+
+    num_records_written = 0
+    num_bytes_written = 0
+    num_text_bytes_written = 0
+
+    def _upsert(self, ids, documents, metadatas=None):
+        if ids[0].startswith("text-"):
+            self.num_text_bytes_written += sum(len(x) for x in documents)
+        else:
+            self.num_records_written += len(ids)
+            self.num_bytes_written += sum(len(x) for x in documents)
+        super()._upsert(ids, documents, metadatas)
+
+
+def make_text(rng: random.Random, num_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def make_links(rng: random.Random, start_idx: int) -> dict[str, LinkData]:
+    return {
+        f"https://example.com/{i}": LinkData(text=make_text(rng, NUM_WORDS_PER_PAGE))
+        for i in range(start_idx, start_idx + NUM_LINKS_PER_ITERATION)
+    }
+
+
+def run_iterations(store: ResearchStateStore) -> tuple[list[float], int]:
+    """Run the iterations, return the time each took and the final metadata size."""
+    rng = random.Random(42)
+    link_data_dict = make_links(rng, 0)
+    rr_data = ResearchReportData(
+        query="What are the main ideas of the research?",
+        search_queries=["main ideas", "research overview"],
+        report_type="detailed report",
+        unprocessed_links=list(link_data_dict),
+        processed_links=[],
+        link_data_dict=link_data_dict,
+        max_tokens_final_context=8000,
+    )
+    record_id = store.save_state(rr_data, rr_data.link_data_dict.values())
+
+    times = []
+    for i in range(1, NUM_ITERATIONS + 1):
+        t_start = time.perf_counter()
+        rr_data = ResearchReportData.model_validate(store.load_state(record_id))
+
+        # Fetch new links, process the oldest ones and write a report
+        new_link_data_dict = make_links(rng, i * NUM_LINKS_PER_ITERATION)
+        rr_data.link_data_dict.update(new_link_data_dict)
+        rr_data.unprocessed_links += list(new_link_data_dict)
+        links = rr_data.unprocessed_links[:NUM_LINKS_PER_ITERATION]
+        for link in links:
+            rr_data.link_data_dict[link].is_ingested = True
+        rr_data.processed_links += links
+        rr_data.unprocessed_links = rr_data.unprocessed_links[len(links) :]
+        rr_data.base_reports.append(
+            Report(report_text=make_text(rng, NUM_WORDS_PER_REPORT), sources=links)
+        )
+
+        store.save_state(rr_data, rr_data.link_data_dict.values(), record_id)
+        times.append(time.perf_counter() - t_start)
+
+    # Check that the state (including the texts) is loaded correctly
+    loaded_rr_data = ResearchReportData.model_validate(store.load_state(record_id))
+    context = {"exclude_stored_texts": True}
+    assert loaded_rr_data.model_dump(context=context) == rr_data.model_dump(
+        context=context
+    ), "Loaded state differs from saved state"
+    store.load_link_texts(loaded_rr_data.link_data_dict.values())
+    assert all(x.text for x in loaded_rr_data.link_data_dict.values())
+
+    return times, len(loaded_rr_data.model_dump_json())
+
+
+def main():
+    for name, compaction_interval in [
+        ("full record", 1),
+        ("journal", RESEARCH_STATE_COMPACTION_INTERVAL),
+    ]:
+        db_dir = tempfile.mkdtemp()
+        try:
+            client = PersistentClient(
+                db_dir, settings=Settings(anonymized_telemetry=False)
+            )
+            store = CountingResearchStateStore(client, compaction_interval)
+            times, metadata_size = run_iterations(store)
+        finally:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+        print(f"{name} (compaction interval {compaction_interval}):")
+        print(f"    state records written: {store.num_records_written}")
+        print(f"    state data written: {store.num_bytes_written / 1024:.0f} KB")
+        print(f"    page texts written: {store.num_text_bytes_written / 1024:.0f} KB")
+        print(f"    ms/iteration, first 10: {1000 * sum(times[:10]) / 10:.1f}")
+        print(f"    ms/iteration, last 10: {1000 * sum(times[-10:]) / 10:.1f}")
+    print(f"Final size of the state with page texts: {metadata_size / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark for TokenBudgetAllocator on long chats.
+
+Compares the time ChatWithDocsChain takes to allocate the token budgets for the
+rephrase prompt and the QA prompt (chat history + docs) using TokenBudgetAllocator
+with the previous approach of calling limit_chat_history once for each budget, and
+checks that both give identical results. Times are reported both including the initial
+token counting of the message pairs and excluding it (with the counts precomputed).
+
+Run from the root of the repo with: python -m eval.bench_token_budget
+"""
+
+import random
+import time
+
+from langchain_openai import ChatOpenAI
+
+from _prepare_env import is_env_loaded
+from components.chat_with_docs_chain import ChatWithDocsChain
+from utils.lang_utils import (
+    TokenBudgetAllocator,
+    get_num_tokens,
+    limit_chat_history,
+    pairwise_chat_history_to_string,
+)
+from utils.prepare import MODEL_NAME
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+CHAT_LENGTHS = [10, 50, 200, 1000]  # number of message pairs
+NUM_DOCS = 10
+NUM_RUNS = 5
+
+# Same budgets as in ChatWithDocsChain
+fields = ChatWithDocsChain.model_fields
+MAX_TOKENS_LIMIT_QA = fields["max_tokens_limit_qa"].default
+MAX_TOKENS_LIMIT_CHAT = fields["max_tokens_limit_chat"].default
+MAX_TOKENS_LIMIT_REPHRASE = fields["max_tokens_limit_rephrase"].default
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from "
+    "at which but have an they you were her she there one all we their can has more "
+    "retrieval chunk token document embedding vector parent neighbor expansion"
+).split()
+
+
+def make_text(rng: random.Random, num_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def make_chat_history(rng: random.Random, num_pairs: int) -> list[tuple[str, str]]:
+    # Mostly short questions and medium answers, with an occasional very long answer
+    return [
+        (
+            make_text(rng, rng.randint(5, 60)),
+            make_text(rng, rng.choice([rng.randint(50, 400)] * 9 + [3000])),
+        )
+        for _ in range(num_pairs)
+    ]
+
+
+def allocate_previously(chat_history, doc_token_counts, llm, cached_token_counts):
+    """The previous approach: one limit_chat_history call per budget."""
+    chat_history, token_counts = limit_chat_history(
+        chat_history,
+        max_token_limit=max(MAX_TOKENS_LIMIT_REPHRASE, MAX_TOKENS_LIMIT_QA),
+        llm_for_token_counting=llm,
+        cached_token_counts=cached_token_counts,
+    )
+    chat_history_for_rephrasing, _ = limit_chat_history(
+        chat_history,
+        max_token_limit=MAX_TOKENS_LIMIT_REPHRASE,
+        cached_token_counts=token_counts,
+        llm_for_token_counting=llm,
+    )
+    _, token_counts_chat = limit_chat_history(
+        chat_history,
+        max_token_limit=MAX_TOKENS_LIMIT_CHAT,
+        cached_token_counts=token_counts,
+        llm_for_token_counting=llm,
+    )
+    token_count_docs = sum(doc_token_counts)
+    num_docs = len(doc_token_counts)
+    while token_count_docs > MAX_TOKENS_LIMIT_QA - sum(token_counts_chat) and num_docs:
+        num_docs -= 1
+        token_count_docs -= doc_token_counts[num_docs]
+    chat_history_for_qa, _ = limit_chat_history(
+        chat_history,
+        max_token_limit=MAX_TOKENS_LIMIT_QA - token_count_docs,
+        cached_token_counts=token_counts,
+        llm_for_token_counting=llm,
+    )
+    return chat_history_for_rephrasing, chat_history_for_qa, num_docs
+
+
+def allocate_with_allocator(chat_history, doc_token_counts, llm, cached_token_counts):
+    token_budget = TokenBudgetAllocator(
+        chat_history,
+        max_token_limit=max(MAX_TOKENS_LIMIT_REPHRASE, MAX_TOKENS_LIMIT_QA),
+        llm_for_token_counting=llm,
+        cached_token_counts=cached_token_counts,
+    )
+    chat_history_for_rephrasing, _ = token_budget.limit_chat_history(
+        MAX_TOKENS_LIMIT_REPHRASE
+    )
+    chat_history_for_qa, num_docs, _ = token_budget.allocate(
+        doc_token_counts,
+        max_tokens_limit_qa=MAX_TOKENS_LIMIT_QA,
+        max_tokens_limit_chat=MAX_TOKENS_LIMIT_CHAT,
+    )
+    return chat_history_for_rephrasing, chat_history_for_qa, num_docs
+
+
+def main():
+    rng = random.Random(42)
+    llm = ChatOpenAI(model=MODEL_NAME, api_key="DUMMY")  # only used to count tokens
+    get_num_tokens("warm up the tokenizer")
+
+    num_mismatches = 0
+    for num_pairs in CHAT_LENGTHS:
+        times = {"previous": [], "allocator": []}
+        times_precounted = {"previous": [], "allocator": []}
+        for _ in range(NUM_RUNS):
+            chat_history = make_chat_history(rng, num_pairs)
+            doc_token_counts = [rng.randint(200, 1200) for _ in range(NUM_DOCS)]
+            token_counts = [
+                get_num_tokens(pairwise_chat_history_to_string([pair]), llm)
+                for pair in chat_history
+            ]
+            for cached_token_counts, times_dict in [
+                (None, times),
+                (token_counts, times_precounted),
+            ]:
+                results = []
+                for name, allocate in [
+                    ("previous", allocate_previously),
+                    ("allocator", allocate_with_allocator),
+                ]:
+                    t_start = time.perf_counter()
+                    results.append(
+                        allocate(
+                            chat_history, doc_token_counts, llm, cached_token_counts
+                        )
+                    )
+                    times_dict[name].append(time.perf_counter() - t_start)
+                num_mismatches += results[0] != results[1]
+
+        print(f"{num_pairs} message pairs (ms/run, with / without initial counting):")
+        for name in times:
+            print(
+                f"    {name}: {1000 * sum(times[name]) / NUM_RUNS:.2f} / "
+                f"{1000 * sum(times_precounted[name]) / NUM_RUNS:.2f}"
+            )
+    print(f"Number of runs with different results: {num_mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark for counting the tokens in many texts.
+
+Compares tokenizing texts one by one in the current thread, in a thread pool (how
+get_num_tokens_in_texts used to do it), with tiktoken's batch encoding and in a pool of
+processes, as well as getting the counts from the token count cache. Use the results to
+choose TOKENIZER_PROCESS_POOL_MIN_CHARS.
+
+Run from the root of the repo with: python -m eval.bench_tokenizer
+"""
+
+import random
+import time
+
+from _prepare_env import is_env_loaded
+from utils.async_utils import execute_func_map_in_threads
+from utils.lang_utils import (
+    get_num_tokens_in_texts,
+    get_num_tokens_in_texts_using_processes,
+    get_tiktoken_encoding,
+    token_count_cache,
+)
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+# (number of texts, number of words per text)
+WORKLOADS = [(10, 300), (100, 300), (1000, 300), (20, 30000), (200, 30000)]
+NUM_RUNS = 3
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from "
+    "at which but have an they you were her she there one all we their can has more "
+    "retrieval chunk token document embedding vector parent neighbor expansion"
+).split()
+
+
+def make_texts(rng: random.Random, num_texts: int, num_words: int) -> list[str]:
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(num_words)) for _ in range(num_texts)
+    ]
+
+
+def main():
+    rng = random.Random(42)
+    tiktoken_encoding = get_tiktoken_encoding()
+
+    def count_one_by_one(texts):
+        return [len(tiktoken_encoding.encode_ordinary(x)) for x in texts]
+
+    def count_in_threads(texts):
+        return execute_func_map_in_threads(
+            lambda x: len(tiktoken_encoding.encode_ordinary(x)), texts
+        )
+
+    def count_with_batch_encoding(texts):
+        return [len(x) for x in tiktoken_encoding.encode_ordinary_batch(texts)]
+
+    def count_in_processes(texts):
+        return get_num_tokens_in_texts_using_processes(texts, tiktoken_encoding.name)
+
+    def count_with_cache(texts):
+        return get_num_tokens_in_texts(texts)
+
+    methods = {
+        "one by one": count_one_by_one,
+        "threads": count_in_threads,
+        "batch encoding": count_with_batch_encoding,
+        "processes": count_in_processes,
+        "cached": count_with_cache,
+    }
+    count_in_processes(["start the process pool"])
+
+    for num_texts, num_words in WORKLOADS:
+        texts = make_texts(rng, num_texts, num_words)
+        get_num_tokens_in_texts(texts)  # fill the cache
+        print(
+            f"{num_texts} texts, {sum(len(x) for x in texts) / 1e6:.1f}M characters:"
+        )
+        expected_token_counts = count_one_by_one(texts)
+        for name, count in methods.items():
+            t_start = time.perf_counter()
+            for _ in range(NUM_RUNS):
+                token_counts = count(texts)
+            elapsed = (time.perf_counter() - t_start) / NUM_RUNS
+            is_ok = token_counts == expected_token_counts
+            print(f"    {name}: {1000 * elapsed:.1f} ms{'' if is_ok else ' (WRONG)'}")
+        token_count_cache.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Parity check between the sync and async retrieval paths of ChromaDDGRetriever.
+
+Ingests a few eval texts into temporary collections (one with chunk positions, one in
+the older format without them), using deterministic fake embeddings, and checks that
+_get_relevant_documents and _aget_relevant_documents return the same documents, with
+the same metadata and similarity scores, for a set of queries. Tokens are counted with
+a local byte-level tokenizer, so the check runs offline (without downloading
+tiktoken's data).
+
+Run from the root of the repo with: python -m eval.check_async_retrieval_parity
+"""
+
+import asyncio
+import sys
+import tempfile
+import uuid
+
+import tiktoken
+from chromadb import PersistentClient
+from chromadb.config import Settings
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from pydantic import Field
+
+from _prepare_env import is_env_loaded
+from components.chroma_ddg import ChromaDDG
+from components.chroma_ddg_retriever import ChromaDDGRetriever
+from eval.ai_news_1 import ai_news_1
+from eval.openai_news import openai_news
+from eval.top_russian_desserts import top_russian_desserts
+from utils.docgrab import FAKE_FULL_DOC_EMBEDDING, prepare_chunks
+from utils.lang_utils import (
+    get_model_name_for_token_counting,
+    tiktoken_encodings_by_model_name,
+)
+from utils.prepare import EMBEDDINGS_DIMENSIONS
+from utils.rag import rag_text_splitter
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+QUERIES = [
+    "What were the biggest AI stories of 2022?",
+    "What is the Q* model that OpenAI is rumored to have?",
+    "What are some traditional Russian desserts?",
+    "How do I make syrniki?",
+    "Is AI sentient?",
+    "Who was fired from Google?",
+]
+
+
+class NormalizedFakeEmbedding(DeterministicFakeEmbedding):
+    """Deterministic fake embeddings of unit length, like OpenAI embeddings."""
+
+    def _get_embedding(self, seed: int) -> list[float]:
+        embedding = super()._get_embedding(seed)
+        norm = sum(x * x for x in embedding) ** 0.5
+        return [x / norm for x in embedding]
+
+
+class RecordingChromaDDGRetriever(ChromaDDGRetriever):
+    """ChromaDDGRetriever that keeps the similarity scores of the last docs found."""
+
+    last_similarities: list[float] = Field(default_factory=list)
+
+    def _pare_down(
+        self, docs_and_similarities_overshot: list[tuple[Document, float]]
+    ) -> tuple[list[Document], list[float]]:
+        chunks, similarities = super()._pare_down(docs_and_similarities_overshot)
+        self.last_similarities = similarities
+        return chunks, similarities
+
+
+def use_offline_tokenizer() -> None:
+    """
+    Make token counting for the default model use a byte-level tokenizer (one token
+    per byte), which doesn't need any data to be downloaded. Token counts are higher
+    than with the model's real tokenizer, which doesn't matter for a parity check.
+    """
+    tiktoken_encodings_by_model_name[get_model_name_for_token_counting()] = (
+        tiktoken.Encoding(
+            name="parity-check-bytes",
+            pat_str=r"\s+|\S+",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={},
+        )
+    )
+
+
+def create_collection(
+    client, embeddings, texts: list[str], with_chunk_positions: bool
+) -> ChromaDDG:
+    parent_ids = [str(uuid.uuid4()) for _ in texts]
+    metadatas = [{"source": f"eval-text-{i}"} for i in range(len(texts))]
+    if with_chunk_positions:
+        chunks = prepare_chunks(texts, metadatas, parent_ids)
+    else:
+        chunks = rag_text_splitter.create_documents(
+            texts, [x | {"parent_id": id} for x, id in zip(metadatas, parent_ids)]
+        )
+    vectorstore: ChromaDDG = ChromaDDG.from_documents(
+        chunks,
+        embedding=embeddings,
+        client=client,
+        collection_name=f"parity-check-{uuid.uuid4().hex[:8]}",
+        create_if_not_exists=True,
+    )
+    fake_embeddings = [FAKE_FULL_DOC_EMBEDDING for _ in texts]
+    vectorstore.collection.add(parent_ids, fake_embeddings, metadatas, texts)
+    return vectorstore
+
+
+async def check_parity(retriever: RecordingChromaDDGRetriever) -> int:
+    num_mismatches = 0
+    for query in QUERIES:
+        docs_sync = retriever.invoke(query)
+        similarities_sync = retriever.last_similarities
+        docs_async = await retriever.ainvoke(query)
+        similarities_async = retriever.last_similarities
+
+        is_match = (
+            [(x.page_content, x.metadata) for x in docs_sync]
+            == [(x.page_content, x.metadata) for x in docs_async]
+            and similarities_sync == similarities_async
+        )
+        num_mismatches += not is_match
+        print(
+            f"{'OK      ' if is_match else 'MISMATCH'} {len(docs_sync)} docs, "
+            f"{sum(x.metadata.get('num_tokens', 0) for x in docs_sync)} tokens: {query}"
+        )
+    return num_mismatches
+
+
+def main():
+    use_offline_tokenizer()
+    embeddings = NormalizedFakeEmbedding(size=EMBEDDINGS_DIMENSIONS)
+    texts = [ai_news_1, openai_news, top_russian_desserts]
+    num_mismatches = 0
+    with tempfile.TemporaryDirectory() as db_dir:
+        client = PersistentClient(db_dir, settings=Settings(anonymized_telemetry=False))
+        for with_chunk_positions in [True, False]:
+            print(f"Collection {with_chunk_positions = }:")
+            vectorstore = create_collection(
+                client, embeddings, texts, with_chunk_positions
+            )
+            retriever = RecordingChromaDDGRetriever(
+                vectorstore=vectorstore,
+                search_type="similarity_ddg",
+                llm_for_token_counting=None,
+                # Fake embeddings give similarities near 0; keep more docs than k_min
+                score_threshold_min=-0.5,
+                score_threshold_max=0.0,
+            )
+            num_mismatches += asyncio.run(check_parity(retriever))
+
+    print(f"Done. Number of mismatches: {num_mismatches}")
+    sys.exit(1 if num_mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
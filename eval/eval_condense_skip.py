@@ -0,0 +1,278 @@
+"""
+Evaluation of the heuristic that decides whether a query needs to be condensed into a
+standalone query before retrieval (see utils/query_analysis.py).
+
+The evaluation set consists of follow-up queries on the topics in eval/queries.md, each
+labeled with whether it needs the chat history to be understood. A query that needs
+condensing but is not condensed (a "false skip") can hurt answer quality, so the number
+of false skips should stay at zero; the skip rate is what saves latency.
+
+With --llm, the condense-question chain is also run on each query (needs an OpenAI API
+key) to measure the latency of the LLM call that a skip saves and to show the standalone
+queries it generates for the skipped queries, for manual review.
+
+Run from the root of the repo with: python -m eval.eval_condense_skip [--llm]
+"""
+
+import sys
+import time
+
+from langchain.chains import LLMChain
+
+from _prepare_env import is_env_loaded
+from components.llm import get_llm
+from utils.prepare import DEFAULT_OPENAI_API_KEY
+from utils.prompts import CONDENSE_QUESTION_PROMPT
+from utils.query_analysis import check_if_query_needs_condensing
+from utils.type_utils import BotSettings
+
+is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
+
+# (previous query, previous answer, query, whether the query needs condensing)
+EVAL_SET = [
+    # AI-powered resume builders
+    (
+        "What are some AI-powered resume builders?",
+        "1. Kickresume\n2. Rezi\n3. Teal\n4. Enhancv\n5. Resume.io",
+        "Which of them are free?",
+        True,
+    ),
+    (
+        "What are some AI-powered resume builders?",
+        "1. Kickresume\n2. Rezi\n3. Teal\n4. Enhancv\n5. Resume.io",
+        "Does Kickresume have a free plan for students?",
+        False,
+    ),
+    (
+        "What are some AI-powered resume builders?",
+        "1. Kickresume\n2. Rezi\n3. Teal\n4. Enhancv\n5. Resume.io",
+        "Tell me more about the second one",
+        True,
+    ),
+    (
+        "What are some AI-powered resume builders?",
+        "1. Kickresume\n2. Rezi\n3. Teal\n4. Enhancv\n5. Resume.io",
+        "How do AI resume builders tailor a resume to a specific job posting?",
+        False,
+    ),
+    # Running llama2 locally
+    (
+        "How do I run llama2 locally?",
+        "You can use Ollama: install it and run `ollama run llama2`.",
+        "What are the hardware requirements?",
+        True,
+    ),
+    (
+        "How do I run llama2 locally?",
+        "You can use Ollama: install it and run `ollama run llama2`.",
+        "How much RAM do I need to run the 13B llama2 model locally?",
+        False,
+    ),
+    (
+        "How do I run llama2 locally?",
+        "You can use Ollama: install it and run `ollama run llama2`.",
+        "And on Windows?",
+        True,
+    ),
+    (
+        "How do I run llama2 locally?",
+        "You can use Ollama: install it and run `ollama run llama2`.",
+        "Can I use the Ollama installer without admin rights on a work laptop?",
+        True,  # "the Ollama installer" refers to the previous answer
+    ),
+    # Disqualifying Trump from running
+    (
+        "What are the legal arguments for disqualifying Trump from running?",
+        "The main argument is based on Section 3 of the 14th Amendment...",
+        "What are the arguments against it?",
+        True,
+    ),
+    (
+        "What are the legal arguments for disqualifying Trump from running?",
+        "The main argument is based on Section 3 of the 14th Amendment...",
+        "How did the Colorado Supreme Court rule on Trump's ballot eligibility?",
+        False,
+    ),
+    (
+        "What are the legal arguments for disqualifying Trump from running?",
+        "The main argument is based on Section 3 of the 14th Amendment...",
+        "Has this section ever been applied before?",
+        True,
+    ),
+    # Traditional Ukrainian dishes
+    (
+        "What are some unique traditional Ukrainian dishes?",
+        "Borscht, varenyky, holubtsi, deruny and salo are some examples.",
+        "How do you make varenyky with cherries?",
+        False,
+    ),
+    (
+        "What are some unique traditional Ukrainian dishes?",
+        "Borscht, varenyky, holubtsi, deruny and salo are some examples.",
+        "Which of these are vegetarian?",
+        True,
+    ),
+    (
+        "What are some unique traditional Ukrainian dishes?",
+        "Borscht, varenyky, holubtsi, deruny and salo are some examples.",
+        "recipe?",
+        True,
+    ),
+    (
+        "What are some unique traditional Ukrainian dishes?",
+        "Borscht, varenyky, holubtsi, deruny and salo are some examples.",
+        "What are some traditional Russian desserts made with cottage cheese?",
+        False,
+    ),
+    # Important AI research papers
+    (
+        "What are some important AI research papers?",
+        "Attention Is All You Need (2017) introduced the Transformer...",
+        "Who are the authors of the paper?",
+        True,
+    ),
+    (
+        "What are some important AI research papers?",
+        "Attention Is All You Need (2017) introduced the Transformer...",
+        "Summarize the main idea of the Transformer architecture in simple terms",
+        True,  # "the Transformer" was introduced in the previous answer
+    ),
+    (
+        "What are some important AI research papers?",
+        "Attention Is All You Need (2017) introduced the Transformer...",
+        "What is the difference between RLHF and DPO for aligning language models?",
+        False,
+    ),
+    # Recommended protein intake
+    (
+        "What do various organizations report as the recommended protein intake?",
+        "The RDA is 0.8 g per kg of body weight per day; for athletes...",
+        "Is that enough for older adults?",
+        True,
+    ),
+    (
+        "What do various organizations report as the recommended protein intake?",
+        "The RDA is 0.8 g per kg of body weight per day; for athletes...",
+        "What does the WHO recommend for protein intake during pregnancy?",
+        False,
+    ),
+    (
+        "What do various organizations report as the recommended protein intake?",
+        "The RDA is 0.8 g per kg of body weight per day; for athletes...",
+        "what about for kids",
+        True,
+    ),
+    # Firestore tutorial
+    (
+        "How do I configure Firestore so that my external server can use it?",
+        "Create a service account and grant it the Cloud Datastore User role...",
+        "Which role should I assign to the service account?",
+        True,
+    ),
+    (
+        "How do I configure Firestore so that my external server can use it?",
+        "Create a service account and grant it the Cloud Datastore User role...",
+        "How do I authenticate a Node.js server to Firestore with a key file?",
+        False,
+    ),
+    (
+        "How do I configure Firestore so that my external server can use it?",
+        "Create a service account and grant it the Cloud Datastore User role...",
+        "Should I ask for more details?",
+        True,
+    ),
+    # Noam Chomsky on ChatGPT
+    (
+        "Please find quotes by Noam Chomsky about the value of ChatGPT",
+        'In a 2023 NYT op-ed, Chomsky called ChatGPT "a lumbering statistical engine"',
+        "Where did he say that?",
+        True,
+    ),
+    (
+        "Please find quotes by Noam Chomsky about the value of ChatGPT",
+        'In a 2023 NYT op-ed, Chomsky called ChatGPT "a lumbering statistical engine"',
+        "What did Gary Marcus say about large language models and reasoning?",
+        False,
+    ),
+    (
+        "Please find quotes by Noam Chomsky about the value of ChatGPT",
+        'In a 2023 NYT op-ed, Chomsky called ChatGPT "a lumbering statistical engine"',
+        "Can you give me the link to the op-ed?",
+        True,
+    ),
+    # text-embedding-ada-002 embeddings
+    (
+        "What is the typical range for the 1536 values in the ada-002 embeddings?",
+        "Most values lie roughly between -0.1 and 0.1, and the vectors are normalized.",
+        "Why are they normalized?",
+        True,
+    ),
+    (
+        "What is the typical range for the 1536 values in the ada-002 embeddings?",
+        "Most values lie roughly between -0.1 and 0.1, and the vectors are normalized.",
+        "How many dimensions does text-embedding-3-large produce by default?",
+        False,
+    ),
+    (
+        "What is the typical range for the 1536 values in the ada-002 embeddings?",
+        "Most values lie roughly between -0.1 and 0.1, and the vectors are normalized.",
+        "Would you like me to compare them with the text-embedding-3 models?",
+        True,
+    ),
+    (
+        "What is the typical range for the 1536 values in the ada-002 embeddings?",
+        "Should I also explain how cosine similarity is computed for them?",
+        "Yes please, with a numeric example",
+        True,
+    ),
+]
+
+
+def get_llm_condense_chain() -> LLMChain:
+    llm = get_llm(BotSettings(temperature=0), api_key=DEFAULT_OPENAI_API_KEY)
+    return LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
+
+
+def main():
+    use_llm = "--llm" in sys.argv[1:]
+    condense_chain = get_llm_condense_chain() if use_llm else None
+
+    num_skipped, num_false_skips, num_needless_condenses = 0, 0, 0
+    condense_times = []
+    for prev_query, prev_answer, query, expected in EVAL_SET:
+        needs_condensing, reason = check_if_query_needs_condensing(
+            query, [(prev_query, prev_answer)]
+        )
+        num_skipped += not needs_condensing
+        num_false_skips += expected and not needs_condensing
+        num_needless_condenses += needs_condensing and not expected
+
+        label = "condense" if needs_condensing else "SKIP    "
+        is_error = needs_condensing != expected
+        print(f"{'ERROR ' if is_error else 'OK    '}{label} ({reason}): {query}")
+
+        if condense_chain is not None:
+            chat_history = f"Human: {prev_query}\nAssistant: {prev_answer}"
+            t_start = time.perf_counter()
+            standalone_query = condense_chain.invoke(
+                {"question": query, "chat_history": chat_history}
+            )["text"]
+            condense_times.append(time.perf_counter() - t_start)
+            if not needs_condensing:
+                print(f"    LLM's standalone query: {standalone_query}")
+
+    num_queries = len(EVAL_SET)
+    print(f"\nSkip rate: {num_skipped}/{num_queries} ({num_skipped / num_queries:.0%})")
+    print(f"False skips (needed condensing but skipped): {num_false_skips}")
+    print(f"Needless condenses (could have been skipped): {num_needless_condenses}")
+    if condense_times:
+        avg_time = sum(condense_times) / len(condense_times)
+        print(
+            f"Avg condense time: {avg_time:.2f}s, "
+            f"est. latency saved per query: {avg_time * num_skipped / num_queries:.2f}s"
+        )
+    sys.exit(1 if num_false_skips else 0)
+
+
+if __name__ == "__main__":
+    main()
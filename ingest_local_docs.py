@@ -4,7 +4,7 @@ import sys
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 
 from _prepare_env import is_env_loaded
-from components.chroma_ddg import initialize_client
+from components.chroma_ddg import chroma_client_pool
 from utils.docgrab import (
     JSONLDocumentLoader,
     ingest_into_chroma,
@@ -83,7 +83,7 @@ if __name__ == "__main__":
             clear_directory(VECTORDB_DIR)
             print("Done!")
         else:
-            chroma_client = initialize_client(use_chroma_via_http=False)
+            chroma_client = chroma_client_pool.get_client(use_chroma_via_http=False)
             collections = chroma_client.list_collections()
             collection_names = [c.name for c in collections]
             if COLLECTON_NAME_FOR_INGESTED_DOCS in collection_names:
@@ -80,6 +80,7 @@ if "chat_state" not in ss:
     is_env_loaded = is_env_loaded  # more info at the end of docdocgo.py
 
 chat_state: ChatState = ss.chat_state
+chat_state.flush_collection_metadata()  # don't reuse metadata loaded on previous run
 
 # Update the query params if scheduled on previous run
 update_url_if_scheduled()
@@ -1,5 +1,5 @@
 from itertools import zip_longest
-from typing import Any, Iterable, Iterator
+from typing import Any, Hashable, Iterable, Iterator
 
 
 def interleave_iterables(iterables: Iterable[Iterable[Any]]) -> Iterator[Any]:
@@ -54,3 +54,33 @@ def insert_interval(
     # If we're here, the new/merged interval is the last one
     new_intervals.append((new_interval_start, new_interval_end))
     return new_intervals
+
+
+def get_jaccard_similarity(set1: set, set2: set) -> float:
+    """
+    Get the Jaccard similarity of two sets (the size of their intersection divided by
+    the size of their union). Two empty sets are considered identical.
+    """
+    if not set1 and not set2:
+        return 1.0
+    return len(set1 & set2) / len(set1 | set2)
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[Iterable[Hashable]], k: int = 60
+) -> list[tuple[Hashable, float]]:
+    """
+    Fuse several rankings (each an iterable of distinct items, best first) into one
+    using reciprocal rank fusion: each item gets the sum of 1 / (k + rank) over the
+    rankings it appears in (with ranks starting at 1). Returns the items with their
+    fused scores, best first (ties are broken by order of first appearance).
+
+    Example:
+    >>> reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=1)
+    [('b', 0.8333333333333333), ('a', 0.5), ('d', 0.3333333333333333), ('c', 0.25)]
+    """
+    scores: dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
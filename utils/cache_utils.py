@@ -0,0 +1,183 @@
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from pydantic import BaseModel
+
+
+class CacheStats(BaseModel):
+    name: str
+    hits: int = 0
+    misses: int = 0
+    num_items: int = 0
+    size: int = 0
+    max_size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / ((self.hits + self.misses) or 1)
+
+
+class SQLiteStore:
+    """
+    Simple persistent key-value store in an SQLite table, with string keys and
+    JSON-serializable values. Thread-safe; can be shared by several processes.
+    """
+
+    def __init__(self, path: str, table: str = "cache"):
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value for the key, or the default if it's not in the store."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """Add or replace an item."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its items, as measured by the
+    get_size function (by default, each item has size 1, i.e. the number of items is
+    bounded). Keeps hit/miss counters. Meant to be shared across requests in one worker.
+
+    Optionally backed by a persistent store (e.g. SQLiteStore), which is checked on a
+    miss and written to on every put; items found there count as hits.
+
+    Cached values are returned as is, so they should be treated as immutable.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        get_size: Callable[[Any], int] = lambda x: 1,
+        name: str = "cache",
+        backing_store: SQLiteStore | None = None,
+    ):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.name = name
+        self.backing_store = backing_store
+        self._items: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value for the key, or the default if it's not in the cache."""
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                if self.backing_store is None:
+                    self._misses += 1
+                    return default
+            else:
+                self._items.move_to_end(key)
+                self._hits += 1
+                return value
+
+        # Not in memory, check the backing store
+        sentinel = object()
+        value = self.backing_store.get(key, sentinel)
+        if value is sentinel:
+            with self._lock:
+                self._misses += 1
+            return default
+        self._put_in_memory(key, value)
+        with self._lock:
+            self._hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Add or replace an item, evicting least recently used items if needed."""
+        self._put_in_memory(key, value)
+        if self.backing_store is not None:
+            self.backing_store.put(key, value)
+
+    def _put_in_memory(self, key: Hashable, value: Any) -> None:
+        size = self.get_size(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return  # too big to cache
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove an item from memory and return its value (or the default if it's not
+        cached). The backing store, if any, is left as is.
+        """
+        with self._lock:
+            return self._pop(key, default)
+
+    def clear(self) -> None:
+        """
+        Remove all items from memory (the hit/miss counters and the backing store,
+        if any, are kept).
+        """
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def get_stats(self) -> CacheStats:
+        """Get the hit/miss counters and current size of the cache."""
+        with self._lock:
+            return CacheStats(
+                name=self.name,
+                hits=self._hits,
+                misses=self._misses,
+                num_items=len(self._items),
+                size=self._size,
+                max_size=self.max_size,
+            )
+
+    def _pop(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            return default
+        self._size -= size
+        return value
+
+
+attached_caches_lock = threading.Lock()
+
+
+def get_attached_cache(owner: Any, name: str, create: Callable[[], Any]) -> Any:
+    """
+    Get the cache (or other object) attached to the owner object (e.g. a chroma client)
+    under the given name, creating it with create() on first use. Unlike a cache kept
+    in a global dict keyed by id(owner), it lives exactly as long as its owner, so it
+    can't be handed to a new object that happens to get the same id.
+    """
+    attr_name = f"_ddg_{name}"
+    if (cache := getattr(owner, attr_name, None)) is None:
+        with attached_caches_lock:
+            if (cache := getattr(owner, attr_name, None)) is None:
+                cache = create()
+                setattr(owner, attr_name, cache)
+    return cache
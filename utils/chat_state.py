@@ -8,18 +8,38 @@ from agents.researcher_data import ResearchReportData
 from components.chroma_ddg import (
     ChromaDDG,
     CollectionDoesNotExist,
+    CollectionMetadataSession,
+    cache_permitted_access_role,
+    get_cached_permitted_access_role,
     get_vectorstore_using_openai_api_key,
+    invalidate_cached_access_roles,
+)
+from components.collection_catalog import (
+    CatalogEntry,
+    CollectionCatalog,
+    get_collection_catalog,
 )
 from components.llm import get_prompt_llm_chain
+from components.research_state_store import (
+    ResearchStateNotFoundError,
+    ResearchStateStore,
+    get_research_state_store,
+)
 from utils.helpers import (
     PRIVATE_COLLECTION_PREFIX,
     PRIVATE_COLLECTION_USER_ID_LENGTH,
     get_timestamp,
 )
-from utils.prepare import DEFAULT_COLLECTION_NAME, get_logger
+from utils.prepare import (
+    DEFAULT_COLLECTION_NAME,
+    EVICT_UNUSED_LINK_TEXTS,
+    RESEARCH_STATE_COLLECTION_NAME,
+    get_logger,
+)
 from utils.query_parsing import ParsedQuery
 from utils.type_utils import (
     COLLECTION_USERS_METADATA_KEY,
+    RR_DATA_RECORD_ID_METADATA_KEY,
     AccessCodeSettings,
     AccessRole,
     BotSettings,
@@ -94,6 +114,7 @@ class ChatState:
         self.chat_history = chat_history or []  # tuple of (user_message, bot_response)
         self.chat_history_all = chat_and_command_history or []
         self.sources_history = sources_history or []  # used only in Streamlit for now
+        self._metadata_session: CollectionMetadataSession | None = None
         self.vectorstore = vectorstore
         self.callbacks = callbacks
         self.add_to_output = add_to_output or (
@@ -108,6 +129,19 @@ class ChatState:
         self.uploaded_docs = uploaded_docs or []
         self.session_data = session_data or {}
 
+    @property
+    def vectorstore(self) -> ChromaDDG:
+        return self._vectorstore
+
+    @vectorstore.setter
+    def vectorstore(self, vectorstore: ChromaDDG) -> None:
+        # Switching collections: save the pending changes to the previous collection's
+        # metadata first (the new collection gets its own metadata session)
+        if self._metadata_session is not None:
+            if self._metadata_session.vectorstore is not vectorstore:
+                self.flush_collection_metadata()
+        self._vectorstore = vectorstore
+
     @property
     def collection_name(self) -> str:
         return self.vectorstore.name
@@ -133,40 +167,72 @@ class ChatState:
             setattr(self, k, v)
 
     def get_all_collections(self) -> list[Collection]:
-        """Get all collections."""
-        return self.db_client.list_collections()
+        """Get all collections (except for the research state store)."""
+        return [
+            c
+            for c in self.db_client.list_collections()
+            if c.name != RESEARCH_STATE_COLLECTION_NAME
+        ]
+
+    @property
+    def collection_catalog(self) -> CollectionCatalog:
+        return get_collection_catalog(self.db_client)
 
-    def get_user_collections(self) -> list[Collection]:
+    def get_user_collections_scope(self) -> tuple[str | None, set[str]]:
         """
-        Get the accessible collections for the current user.
+        Get the owner prefix and the names of the extra collections that make up the
+        accessible collections for the current user (see CollectionCatalog).
         """
-        collections = self.db_client.list_collections()  # TODO: here and elsewhere,
-        # introduce limit and offset for pagination when there are many collections
         cached_accessible_coll_names = {
             coll_name
             for coll_name in self._access_role_by_user_id_by_coll.keys()
             if self.get_cached_access_role(coll_name).value > AccessRole.NONE.value
-        }  # some may have been deleted or renamed but that's taken care of below
-
-        if self.user_id:
-            short_user_id = self.user_id[-PRIVATE_COLLECTION_USER_ID_LENGTH:]
-            prefix = PRIVATE_COLLECTION_PREFIX + short_user_id
-
-            cached_accessible_coll_names.add(DEFAULT_COLLECTION_NAME)  # for efficiency
-            filtered_collections = [
-                c
-                for c in collections
-                if c.name.startswith(prefix) or c.name in cached_accessible_coll_names
-            ]
-        else:
-            filtered_collections = [
-                c
-                for c in collections
-                if not c.name.startswith(PRIVATE_COLLECTION_PREFIX)
-                or c.name in cached_accessible_coll_names
-            ]
+        }  # some may have been deleted or renamed but the catalog skips those
+
+        if not self.user_id:
+            return None, cached_accessible_coll_names  # None = public collections
+
+        short_user_id = self.user_id[-PRIVATE_COLLECTION_USER_ID_LENGTH:]
+        cached_accessible_coll_names.add(DEFAULT_COLLECTION_NAME)
+        return PRIVATE_COLLECTION_PREFIX + short_user_id, cached_accessible_coll_names
 
-        return filtered_collections
+    def get_user_collections(
+        self,
+        offset: int = 0,
+        limit: int | None = None,
+        prefix: str | None = None,
+        substring: str | None = None,
+    ) -> list[CatalogEntry]:
+        """
+        Get the accessible collections for the current user (the default collection
+        first, then the most recently updated ones), starting from the given offset.
+        If prefix or substring is provided, only get the collections whose names as
+        shown start with the prefix or contain the substring (with their indexes in
+        the full list).
+        """
+        owner_prefix, extra_names = self.get_user_collections_scope()
+        if prefix is None and substring is None:
+            return self.collection_catalog.list_collections(
+                owner_prefix, extra_names, offset=offset, limit=limit
+            )
+        return self.collection_catalog.search(
+            owner_prefix,
+            extra_names,
+            prefix=prefix,
+            substring=substring or "",
+            offset=offset,
+            limit=limit,
+        )
+
+    def count_user_collections(self) -> int:
+        """Get the number of accessible collections for the current user."""
+        return self.collection_catalog.count(*self.get_user_collections_scope())
+
+    def is_user_collection(self, coll_name: str) -> bool:
+        """Check if the collection is among the current user's accessible ones."""
+        return self.collection_catalog.is_listed(
+            coll_name, *self.get_user_collections_scope()
+        )
 
     def fetch_collection_metadata(self, coll_name: str | None = None) -> Props | None:
         """
@@ -174,7 +240,7 @@ class ChatState:
         collection name if provided. If the collection does not exist, returns None.
         """
         if coll_name in (None, self.vectorstore.name):
-            return self.vectorstore.fetch_collection_metadata()
+            return self.metadata_session.get_metadata()
         elif tmp_vectorstore := self.get_new_vectorstore(
             coll_name, create_if_not_exists=False
         ):
@@ -184,89 +250,129 @@ class ChatState:
         else:
             return None  # redundant but for clarity
 
+    @property
+    def metadata_session(self) -> CollectionMetadataSession:
+        """
+        The metadata session for the currently selected collection (when switching
+        collections, the previous collection's session is flushed by the vectorstore
+        setter).
+        """
+        if self._metadata_session is None:
+            self._metadata_session = CollectionMetadataSession(self.vectorstore)
+        return self._metadata_session
+
+    @property
+    def has_unsaved_metadata_changes(self) -> bool:
+        """Check if there are changes to the collection's metadata not saved yet."""
+        return self._metadata_session is not None and self._metadata_session.is_dirty
+
+    def flush_collection_metadata(self) -> None:
+        """
+        Save the pending changes to the currently selected collection's metadata in
+        one write (should be called at the end of each request). The metadata will be
+        reloaded from the database the next time it's needed.
+        """
+        if (session := self._metadata_session) is not None:
+            self._metadata_session = None
+            session.flush(get_timestamp())
+
     def get_cached_collection_metadata(self) -> Props | None:
-        return self.vectorstore.get_cached_collection_metadata()
+        return self.metadata_session.get_metadata()
 
-    def get_collection_metadata(
-        self, use_cached_metadata: bool = False
-    ) -> Props | None:
+    def get_collection_metadata(self) -> Props | None:
         """
-        Get the metadata for the currently selected collection, either from the cache
-        or by fetching it from the database, depending on the value of use_cached_metadata.
+        Get the metadata for the currently selected collection, including changes not
+        saved yet. It's loaded once per request (see metadata_session).
         """
-        return (
-            self.vectorstore.get_cached_collection_metadata()
-            if use_cached_metadata
-            else self.vectorstore.fetch_collection_metadata()
-        )
+        return self.metadata_session.get_metadata()
 
     def save_collection_metadata(self, metadata: Props) -> None:
         """
-        Update the metadata for the currently selected collection
+        Update the metadata for the currently selected collection. The changes are
+        saved (and "updated_at" is set) by flush_collection_metadata.
         """
-        metadata["updated_at"] = get_timestamp()
-        self.vectorstore.save_collection_metadata(metadata)
+        self.metadata_session.update(metadata)
 
-    def get_agent_data(self, use_cached_metadata: bool = False) -> AgentDataDict:
+    def get_agent_data(self) -> AgentDataDict:
         """
         Extract agent data from the currently selected collection's metadata
         """
         try:
-            agent_data = self.get_collection_metadata(use_cached_metadata)["agent_data"]
+            agent_data = self.get_collection_metadata()["agent_data"]
             return json.loads(agent_data)
         except (TypeError, KeyError):
             return {}
 
-    def save_agent_data(
-        self, agent_data: AgentDataDict, use_cached_metadata: bool = False
-    ) -> None:
+    def save_agent_data(self, agent_data: AgentDataDict) -> None:
         """
         Update the currently selected collection's metadata with the given agent data
         """
         # NOTE: currently, agent_data is assumed to be able to have only one key at
-        # a time for a given collection, such as "hs" or "rr".
-        coll_metadata = self.get_collection_metadata(use_cached_metadata) or {}
+        # a time for a given collection, such as "hs_id".
+        coll_metadata = self.get_collection_metadata() or {}
         coll_metadata["agent_data"] = json.dumps(agent_data)
         self.save_collection_metadata(coll_metadata)
 
-    def get_rr_data(
-        self, use_cached_metadata: bool = False
-    ) -> ResearchReportData | None:
+    @property
+    def research_state_store(self) -> ResearchStateStore:
+        return get_research_state_store(self.db_client)
+
+    def get_rr_data(self) -> ResearchReportData | None:
         """
-        Extract ResearchReportData from the currently selected collection's metadata
+        Get the currently selected collection's ResearchReportData from the research
+        state store (or from the collection's metadata, for older collections). The
+        texts of the links are loaded when needed (see ResearchReportData.load_link_texts).
         """
         logger.info("Getting rr_data")
-        coll_metadata = self.get_collection_metadata(use_cached_metadata)
-        try:
-            rr_data_json = coll_metadata["rr_data"]
-        except (TypeError, KeyError):
+        coll_metadata = self.get_collection_metadata() or {}
+        if rr_data_json := coll_metadata.get("rr_data"):
+            return ResearchReportData.model_validate_json(rr_data_json)  # older style
+        if (record_id := coll_metadata.get(RR_DATA_RECORD_ID_METADATA_KEY)) is None:
             logger.info("No rr_data found")
             return None
+
+        # The collection has research data, so failing to load it is an error (rather
+        # than a sign of a normal collection, which could get a new record on save)
+        try:
+            rr_data_dict = self.research_state_store.load_state(record_id)
+            if rr_data_dict is None:
+                raise ResearchStateNotFoundError(
+                    f"Research state record {record_id} not found"
+                )
+            rr_data = ResearchReportData.model_validate(rr_data_dict)
+        except Exception as e:
+            logger.error(f"Could not load research state record {record_id}: {e}")
+            raise
+        rr_data._link_text_loader = self.research_state_store.load_link_texts
         logger.info("rr_data retrieved.")
-        return ResearchReportData.model_validate_json(rr_data_json)
+        return rr_data
 
-    def save_rr_data(
-        self, rr_data: ResearchReportData, use_cached_metadata: bool = False
-    ) -> None:
+    def save_rr_data(self, rr_data: ResearchReportData) -> None:
         """
-        Update the currently selected collection's metadata with the given ResearchReportData
+        Save the given ResearchReportData for the currently selected collection in the
+        research state store (only link texts that are not stored yet are written).
         """
-        coll_metadata = self.get_collection_metadata(use_cached_metadata) or {}
-        coll_metadata["rr_data"] = rr_data.model_dump_json()
-        self.save_collection_metadata(coll_metadata)
+        if EVICT_UNUSED_LINK_TEXTS:
+            rr_data.evict_unused_link_texts()
+        coll_metadata = self.get_collection_metadata() or {}
+        record_id = self.research_state_store.save_state(
+            rr_data,
+            rr_data.link_data_dict.values(),
+            record_id=coll_metadata.get(RR_DATA_RECORD_ID_METADATA_KEY),
+        )
+        self.save_collection_metadata(
+            {"rr_data": None, RR_DATA_RECORD_ID_METADATA_KEY: record_id}
+        )  # "rr_data" may be there from older versions
 
     def get_collection_permissions(
-        self, coll_name: str | None = None, use_cached_metadata: bool = False
+        self, coll_name: str | None = None
     ) -> CollectionPermissions:
         """
         Get the collection user settings from the currently selected collection's
         metadata, or from the given collection name if provided
         """
         try:
-            if use_cached_metadata and coll_name is None:
-                coll_metadata = self.get_cached_collection_metadata()
-            else:
-                coll_metadata = self.fetch_collection_metadata(coll_name)
+            coll_metadata = self.fetch_collection_metadata(coll_name)
             collection_permissions_json = coll_metadata[COLLECTION_USERS_METADATA_KEY]
             logger.info(f"Permissions for {coll_name}:\n{collection_permissions_json}")
         except (TypeError, KeyError):
@@ -274,83 +380,96 @@ class ChatState:
         return CollectionPermissions.model_validate_json(collection_permissions_json)
 
     def save_collection_permissions(
-        self,
-        collection_permissions: CollectionPermissions,
-        use_cached_metadata: bool = False,
+        self, collection_permissions: CollectionPermissions
     ) -> None:
         """
         Update the currently selected collection's metadata with the given CollectionUsers
         """
-        coll_metadata = self.get_collection_metadata(use_cached_metadata) or {}
+        coll_metadata = self.get_collection_metadata() or {}
         json_str = collection_permissions.model_dump_json()
         coll_metadata[COLLECTION_USERS_METADATA_KEY] = json_str
         self.save_collection_metadata(coll_metadata)
+        invalidate_cached_access_roles(self.db_client, self.collection_name)
+
+    def get_permitted_access_role(
+        self, coll_name: str | None = None, access_code: str | None = None
+    ) -> AccessRole:
+        """
+        Get the access role that the permissions of the currently selected collection,
+        or of the given collection if provided, give the current user or the given
+        access code (whichever is higher). Uses the worker-wide access role cache.
+        """
+        coll_name = coll_name or self.collection_name
+        if (
+            access_role := get_cached_permitted_access_role(
+                self.db_client, coll_name, self.user_id, access_code
+            )
+        ) is not None:
+            return access_role
+
+        collection_permissions = self.get_collection_permissions(coll_name)
+        access_role = max(
+            collection_permissions.get_user_settings(self.user_id).access_role,
+            collection_permissions.get_access_code_settings(access_code).access_role,
+            key=lambda x: x.value,
+        )
+
+        # Don't cache roles based on permissions that haven't been saved yet
+        if coll_name != self.collection_name or not self.metadata_session.is_dirty:
+            cache_permitted_access_role(
+                self.db_client, coll_name, self.user_id, access_code, access_role
+            )
+        return access_role
 
     def get_collection_settings_for_user(
         self,
         user_id: str | None,
         coll_name: str | None = None,
-        use_cached_metadata: bool = False,
     ) -> CollectionUserSettings:
         """
         Get the collection user settings for the given user from the currently selected collection's
         metadata, or from the specified collection
         """
-        return self.get_collection_permissions(
-            coll_name, use_cached_metadata=use_cached_metadata
-        ).get_user_settings(user_id)
+        return self.get_collection_permissions(coll_name).get_user_settings(user_id)
 
     def save_collection_settings_for_user(
         self,
         user_id: str | None,
         settings: CollectionUserSettings,
-        use_cached_metadata: bool = False,
     ) -> None:
         """
         Update the currently selected collection's metadata with the given CollectionUserSettings
         """
-        collection_permissions = self.get_collection_permissions(
-            use_cached_metadata=use_cached_metadata
-        )
+        collection_permissions = self.get_collection_permissions()
         collection_permissions.set_user_settings(user_id, settings)
-        self.save_collection_permissions(
-            collection_permissions,
-            use_cached_metadata=True,  # since we just fetched it
-        )
+        self.save_collection_permissions(collection_permissions)
 
     def get_access_code_settings(
         self,
         access_code: str,
         coll_name: str | None = None,
-        use_cached_metadata: bool = False,
     ) -> AccessCodeSettings:
         """
         Get the access code settings from the currently selected collection's metadata,
         or from the specified collection
         """
-        return self.get_collection_permissions(
-            coll_name, use_cached_metadata=use_cached_metadata
-        ).get_access_code_settings(access_code)
+        return self.get_collection_permissions(coll_name).get_access_code_settings(
+            access_code
+        )
 
     def save_access_code_settings(
         self,
         access_code: str,
         access_code_settings: AccessCodeSettings,
-        use_cached_metadata: bool = False,
     ) -> None:
         """
         Update the currently selected collection's metadata with the given AccessCodeSettings
         """
-        collection_permissions = self.get_collection_permissions(
-            use_cached_metadata=use_cached_metadata
-        )
+        collection_permissions = self.get_collection_permissions()
         collection_permissions.set_access_code_settings(
             access_code, access_code_settings
         )
-        self.save_collection_permissions(
-            collection_permissions,
-            use_cached_metadata=True,  # since we just fetched it
-        )
+        self.save_collection_permissions(collection_permissions)
 
     def get_cached_access_role(self, coll_name: str | None = None) -> AccessRole:
         """
@@ -393,13 +512,13 @@ class ChatState:
         """
         Get a new ChromaDDG instance with the given collection name. If the collection
         does not exist, either returns None or creates a new collection, depending on
-        the value of create_if_not_exists (default: True).
+        the value of create_if_not_exists (default: True). Uses the shared client from
+        chroma_client_pool.
         """
         try:
             res = get_vectorstore_using_openai_api_key(
                 collection_name,
                 openai_api_key=self.openai_api_key,
-                client=self.vectorstore.client,
                 create_if_not_exists=create_if_not_exists,
             )
         except CollectionDoesNotExist:
@@ -6,10 +6,11 @@ from chromadb import ClientAPI
 from dotenv import load_dotenv
 from langchain_community.document_loaders import GitbookLoader
 
-from components.chroma_ddg import ChromaDDG
+from components.chroma_ddg import ChromaDDG, chroma_client_pool
 from components.openai_embeddings_ddg import get_openai_embeddings
-from utils.prepare import EMBEDDINGS_DIMENSIONS, get_logger
-from utils.rag import rag_text_splitter
+from utils.lang_utils import split_text_into_token_chunks
+from utils.prepare import CHUNKING_MODE, EMBEDDINGS_DIMENSIONS, get_logger
+from utils.rag import split_text_into_positioned_chunks
 from langchain_core.documents import Document
 
 load_dotenv(override=True)
@@ -53,25 +54,27 @@ def prepare_chunks(
     texts: list[str], metadatas: list[dict], ids: list[str]
 ) -> list[Document]:
     """
-    Split documents into chunks and add parent ids to the chunks' metadata.
+    Split documents into chunks and add parent ids to the chunks' metadata, along with
+    each chunk's position in its parent (see split_text_into_positioned_chunks).
+    If CHUNKING_MODE is "tokens", the documents are split on token boundaries and each
+    chunk's token count is recorded too (see split_text_into_token_chunks).
     Returns a list of snippets (each is a Document).
 
     It is ok to pass an empty list of texts.
     """
     logger.info(f"Splitting {len(texts)} documents into chunks...")
 
-    # Add parent ids to metadata (will delete, but only after it they propagate to snippets)
-    for metadata, id in zip(metadatas, ids):
-        metadata["parent_id"] = id
-
-    # Split into snippets
-    snippets = rag_text_splitter.create_documents(texts, metadatas)
+    # Split into snippets (the metadata is copied, so the original is not modified)
+    split = (
+        split_text_into_token_chunks
+        if CHUNKING_MODE == "tokens"
+        else split_text_into_positioned_chunks
+    )
+    snippets = []
+    for text, metadata, id in zip(texts, metadatas, ids):
+        snippets.extend(split(text, metadata | {"parent_id": id}))
     logger.info(f"Obtained {len(snippets)} chunks.")
 
-    # Restore original metadata
-    for metadata in metadatas:
-        del metadata["parent_id"]
-
     return snippets
 
 
@@ -95,10 +98,22 @@ def ingest_into_chroma(
     If collection_metadata is passed and the collection exists, the metadata will be
     replaced with the passed metadata, according to the Chroma docs.
 
+    The documents are saved using chroma_client if passed, otherwise using the shared
+    client from chroma_client_pool for the database in save_dir (if passed) or for the
+    configured database.
+
     NOTE: Normally, the higher level agentblocks.collectionhelper.ingest_into_collection 
     should be used, which creates/updates the "created_at" and "updated_at" metadata fields.
     """
-    assert bool(chroma_client) != bool(save_dir), "Invalid vector db destination"
+    assert not (chroma_client and save_dir), "Invalid vector db destination"
+    if not chroma_client:
+        chroma_client = (
+            chroma_client_pool.get_client(
+                use_chroma_via_http=False, persist_directory=save_dir
+            )
+            if save_dir
+            else chroma_client_pool.get_client()
+        )
 
     # Handle special case of no docs - just create/update collection with given metadata
     if not docs:
@@ -170,6 +170,8 @@ Other prefixes:
 
 - `/details <your query>`: get details about the retrieved documents
 - `/quotes <your query>`: get quotes from the retrieved documents
+- `/kb --collections coll1,ingested-content-* <your query>`: chat using several
+  collections at once (a trailing `*` matches all collections with that prefix)
 - `/web <your query>`: perform web searches and generate a report without ingesting
 - `/chat <your query>`: regular chat, without retrieving docs or websites
 - `/export`: export your data
@@ -1,19 +1,61 @@
+import hashlib
+import re
+import threading
 from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+from math import ceil
+from typing import Any, Callable
+
+import tiktoken
+
 from langchain_core.documents import Document
-from langchain_openai import ChatOpenAI
 
 from utils.algo import insert_interval
-from utils.async_utils import execute_func_map_in_threads
+from utils.cache_utils import LRUCache, SQLiteStore
 from utils.output import ConditionalLogger
-from utils.prepare import get_logger
-from utils.rag import rag_text_splitter
+from utils.prepare import (
+    CHAT_TOKEN_COUNT_CACHE_DB_PATH,
+    CHAT_TOKEN_COUNT_CACHE_MAX_ITEMS,
+    CHUNK_OVERLAP_TOKENS,
+    CHUNK_SIZE_TOKENS,
+    MODEL_NAME,
+    TOKEN_COUNT_CACHE_MAX_ITEMS,
+    TOKENIZER_PROCESS_POOL_MIN_CHARS,
+    TOKENIZER_PROCESS_POOL_WORKERS,
+    get_logger,
+)
+from utils.rag import join_contiguous_chunks, split_text_into_positioned_chunks
 from utils.type_utils import PairwiseChatHistory
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, get_buffer_string
 
 logger = get_logger()
 
-default_llm_for_token_counting = ChatOpenAI(api_key="DUMMY")  # "DUMMY" to avoid error
+# Tiktoken encodings by model name, resolved when first needed (or preloaded at startup,
+# see preload_tiktoken_encodings) and shared across the process
+tiktoken_encodings_by_model_name: dict[str, tiktoken.Encoding] = {}
+tiktoken_encodings_lock = threading.Lock()
+
+# Token counts of chat message pairs, shared across requests (in the API, the client
+# re-sends the whole chat history with each message)
+chat_pair_token_count_cache = LRUCache(
+    max_size=CHAT_TOKEN_COUNT_CACHE_MAX_ITEMS,
+    name="chat pair token counts",
+    backing_store=SQLiteStore(CHAT_TOKEN_COUNT_CACHE_DB_PATH, "chat_pair_token_counts")
+    if CHAT_TOKEN_COUNT_CACHE_DB_PATH
+    else None,
+)
+
+# Token counts of texts, shared across requests. Only texts of at least
+# MIN_CHARS_TO_CACHE_TOKEN_COUNT characters are cached: for shorter texts, hashing
+# and cache bookkeeping would cost about as much as tokenizing.
+token_count_cache = LRUCache(max_size=TOKEN_COUNT_CACHE_MAX_ITEMS, name="token counts")
+MIN_CHARS_TO_CACHE_TOKEN_COUNT = 256
+
+# Created when first needed (see get_num_tokens_in_texts)
+tokenizer_process_pool: ProcessPoolExecutor | None = None
+tokenizer_process_pool_lock = threading.Lock()
 
 ## https://gptforwork.com/guides/openai-gpt3-tokens
 # English: 1 word ≈ 1.3 tokens
@@ -29,35 +71,176 @@ default_llm_for_token_counting = ChatOpenAI(api_key="DUMMY")  # "DUMMY" to avoid
 ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN = 4  # English: 1 word ≈ 1.3 tokens
 
 
+def get_model_name_for_token_counting(
+    llm_for_token_counting: BaseLanguageModel | None = None,
+) -> str:
+    """
+    Get the name of the model whose tokenizer should be used to count tokens for an llm
+    (by default, for the default model).
+    """
+    if llm_for_token_counting is None:
+        return MODEL_NAME
+    return (
+        getattr(llm_for_token_counting, "tiktoken_model_name", None)
+        or getattr(llm_for_token_counting, "model_name", None)
+        or MODEL_NAME
+    )
+
+
+def get_tiktoken_encoding_for_model(model_name: str) -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding for a model. It's resolved once per model name and cached
+    for the whole process. Falls back to the encoding of the model's family (the same
+    way ChatOpenAI does) if tiktoken doesn't know the model.
+    """
+    try:
+        return tiktoken_encodings_by_model_name[model_name]
+    except KeyError:
+        pass
+
+    with tiktoken_encodings_lock:
+        tiktoken_encoding = tiktoken_encodings_by_model_name.get(model_name)
+        if tiktoken_encoding is not None:
+            return tiktoken_encoding
+        try:
+            tiktoken_encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            is_o200k = model_name.startswith("gpt-4o") or model_name.startswith("gpt-4.1")
+            tiktoken_encoding = tiktoken.get_encoding(
+                "o200k_base" if is_o200k else "cl100k_base"
+            )
+        tiktoken_encodings_by_model_name[model_name] = tiktoken_encoding
+        return tiktoken_encoding
+
+
+def get_tiktoken_encoding(
+    llm_for_token_counting: BaseLanguageModel | None = None,
+) -> tiktoken.Encoding:
+    """Get the tiktoken encoding used by an llm (by default, by the default model)."""
+    return get_tiktoken_encoding_for_model(
+        get_model_name_for_token_counting(llm_for_token_counting)
+    )
+
+
+def preload_tiktoken_encodings(model_names: list[str]) -> None:
+    """
+    Load the tiktoken encodings for the given models into the process-wide registry, so
+    that the first request doesn't have to wait for them to be loaded (or downloaded).
+    """
+    for model_name in model_names:
+        try:
+            get_tiktoken_encoding_for_model(model_name)
+        except Exception as e:
+            logger.warning(f"Could not preload the tokenizer for {model_name}: {e}")
+
+
+def get_token_count_cache_key(text: str, tiktoken_encoding: tiktoken.Encoding) -> str:
+    """Get the key for the token count of a text in a token count cache."""
+    text_hash = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+    return f"{tiktoken_encoding.name}:{text_hash}"
+
+
 def get_token_ids(text: str, llm_for_token_counting: BaseLanguageModel | None = None):
     """Get the token IDs for a text."""
-    llm = llm_for_token_counting or default_llm_for_token_counting
     # return llm.get_token_ids(text) # can result in:
     # ValueError: Encountered text corresponding to disallowed special token '<|endoftext|>'
-    _, tiktoken_encoding = llm._get_encoding_model()
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
     return tiktoken_encoding.encode_ordinary(text)  # LC uses encode instead
 
 
 def get_num_tokens(text: str, llm_for_token_counting: BaseLanguageModel | None = None):
-    """Get the number of tokens in a text."""
-    return len(get_token_ids(text, llm_for_token_counting))
+    """Get the number of tokens in a text (cached for long enough texts)."""
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    if len(text) < MIN_CHARS_TO_CACHE_TOKEN_COUNT:
+        return len(tiktoken_encoding.encode_ordinary(text))
+
+    key = get_token_count_cache_key(text, tiktoken_encoding)
+    if (num_tokens := token_count_cache.get(key)) is None:
+        num_tokens = len(tiktoken_encoding.encode_ordinary(text))
+        token_count_cache.put(key, num_tokens)
+    return num_tokens
 
 
 def get_num_tokens_in_texts(
     texts: list[str], llm_for_token_counting: BaseLanguageModel | None = None
 ) -> list[int]:
     """
-    Get the number of tokens in a list of texts using multiple threads.
-    """
+    Get the number of tokens in each of a list of texts (cached for long enough texts).
 
-    def _get_num_tokens(text):
-        return get_num_tokens(text, llm_for_token_counting)
+    Texts that aren't cached are tokenized with tiktoken's batch encoding (which uses
+    threads; tiktoken releases the GIL) or, if their total length is at least
+    TOKENIZER_PROCESS_POOL_MIN_CHARS, in a pool of processes.
+    """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+
+    # Get cached token counts and collect the texts to tokenize
+    token_counts: list[int | None] = []
+    keys: list[str | None] = []
+    idxs_to_tokenize = []
+    for i, text in enumerate(texts):
+        if len(text) < MIN_CHARS_TO_CACHE_TOKEN_COUNT:
+            key = num_tokens = None
+        else:
+            key = get_token_count_cache_key(text, tiktoken_encoding)
+            num_tokens = token_count_cache.get(key)
+        if num_tokens is None:
+            idxs_to_tokenize.append(i)
+        token_counts.append(num_tokens)
+        keys.append(key)
+
+    if not idxs_to_tokenize:
+        return token_counts
+
+    # Tokenize the rest
+    texts_to_tokenize = [texts[i] for i in idxs_to_tokenize]
+    if (
+        TOKENIZER_PROCESS_POOL_MIN_CHARS
+        and sum(len(x) for x in texts_to_tokenize) >= TOKENIZER_PROCESS_POOL_MIN_CHARS
+    ):
+        new_token_counts = get_num_tokens_in_texts_using_processes(
+            texts_to_tokenize, tiktoken_encoding.name
+        )
+    else:
+        new_token_counts = [
+            len(x) for x in tiktoken_encoding.encode_ordinary_batch(texts_to_tokenize)
+        ]
 
-    # TODO: experiment - since this is CPU-bound, may not benefit from threads
-    token_counts = execute_func_map_in_threads(_get_num_tokens, texts)
+    for i, num_tokens in zip(idxs_to_tokenize, new_token_counts):
+        token_counts[i] = num_tokens
+        if keys[i] is not None:
+            token_count_cache.put(keys[i], num_tokens)
     return token_counts
 
 
+def get_num_tokens_in_texts_using_processes(
+    texts: list[str], encoding_name: str, num_batches: int | None = None
+) -> list[int]:
+    """
+    Get the number of tokens in each text, splitting the texts into batches that are
+    tokenized in parallel in a pool of processes (by default, one batch per process).
+    """
+    global tokenizer_process_pool
+    with tokenizer_process_pool_lock:
+        if tokenizer_process_pool is None:
+            tokenizer_process_pool = ProcessPoolExecutor(
+                max_workers=TOKENIZER_PROCESS_POOL_WORKERS
+            )
+    num_batches = num_batches or TOKENIZER_PROCESS_POOL_WORKERS
+    batch_size = ceil(len(texts) / num_batches)
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    futures = [
+        tokenizer_process_pool.submit(get_num_tokens_in_batch, batch, encoding_name)
+        for batch in batches
+    ]
+    return [num_tokens for future in futures for num_tokens in future.result()]
+
+
+def get_num_tokens_in_batch(texts: list[str], encoding_name: str) -> list[int]:
+    """Get the number of tokens in each text (runs in a tokenizer process)."""
+    tiktoken_encoding = tiktoken.get_encoding(encoding_name)
+    return [len(x) for x in tiktoken_encoding.encode_ordinary_batch(texts)]
+
+
 def pairwise_chat_history_to_msg_list(
     chat_history: PairwiseChatHistory,
 ) -> list[BaseMessage]:
@@ -109,6 +292,23 @@ def msg_list_chat_history_to_string(
     return get_buffer_string(msg_list, human_prefix, ai_prefix)
 
 
+def get_num_tokens_in_chat_pair(
+    human_and_ai_msgs: tuple[str, str],
+    llm_for_token_counting: BaseLanguageModel | None = None,
+) -> int:
+    """
+    Get the number of tokens in a chat message pair (as formatted by
+    pairwise_chat_history_to_string), using chat_pair_token_count_cache.
+    """
+    text = pairwise_chat_history_to_string([human_and_ai_msgs])
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    key = get_token_count_cache_key(text, tiktoken_encoding)
+    if (num_tokens := chat_pair_token_count_cache.get(key)) is None:
+        num_tokens = len(tiktoken_encoding.encode_ordinary(text))
+        chat_pair_token_count_cache.put(key, num_tokens)
+    return num_tokens
+
+
 def limit_chat_history(
     chat_history: PairwiseChatHistory,
     max_token_limit=2000,
@@ -139,9 +339,8 @@ def limit_chat_history(
         if cached_token_counts:
             token_count_in_pair = cached_token_counts[-i - 1]
         else:
-            token_count_in_pair = get_num_tokens(
-                pairwise_chat_history_to_string([human_and_ai_msgs]),
-                llm_for_token_counting,
+            token_count_in_pair = get_num_tokens_in_chat_pair(
+                human_and_ai_msgs, llm_for_token_counting
             )
 
         tot_token_count += token_count_in_pair
@@ -185,115 +384,285 @@ def shorten_chat_msg_pair(
     llm_for_token_counting: BaseLanguageModel | None = None,
 ):
     """
-    Shorten a chat pair to below a maximum number of tokens.
+    Shorten a chat pair to at most max_token_limit tokens (when formatted with
+    pairwise_chat_history_to_string) by removing the middle of the longer message, or
+    of both messages if the shorter one takes more than half of the available tokens.
 
-    There is some imprecision in the token counting,
-    but it should be ok as long as we only try to shorten long messages.
+    Returns the shortened pair and its exact number of tokens.
     """
     human_msg, ai_msg = human_and_ai_msgs
     if max_token_limit < 10:
-        # To prevent infinite loops from inability to shorten
+        # To make sure the prefixes etc. fit
         raise ValueError("max_token_limit must be at least 10")
 
-    # Find the longest message
     human_token_count = get_num_tokens(human_msg, llm_for_token_counting)
     ai_token_count = get_num_tokens(ai_msg, llm_for_token_counting)
 
-    # Shorten the longest message
-    tokens_to_remove = curr_token_count - max_token_limit
-    if human_token_count > ai_token_count:
-        fraction_to_remove = min(0.9, tokens_to_remove / human_token_count)
-        human_msg = shorten_text_remove_middle(human_msg, fraction_to_remove)
-    else:
-        fraction_to_remove = min(0.9, tokens_to_remove / ai_token_count)
-        ai_msg = shorten_text_remove_middle(ai_msg, fraction_to_remove)
-
-    # Recalculate token count
-    token_count_new = get_num_tokens(
-        pairwise_chat_history_to_string([(human_msg, ai_msg)]),
-        llm_for_token_counting,
+    # Tokens available for the two messages (the rest are taken by the prefixes etc.)
+    max_tokens_msgs = max_token_limit - max(
+        0, curr_token_count - human_token_count - ai_token_count
     )
+    while True:
+        # Keep the shorter message as is if it takes at most half of the tokens
+        if human_token_count <= ai_token_count:
+            max_tokens_human = min(human_token_count, max_tokens_msgs // 2)
+            max_tokens_ai = max_tokens_msgs - max_tokens_human
+        else:
+            max_tokens_ai = min(ai_token_count, max_tokens_msgs // 2)
+            max_tokens_human = max_tokens_msgs - max_tokens_ai
+        human_msg_new, _ = remove_middle_tokens(
+            human_msg, max_tokens_human, llm_for_token_counting
+        )
+        ai_msg_new, _ = remove_middle_tokens(
+            ai_msg, max_tokens_ai, llm_for_token_counting
+        )
 
-    # print(
-    #     f"Shortened pair 'Human: {human_msg[:20]}..., AI: {ai_msg[:20]}...' to "
-    #     f"{token_count_new} tokens. Target was {max_token_limit} tokens."
-    # )
-
-    # If we are still over the limit, keep shortening
-    if token_count_new > max_token_limit:
-        return shorten_chat_msg_pair(
-            (human_msg, ai_msg),
-            max_token_limit,
-            token_count_new,
+        # The tokens at the joins may merge differently, so count them to be exact
+        token_count_new = get_num_tokens(
+            pairwise_chat_history_to_string([(human_msg_new, ai_msg_new)]),
             llm_for_token_counting,
         )
+        if token_count_new <= max_token_limit or max_tokens_msgs <= 0:
+            return (human_msg_new, ai_msg_new), token_count_new
+        max_tokens_msgs -= token_count_new - max_token_limit
 
-    return (human_msg, ai_msg), token_count_new
 
+class TokenBudgetAllocator:
+    """
+    Limits a chat history to various token budgets and allocates the token budget for
+    the final prompt between the chat history and retrieved docs, counting the tokens
+    in each message pair only once.
 
-def shorten_text_remove_middle(text: str, fraction_to_remove: float) -> str:
+    Limiting to a budget gives the same result as limit_chat_history with the same
+    max_token_limit, but is a binary search over cumulative token counts, plus (if
+    there's enough room) shortening of the oldest kept pair, which is memoized.
     """
-    Shorten a text to a given fraction of its original length by removing the middle
-    and replacing it with " ... ".
 
-    Usually the intended measure of the length is tokens but we use words as a proxy,
-    by splitting on spaces.
+    def __init__(
+        self,
+        chat_history: PairwiseChatHistory,
+        max_token_limit: int,
+        llm_for_token_counting: BaseLanguageModel | None = None,
+        cached_token_counts: list[int] | None = None,
+    ):
+        """
+        Initially limit the chat history to max_token_limit (the largest budget that
+        will be requested) and count the tokens in each message pair.
+        """
+        self.chat_history, self.token_counts = limit_chat_history(
+            chat_history,
+            max_token_limit=max_token_limit,
+            llm_for_token_counting=llm_for_token_counting,
+            cached_token_counts=cached_token_counts,
+        )
+        self.llm_for_token_counting = llm_for_token_counting
+
+        # Total token counts of the last k message pairs, for k = 0, 1, ...
+        self.token_counts_of_last_pairs = list(
+            accumulate(reversed(self.token_counts), initial=0)
+        )
+        self._shortened_pairs: dict[tuple[int, int], tuple[tuple[str, str], int]] = {}
+
+    def limit_chat_history(
+        self, max_token_limit: int
+    ) -> tuple[PairwiseChatHistory, list[int]]:
+        """
+        Limit the chat history to a maximum number of tokens. Returns the limited chat
+        history and the token counts of its message pairs.
+        """
+        num_pairs = max(
+            0, bisect_right(self.token_counts_of_last_pairs, max_token_limit) - 1
+        )
+        start_idx = len(self.chat_history) - num_pairs
+        chat_history = self.chat_history[start_idx:]
+        token_counts = self.token_counts[start_idx:]
+        if not start_idx:
+            return chat_history, token_counts
+
+        # If the next older pair is quite long, shorten it and also include it
+        num_tokens_can_add = (
+            max_token_limit - self.token_counts_of_last_pairs[num_pairs]
+        )
+        if not self.llm_for_token_counting or num_tokens_can_add <= max_token_limit / 3:
+            return chat_history, token_counts
+        key = (start_idx - 1, num_tokens_can_add)
+        if key not in self._shortened_pairs:
+            self._shortened_pairs[key] = shorten_chat_msg_pair(
+                self.chat_history[start_idx - 1],
+                num_tokens_can_add,
+                self.token_counts[start_idx - 1],
+                self.llm_for_token_counting,
+            )
+        shortened_pair, token_count_shortened = self._shortened_pairs[key]
+        return [shortened_pair] + chat_history, [token_count_shortened] + token_counts
+
+    def allocate(
+        self,
+        doc_token_counts: list[int],
+        max_tokens_limit_qa: int,
+        max_tokens_limit_chat: int,
+    ) -> tuple[PairwiseChatHistory, int, int]:
+        """
+        Allocate the token budget for docs + chat history:
+        1. Limit the chat history to max_tokens_limit_chat.
+        2. Keep as many docs (in order) as fit in the rest of max_tokens_limit_qa.
+        3. Give the chat history whatever room the docs left (it may fit more now).
+
+        Returns the limited chat history, the number of docs to keep and the total
+        number of tokens in them.
+        """
+        _, token_counts_chat = self.limit_chat_history(max_tokens_limit_chat)
+        max_tokens_limit_docs = max_tokens_limit_qa - sum(token_counts_chat)
+
+        # Keep the docs whose cumulative token count is within the limit
+        cumulative_doc_token_counts = list(accumulate(doc_token_counts, initial=0))
+        num_docs = max(
+            0, bisect_right(cumulative_doc_token_counts, max_tokens_limit_docs) - 1
+        )
+        token_count_docs = cumulative_doc_token_counts[num_docs]
+
+        chat_history, _ = self.limit_chat_history(
+            max_tokens_limit_qa - token_count_docs
+        )
+        return chat_history, num_docs, token_count_docs
+
+
+MIDDLE_REMOVAL_MARKER = " ... "
+
+
+def remove_middle_tokens(
+    text: str,
+    max_tokens: int,
+    llm_for_token_counting: BaseLanguageModel | None = None,
+    marker: str = MIDDLE_REMOVAL_MARKER,
+) -> tuple[str, int]:
     """
-    words = text.split(" ")  # NOTE could use RecursiveCharacterTextSplitter
-    num_words_to_keep = int(len(words) * (1 - fraction_to_remove))
-    if num_words_to_keep < 4:
-        return "..."
-    return (
-        " ".join(words[: num_words_to_keep // 2 - 1])
-        + " ... "
-        + " ".join(words[-(num_words_to_keep // 2 - 1) :])
+    Shorten a text to at most max_tokens tokens by replacing tokens in its middle
+    with a marker (" ... " by default). The text is encoded once and the kept head and
+    tail tokens are decoded and joined with the marker. Can be used for chat messages
+    as well as documents.
+
+    Returns the shortened text and its exact number of tokens.
+    """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    token_ids = tiktoken_encoding.encode_ordinary(text)
+    if len(token_ids) <= max_tokens:
+        return text, len(token_ids)
+
+    num_tokens_to_keep = max_tokens - len(tiktoken_encoding.encode_ordinary(marker))
+    while num_tokens_to_keep > 0:
+        num_tokens_tail = num_tokens_to_keep // 2
+        head_bytes = tiktoken_encoding.decode_bytes(
+            token_ids[: num_tokens_to_keep - num_tokens_tail]
+        )
+        tail_bytes = tiktoken_encoding.decode_bytes(
+            token_ids[len(token_ids) - num_tokens_tail :]
+        )
+        # Drop partial characters and whitespace at the cuts
+        shortened_text = (
+            head_bytes.decode("utf-8", errors="ignore").rstrip()
+            + marker
+            + tail_bytes.decode("utf-8", errors="ignore").lstrip()
+        )
+
+        # The tokens at the joins may merge differently, so count them to be exact
+        num_tokens = len(tiktoken_encoding.encode_ordinary(shortened_text))
+        if num_tokens <= max_tokens:
+            return shortened_text, num_tokens
+        num_tokens_to_keep -= num_tokens - max_tokens
+
+    # No room for any of the text
+    return truncate_text_to_tokens(
+        marker.strip(), max_tokens, llm_for_token_counting
     )
 
 
-def limit_tokens_in_text(
+SENTENCE_END_REGEX = re.compile(r"[.!?][\"')\]]*(?=\s)|\n")
+
+
+def get_char_idx_after_tokens(
+    token_ids: list[int], num_tokens: int, tiktoken_encoding: tiktoken.Encoding
+) -> int:
+    """
+    Get the index of the character right after the first num_tokens tokens in the text
+    that the token IDs were obtained from. If the token boundary falls inside a
+    multi-byte character, the character is not included.
+    """
+    prefix_bytes = tiktoken_encoding.decode_bytes(token_ids[:num_tokens])
+    return len(prefix_bytes.decode("utf-8", errors="ignore"))
+
+
+def snap_char_idx(text: str, char_idx: int, snap_to: str | None) -> int:
+    """
+    Move a cut point in a text back to the end of a word ("word") or sentence
+    ("sentence"), if possible. If snap_to is None, return the cut point as is.
+    """
+    if snap_to is None or char_idx >= len(text):
+        return char_idx
+    if snap_to == "sentence":
+        sentence_ends = list(SENTENCE_END_REGEX.finditer(text, 0, char_idx + 1))
+        if sentence_ends and sentence_ends[-1].end() <= char_idx:
+            return sentence_ends[-1].end()
+    elif snap_to != "word":
+        raise ValueError(f"Invalid snap_to: {snap_to}")
+
+    # Snap to the end of a word (unless the text has no whitespace to snap to)
+    if not text[char_idx].isspace():
+        idx_space = max(text.rfind(" ", 0, char_idx), text.rfind("\n", 0, char_idx))
+        if idx_space <= 0:
+            return char_idx
+        char_idx = idx_space
+    return len(text[:char_idx].rstrip())
+
+
+def truncate_text_to_tokens(
     text: str,
     max_tokens: int,
     llm_for_token_counting: BaseLanguageModel | None = None,
-    slow_down_factor=1.0,  # 0 = quicker but can undershoot significantly
-) -> str:
+    snap_to: str | None = None,
+) -> tuple[str, int]:
     """
-    Limit the number of tokens in a text to the specified amount (or slightly less).
+    Truncate a text to at most max_tokens tokens, removing tokens from the end. The
+    text is encoded once and cut at the token boundary, optionally moved back to the
+    end of a word or sentence (snap_to="word" or "sentence").
 
-    Tokens are removed from the end of the text.
+    Returns the truncated text and its exact number of tokens.
     """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    token_ids = tiktoken_encoding.encode_ordinary(text)
+    if len(token_ids) <= max_tokens:
+        return text, len(token_ids)
+
+    num_tokens_to_keep = max_tokens
+    while num_tokens_to_keep > 0:
+        char_idx = get_char_idx_after_tokens(
+            token_ids, num_tokens_to_keep, tiktoken_encoding
+        )
+        truncated_text = text[: snap_char_idx(text, char_idx, snap_to)]
 
-    # NOTE: Can implement without "guesses", using get_token_ids and token lookup
-    words = text.split(" ")
-    num_tokens = 0
-    at_most_words = len(words)
+        # A truncated text is usually tokenized the same as the kept tokens, but
+        # merges at the cut point can differ, so count its tokens to be exact
+        num_tokens = len(tiktoken_encoding.encode_ordinary(truncated_text))
+        if num_tokens <= max_tokens:
+            return truncated_text, num_tokens
+        num_tokens_to_keep -= num_tokens - max_tokens
+    return "", 0
 
-    # Get the initial guess for the number of words to keep
-    # print("max_tokens:", max_tokens)
-    # print("Initial token counting...")
-    for i, word in enumerate(words):
-        curr_num_tokens = get_num_tokens(word, llm_for_token_counting)
-        num_tokens += curr_num_tokens
-        if num_tokens > max_tokens:
-            at_most_words = i
-            break
-    # print("actual number of words:", len(words))
-    # print("at_most_words:", at_most_words)
 
-    # Keep reducing the number of words to keep until we're below the token limit
-    while True:
-        text = " ".join(words[:at_most_words])
-        true_num_tokens = get_num_tokens(text, llm_for_token_counting)
-        if true_num_tokens <= max_tokens:
-            return text, true_num_tokens
-        # Reduce the number of words to keep and try again
-        # print("true_num_tokens:", true_num_tokens)
-        # print("at_most_words:", at_most_words, end=" -> ")
-        at_most_words = int(
-            at_most_words
-            * (max_tokens / true_num_tokens + slow_down_factor)
-            / (1 + slow_down_factor)
-        )
-        # print(at_most_words)
+def limit_tokens_in_text(
+    text: str,
+    max_tokens: int,
+    llm_for_token_counting: BaseLanguageModel | None = None,
+) -> tuple[str, int]:
+    """
+    Limit the number of tokens in a text to the specified amount (or slightly less,
+    to end on a whole word). Returns the text and its number of tokens.
+
+    Tokens are removed from the end of the text.
+    """
+    return truncate_text_to_tokens(
+        text, max_tokens, llm_for_token_counting, snap_to="word"
+    )
 
 
 def get_max_token_allowance_for_texts(
@@ -370,24 +739,242 @@ def limit_tokens_in_texts(
     return new_texts, new_token_counts
 
 
+PARAGRAPH_BREAK_REGEX = re.compile(r"\n[^\S\n]*\n\s*")
+WORD_BREAK_REGEX = re.compile(r"(?<=\S)(?=\s)")
+
+
+def get_natural_token_boundary(
+    text: str, char_idxs: list[int], min_token_idx: int, max_token_idx: int
+) -> int:
+    """
+    Find a token boundary between min_token_idx (exclusive) and max_token_idx
+    (inclusive) at which to cut a text, preferring the last paragraph break, then the
+    last sentence end, then the last word end. char_idxs[i] must be the index in the
+    text of the first character of token i. Returns max_token_idx if there is no
+    natural break that falls on a token boundary.
+    """
+    min_char_idx = char_idxs[min_token_idx] + 1
+    max_char_idx = char_idxs[max_token_idx]
+    for regex in [PARAGRAPH_BREAK_REGEX, SENTENCE_END_REGEX, WORD_BREAK_REGEX]:
+        # Look one character past the window, for the regexes' lookaheads
+        matches = list(regex.finditer(text, min_char_idx, max_char_idx + 1))
+        for match in reversed(matches):
+            if match.end() > max_char_idx:
+                continue
+            token_idx = bisect_right(
+                char_idxs, match.end(), min_token_idx, max_token_idx + 1
+            )
+            if char_idxs[token_idx - 1] == match.end() and token_idx - 1 > min_token_idx:
+                return token_idx - 1
+    return max_token_idx
+
+
+def split_text_by_tokens(
+    text: str,
+    max_tokens: int,
+    overlap_tokens: int = 0,
+    llm_for_token_counting: BaseLanguageModel | None = None,
+    min_tokens: int | None = None,
+) -> list[tuple[int, int, int, int]]:
+    """
+    Split a text into parts of at most max_tokens tokens. The text is encoded once and
+    each part is cut on a token boundary, moved back to the end of a paragraph,
+    sentence or word if there is one in the last part of the allowed range (parts are
+    at least min_tokens tokens long, by default half of max_tokens, unless the text
+    ends). Consecutive parts overlap by about overlap_tokens tokens.
+
+    Returns a (start char idx, end char idx, start token idx, end token idx) tuple for
+    each part. The number of tokens in a part is the difference of its token indices.
+    """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    token_ids = tiktoken_encoding.encode_ordinary(text)
+    num_tokens_in_text = len(token_ids)
+    if not num_tokens_in_text:
+        return []
+    if min_tokens is None:
+        min_tokens = max_tokens // 2
+
+    # Index of the first character of each token (plus the end of the text)
+    _, char_idxs = tiktoken_encoding.decode_with_offsets(token_ids)
+    char_idxs.append(len(text))
+
+    parts = []
+    start_token_idx = 0
+    while True:
+        end_token_idx = min(start_token_idx + max_tokens, num_tokens_in_text)
+        if end_token_idx < num_tokens_in_text:
+            end_token_idx = get_natural_token_boundary(
+                text,
+                char_idxs,
+                min(start_token_idx + max(min_tokens, 1), end_token_idx) - 1,
+                end_token_idx,
+            )
+        parts.append(
+            (
+                char_idxs[start_token_idx],
+                char_idxs[end_token_idx],
+                start_token_idx,
+                end_token_idx,
+            )
+        )
+        if end_token_idx == num_tokens_in_text:
+            return parts
+
+        # Start the next part at the start of a word within the overlap, if possible
+        next_start_token_idx = max(end_token_idx - overlap_tokens, start_token_idx + 1)
+        while next_start_token_idx < end_token_idx and not (
+            text[char_idxs[next_start_token_idx]].isspace()
+            or text[char_idxs[next_start_token_idx] - 1].isspace()
+        ):
+            next_start_token_idx += 1
+        start_token_idx = next_start_token_idx
+
+
+def split_text_into_token_chunks(
+    text: str,
+    metadata: dict,
+    chunk_size: int = CHUNK_SIZE_TOKENS,
+    chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+    llm_for_token_counting: BaseLanguageModel | None = None,
+) -> list[Document]:
+    """
+    Token-aware alternative to split_text_into_positioned_chunks: split a text into
+    chunks of at most chunk_size tokens (see split_text_by_tokens) that have the same
+    position metadata, plus:
+    - "num_tokens": the number of tokens in the chunk
+    - "start_token_idx", "end_token_idx": the chunk's token range in the text
+    - "tokenizer": the name of the tiktoken encoding used, so that the token counts are
+    only reused with the same tokenizer
+
+    The metadata is copied, so the original is not modified.
+    """
+    if not text.strip():
+        return []
+    tokenizer_name = get_tiktoken_encoding(llm_for_token_counting).name
+    parts = split_text_by_tokens(
+        text, chunk_size, chunk_overlap, llm_for_token_counting
+    )
+    chunks = []
+    prev_end_idx = None
+    for i, (start_idx, end_idx, start_token_idx, end_token_idx) in enumerate(parts):
+        chunks.append(
+            Document(
+                page_content=text[start_idx:end_idx],
+                metadata=metadata
+                | {
+                    "start_index": start_idx,
+                    "chunk_idx": i,
+                    "num_chunks_in_parent": len(parts),
+                    "gap_before": (
+                        text[prev_end_idx:start_idx] if prev_end_idx is not None else ""
+                    ),
+                    "num_tokens": end_token_idx - start_token_idx,
+                    "start_token_idx": start_token_idx,
+                    "end_token_idx": end_token_idx,
+                    "tokenizer": tokenizer_name,
+                },
+            )
+        )
+        prev_end_idx = end_idx if prev_end_idx is None else max(prev_end_idx, end_idx)
+    return chunks
+
+
+ChunkFetcher = Callable[[list[tuple[str, int, int]]], list[Document]]
+# Takes a list of (parent_id, start_chunk_idx, end_chunk_idx) and returns the chunks
+# in those ranges (see ChromaDDG.get_chunks_by_position)
+
+MIN_NUM_CHUNKS_TO_FETCH = 4  # when expansion reaches the edge of the fetched chunks
+
+# Metadata describing the position of a single chunk, not valid for a range of chunks
+SINGLE_CHUNK_METADATA_KEYS = (
+    "chunk_idx",
+    "gap_before",
+    "start_token_idx",
+    "end_token_idx",
+    "tokenizer",
+)
+
+
+def get_chunk_fetcher_from_parents(
+    base_chunks: list[Document], parents_by_id: dict[str, Document]
+) -> tuple[list[Document], ChunkFetcher]:
+    """
+    Split parent documents into positioned chunks and return a chunk fetcher that
+    serves chunks from them, along with copies of the base chunks that have their
+    position metadata filled in. Used for older collections, whose chunks don't
+    have the "chunk_idx" metadata field.
+    """
+    chunks_by_parent_id = {
+        id_: split_text_into_positioned_chunks(
+            doc.page_content, doc.metadata | {"parent_id": id_}
+        )
+        for id_, doc in parents_by_id.items()
+    }
+
+    # Determine the location of each chunk in its parent document chunks
+    positioned_base_chunks = []
+    for base_chunk in base_chunks:
+        parent_id = base_chunk.metadata["parent_id"]
+        start_index = base_chunk.metadata["start_index"]
+
+        # Find the index of the parent chunk identical to chunk
+        for parent_chunk in chunks_by_parent_id[parent_id]:
+            if parent_chunk.metadata["start_index"] == start_index:
+                break
+        else:
+            raise ValueError(f"Parent for start_index {start_index} not found.")
+        positioned_base_chunks.append(
+            Document(
+                page_content=base_chunk.page_content,
+                metadata=parent_chunk.metadata | base_chunk.metadata,
+            )
+        )
+
+    def fetch_chunks(chunk_ranges: list[tuple[str, int, int]]) -> list[Document]:
+        return [
+            chunk
+            for parent_id, start_chunk_idx, end_chunk_idx in chunk_ranges
+            for chunk in chunks_by_parent_id[parent_id][start_chunk_idx:end_chunk_idx]
+        ]
+
+    return positioned_base_chunks, fetch_chunks
+
+
 def expand_chunks(
     base_chunks: list[Document],
-    parents_by_id: dict[str, Document],
+    fetch_chunks: ChunkFetcher,
     max_total_tokens: int,
     boost_factor_top: float = 1.4,  # boost token allowance for top chunk, decrease linearly
     ratio_add_above_vs_below: float = 0.5,  # approx. ratio of tokens to add above vs below
     llm_for_token_counting: BaseLanguageModel | None = None,
     keep_chunk_order: bool = True,
+    recount_tokens: bool = False,
 ) -> list[Document]:
     """
-    Expand chunks using their parent documents. The expanded chunks will have a total
-    number of tokens below the specified limit (or slightly above). The expanded chunks
-    will have the same metadata as the base chunks, except for the "start_index" metadata,
-    which will be updated to reflect the new start index in the parent document, and the
-    "num_tokens" metadata, which will contain the chunk's number of tokens.
-
-    If during expansion two or more chunks in the same parent document overlap, they will
-    be merged into one chunk.
+    Expand chunks by adding neighboring chunks from their parent documents. The expanded
+    chunks will have a total number of tokens below the specified limit (or slightly above).
+    The expanded chunks will have the same metadata as the base chunks, except for the
+    "start_index" metadata, which will be updated to reflect the new start index in the
+    parent document, and the "num_tokens" metadata, which will contain the chunk's number
+    of tokens. The metadata describing the position of a single chunk (see
+    SINGLE_CHUNK_METADATA_KEYS) is dropped, since expanded chunks span several chunks.
+
+    The base chunks must have the "parent_id", "chunk_idx" and "num_chunks_in_parent"
+    metadata fields. Neighboring chunks are obtained using fetch_chunks: first, windows
+    of chunks estimated to be enough for the expansion are fetched in one batch, and
+    then more chunks are fetched only if an expansion reaches the edge of its window.
+
+    If during expansion two or more chunks in the same parent document overlap or become
+    adjacent, they will be merged into one chunk.
+
+    Each chunk is tokenized only once; the number of tokens in an expanded chunk is the
+    sum of its chunks' token counts, corrected at each join for the gap or overlap
+    between the chunk and the text so far (as in join_contiguous_chunks, relative to the
+    furthest end of the chunks before it). This can be off by a few tokens at the joins.
+    Chunks split on token boundaries (see split_text_into_token_chunks) are not
+    tokenized at all: their token counts and positions are taken from their metadata.
+    If recount_tokens is True, the "num_tokens" of the final chunks is recounted exactly
+    at the end.
 
     If keep_chunk_order is True, the order of the final chunks will be determined by the earliest
     base chunk within each final chunk. If False, all final chunks belonging to the same parent
@@ -402,27 +989,6 @@ def expand_chunks(
     if num_base_chunks == 0:
         return []
 
-    # Split each parent document into chunks
-    parent_chunks_by_id: dict[str, list[Document]] = {
-        id_: rag_text_splitter.split_documents([doc])
-        for id_, doc in parents_by_id.items()
-    }
-
-    # Determine the location of each chunk in its parent document chunks
-    chunk_idxs = []
-    for base_chunk in base_chunks:
-        parent_id = base_chunk.metadata["parent_id"]
-        start_index = base_chunk.metadata["start_index"]
-        parent_chunks = parent_chunks_by_id[parent_id]
-
-        # Find the index of the parent chunk identical to chunk
-        for i, parent_chunk in enumerate(parent_chunks):
-            if parent_chunk.metadata["start_index"] == start_index:
-                chunk_idxs.append(i)
-                break
-        else:
-            raise ValueError(f"Parent for start_index {start_index} not found.")
-
     # Determine target expasion boost factor for each base chunk - vs avg expanded size
     if num_base_chunks == 1:
         boost_factors = [1.0]
@@ -433,7 +999,151 @@ def expand_chunks(
             boost_factor_top - boost_factor_step * i for i in range(num_base_chunks)
         ]
 
-    # Prepare to keep track of the expanded chunks
+    # Keep track of the chunks we have so far, starting with the base chunks
+    chunks_by_parent_id: dict[str, dict[int, Document]] = {}
+    for base_chunk in base_chunks:
+        chunks_by_parent_id.setdefault(base_chunk.metadata["parent_id"], {})[
+            base_chunk.metadata["chunk_idx"]
+        ] = base_chunk
+
+    # Token counts of individual chunks and corrections for joining a chunk to the text
+    # so far, keyed also by the earlier chunk with the furthest end
+    num_tokens_by_chunk_key: dict[tuple[str, int], int] = {}
+    num_join_tokens_by_chunk_key: dict[tuple[str, int, int], int] = {}
+
+    # Chunks split by split_text_into_token_chunks with the same tokenizer already
+    # have their token counts and token positions in their metadata
+    tokenizer_name = get_tiktoken_encoding(llm_for_token_counting).name
+
+    def has_token_positions(chunk: Document) -> bool:
+        return chunk.metadata.get("tokenizer") == tokenizer_name
+
+    def get_num_tokens_in_chunk(parent_id: str, chunk_idx: int) -> int:
+        key = (parent_id, chunk_idx)
+        if key not in num_tokens_by_chunk_key:
+            chunk = chunks_by_parent_id[parent_id][chunk_idx]
+            num_tokens_by_chunk_key[key] = (
+                chunk.metadata["num_tokens"]
+                if has_token_positions(chunk)
+                else get_num_tokens(chunk.page_content, llm_for_token_counting)
+            )
+        return num_tokens_by_chunk_key[key]
+
+    def get_end_index(parent_id: str, chunk_idx: int) -> int:
+        chunk = chunks_by_parent_id[parent_id][chunk_idx]
+        return chunk.metadata["start_index"] + len(chunk.page_content)
+
+    def get_num_join_tokens(parent_id: str, chunk_idx: int, prev_chunk_idx: int) -> int:
+        # Tokens to add when joining the chunk to the text so far, whose furthest end is
+        # that of chunk prev_chunk_idx (negative if overlap; cancels the chunk's own
+        # tokens if the chunk is entirely within that text)
+        key = (parent_id, chunk_idx, prev_chunk_idx)
+        if key not in num_join_tokens_by_chunk_key:
+            prev_chunk = chunks_by_parent_id[parent_id][prev_chunk_idx]
+            chunk = chunks_by_parent_id[parent_id][chunk_idx]
+            num_tokens_in_chunk = get_num_tokens_in_chunk(parent_id, chunk_idx)
+            if has_token_positions(prev_chunk) and has_token_positions(chunk):
+                num_join_tokens_by_chunk_key[key] = max(
+                    chunk.metadata["start_token_idx"]
+                    - prev_chunk.metadata["end_token_idx"],
+                    -num_tokens_in_chunk,
+                )
+                return num_join_tokens_by_chunk_key[key]
+            overlap_len = (
+                get_end_index(parent_id, prev_chunk_idx) - chunk.metadata["start_index"]
+            )
+            if overlap_len >= len(chunk.page_content):
+                num_join_tokens = -num_tokens_in_chunk
+            elif overlap_len > 0:
+                num_join_tokens = -get_num_tokens(
+                    chunk.page_content[:overlap_len], llm_for_token_counting
+                )
+            else:
+                num_join_tokens = get_num_tokens(
+                    chunk.metadata.get("gap_before", ""), llm_for_token_counting
+                )
+            num_join_tokens_by_chunk_key[key] = num_join_tokens
+        return num_join_tokens_by_chunk_key[key]
+
+    def get_num_tokens_in_chunk_range(
+        parent_id: str, idx_pair: tuple[int, int]
+    ) -> int:
+        # Same joins as in join_contiguous_chunks: each chunk is joined to the text so
+        # far, i.e. relative to the furthest end of the chunks before it
+        num_tokens = get_num_tokens_in_chunk(parent_id, idx_pair[0])
+        max_end_chunk_idx = idx_pair[0]
+        for i in range(idx_pair[0] + 1, idx_pair[1]):
+            num_tokens += get_num_tokens_in_chunk(parent_id, i) + get_num_join_tokens(
+                parent_id, i, max_end_chunk_idx
+            )
+            max_end_index = get_end_index(parent_id, max_end_chunk_idx)
+            if get_end_index(parent_id, i) > max_end_index:
+                max_end_chunk_idx = i
+        return num_tokens
+
+    def get_chunk_range_metadata(
+        base_chunk: Document, idx_pair: tuple[int, int], num_tokens: int
+    ) -> dict[str, Any]:
+        parent_id = base_chunk.metadata["parent_id"]
+        return {
+            k: v
+            for k, v in base_chunk.metadata.items()
+            if k not in SINGLE_CHUNK_METADATA_KEYS
+        } | {
+            "num_tokens": num_tokens,
+            "start_index": chunks_by_parent_id[parent_id][idx_pair[0]].metadata[
+                "start_index"
+            ],
+        }
+
+    base_chunk_num_tokens = [
+        get_num_tokens_in_chunk(x.metadata["parent_id"], x.metadata["chunk_idx"])
+        for x in base_chunks
+    ]
+
+    def add_fetched_chunks(chunk_ranges: list[tuple[str, int, int]]) -> None:
+        for chunk in fetch_chunks(chunk_ranges):
+            chunks_by_parent_id[chunk.metadata["parent_id"]].setdefault(
+                chunk.metadata["chunk_idx"], chunk
+            )
+
+    # Fetch the windows of neighboring chunks that we expect to need (in one batch)
+    window_idxs_by_parent_id: dict[str, list[tuple[int, int]]] = {}
+    avg_target_num_tokens = max_total_tokens / num_base_chunks
+    for base_chunk, boost_factor, num_tokens in zip(
+        base_chunks, boost_factors, base_chunk_num_tokens
+    ):
+        # NOTE: overestimate a bit, since leftover allowance is passed on to later chunks
+        num_to_add = 1.5 * avg_target_num_tokens * boost_factor / max(num_tokens, 1) - 1
+        num_to_add_above = ceil(max(num_to_add, 0) * ratio_add_above_vs_below) + 1
+        num_to_add_below = ceil(max(num_to_add, 0)) + 1
+        parent_id = base_chunk.metadata["parent_id"]
+        chunk_idx = base_chunk.metadata["chunk_idx"]
+        window_idxs_by_parent_id[parent_id] = insert_interval(
+            window_idxs_by_parent_id.get(parent_id, []),
+            (
+                max(0, chunk_idx - num_to_add_above),
+                min(
+                    base_chunk.metadata["num_chunks_in_parent"],
+                    chunk_idx + 1 + num_to_add_below,
+                ),
+            ),
+        )
+    add_fetched_chunks(
+        [
+            (parent_id, start_chunk_idx, end_chunk_idx)
+            for parent_id, window_idxs in window_idxs_by_parent_id.items()
+            for start_chunk_idx, end_chunk_idx in window_idxs
+        ]
+    )
+
+    def get_text_of_chunk_range(parent_id: str, idx_pair: tuple[int, int]) -> str:
+        chunks_in_parent = chunks_by_parent_id[parent_id]
+        return join_contiguous_chunks(
+            [chunks_in_parent[i] for i in range(idx_pair[0], idx_pair[1])]
+        )
+
+    # Prepare to keep track of the expanded chunks (keyed by ranges of chunk indices)
     final_chunks_by_id: dict[str, dict[tuple[int, int], Document]] = {}
 
     token_allowance_left = max_total_tokens
@@ -441,26 +1151,18 @@ def expand_chunks(
     boost_factors_sum_left = num_base_chunks
 
     # Expand each base chunk and merge overlapping chunks
-    for base_chunk, boost_factor, chunk_idx in zip(
-        base_chunks, boost_factors, chunk_idxs
+    for base_chunk, boost_factor, num_tokens in zip(
+        base_chunks, boost_factors, base_chunk_num_tokens
     ):
         parent_id = base_chunk.metadata["parent_id"]
-        parent_doc_text = parents_by_id[parent_id].page_content
-        parent_chunks = parent_chunks_by_id[parent_id]
-        num_parent_chunks = len(parent_chunks)
+        chunk_idx = base_chunk.metadata["chunk_idx"]
+        num_parent_chunks = base_chunk.metadata["num_chunks_in_parent"]
+        chunks_in_parent = chunks_by_parent_id[parent_id]
 
-        # Variables to keep track of the expanded chunk
-        start_idx = base_chunk.metadata["start_index"]
-        end_idx = start_idx + len(base_chunk.page_content)
+        # Variables to keep track of the expanded chunk (starts as the original chunk)
         start_chunk_idx = chunk_idx
         end_chunk_idx = chunk_idx + 1
-
-        # Expanded chunk starts with the original chunk
-        num_tokens = get_num_tokens(base_chunk.page_content, llm_for_token_counting)
-        expanded_chunk = Document(
-            page_content=base_chunk.page_content,
-            metadata=base_chunk.metadata | {"num_tokens": num_tokens},
-        )
+        max_end_chunk_idx = chunk_idx  # chunk with the furthest end in the range
 
         target_num_tokens = token_allowance_left * boost_factor / boost_factors_sum_left
         clg.log(
@@ -489,19 +1191,60 @@ def expand_chunks(
                 )
                 add_above = abs(score_if_add_above) <= abs(score_if_add_below) + 1e-6
 
-            # Get the chunk to add and update number of tokens in the expanded chunk
+            # Get the chunk to add, fetching more chunks if we reached the window's edge
             new_chunk_idx = start_chunk_idx - 1 if add_above else end_chunk_idx
-            chunk_to_add = parent_chunks[new_chunk_idx]
-            chunk_to_add_start_idx = chunk_to_add.metadata["start_index"]
-            new_start_idx = chunk_to_add_start_idx if add_above else start_idx
-            new_end_idx = (
-                end_idx
+            if new_chunk_idx not in chunks_in_parent:
+                num_to_fetch = max(
+                    MIN_NUM_CHUNKS_TO_FETCH, end_chunk_idx - start_chunk_idx
+                )
+                fetch_idx_pair = (
+                    (max(0, new_chunk_idx + 1 - num_to_fetch), new_chunk_idx + 1)
+                    if add_above
+                    else (
+                        new_chunk_idx,
+                        min(num_parent_chunks, new_chunk_idx + num_to_fetch),
+                    )
+                )
+                add_fetched_chunks([(parent_id, *fetch_idx_pair)])
+                if new_chunk_idx not in chunks_in_parent:
+                    logger.warning(f"Chunk {new_chunk_idx} of {parent_id} not found.")
+                    break
+
+            # Update number of tokens in the expanded chunk
+            new_idx_pair = (
+                (new_chunk_idx, end_chunk_idx)
                 if add_above
-                else chunk_to_add_start_idx + len(chunk_to_add.page_content)
+                else (start_chunk_idx, new_chunk_idx + 1)
             )
-
-            new_text = parent_doc_text[new_start_idx:new_end_idx]
-            new_num_tokens = get_num_tokens(new_text, llm_for_token_counting)
+            new_end_index = get_end_index(parent_id, new_chunk_idx)
+            if not add_above:
+                new_num_tokens = (
+                    num_tokens
+                    + get_num_tokens_in_chunk(parent_id, new_chunk_idx)
+                    + get_num_join_tokens(parent_id, new_chunk_idx, max_end_chunk_idx)
+                )
+                new_max_end_chunk_idx = (
+                    new_chunk_idx
+                    if new_end_index > get_end_index(parent_id, max_end_chunk_idx)
+                    else max_end_chunk_idx
+                )
+            elif new_end_index <= get_end_index(parent_id, start_chunk_idx):
+                # Only the join of the previous first chunk changes
+                new_num_tokens = (
+                    num_tokens
+                    + get_num_tokens_in_chunk(parent_id, new_chunk_idx)
+                    + get_num_join_tokens(parent_id, start_chunk_idx, new_chunk_idx)
+                )
+                new_max_end_chunk_idx = max_end_chunk_idx
+            else:
+                # The new first chunk reaches past the previous one (rare), which can
+                # change the joins further down, so count the whole range
+                new_num_tokens = get_num_tokens_in_chunk_range(parent_id, new_idx_pair)
+                new_max_end_chunk_idx = (
+                    new_chunk_idx
+                    if new_end_index > get_end_index(parent_id, max_end_chunk_idx)
+                    else max_end_chunk_idx
+                )
 
             # If adding this chunk would exceed the target size, stop
             # NOTE: we are always including the original chunk, even if it
@@ -511,24 +1254,26 @@ def expand_chunks(
                 break
 
             # Add the base chunk by updating the relevant variables
+            start_chunk_idx, end_chunk_idx = new_idx_pair
+            num_tokens = new_num_tokens
+            max_end_chunk_idx = new_max_end_chunk_idx
             if add_above:
-                start_idx = new_start_idx
-                start_chunk_idx -= 1
                 added_above += 1
             else:
-                end_idx = new_end_idx
-                end_chunk_idx += 1
                 added_below += 1
 
-            # Update the expanded chunk
-            expanded_chunk = Document(
-                page_content=new_text,
-                metadata=base_chunk.metadata
-                | {"num_tokens": new_num_tokens, "start_index": new_start_idx},
-            )
+        # Construct the expanded chunk
+        expanded_chunk = Document(
+            page_content=get_text_of_chunk_range(
+                parent_id, (start_chunk_idx, end_chunk_idx)
+            ),
+            metadata=get_chunk_range_metadata(
+                base_chunk, (start_chunk_idx, end_chunk_idx), num_tokens
+            ),
+        )
         clg.log(
-            f"New num_tokens: {expanded_chunk.metadata['num_tokens']}, "
-            f"{start_idx = }, {end_idx = }, "
+            f"New num_tokens: {num_tokens}, "
+            f"{start_chunk_idx = }, {end_chunk_idx = }, "
             f"{added_above = }, {added_below = }"
         )
 
@@ -536,7 +1281,7 @@ def expand_chunks(
         curr_chunks_in_parent = final_chunks_by_id.get(parent_id, {})
         curr_chunk_boundaries = list(curr_chunks_in_parent.keys())
         new_chunk_boundaries = insert_interval(
-            curr_chunk_boundaries, (start_idx, end_idx)
+            curr_chunk_boundaries, (start_chunk_idx, end_chunk_idx)
         )  # some chunks may have been merged
         new_chunks_in_parent: dict[tuple[int, int], Document] = {}
         for idx_pair in new_chunk_boundaries:
@@ -545,20 +1290,18 @@ def expand_chunks(
                 new_chunks_in_parent[idx_pair] = curr_chunks_in_parent[idx_pair]
             except KeyError:
                 # We don't have info for this expanded chunk yet, so add it
-                if idx_pair == (start_idx, end_idx):
+                if idx_pair == (start_chunk_idx, end_chunk_idx):
                     # The unaltered expanded chunk we just constructed
                     new_chunks_in_parent[idx_pair] = expanded_chunk
                 else:
                     # Some sort of merged chunk. Construct it and add it
-                    chunk_text = parent_doc_text[idx_pair[0] : idx_pair[1]]
-                    num_tokens = get_num_tokens(chunk_text, llm_for_token_counting)
                     new_chunks_in_parent[idx_pair] = Document(
-                        page_content=chunk_text,
-                        metadata=base_chunk.metadata
-                        | {
-                            "start_index": idx_pair[0],
-                            "num_tokens": num_tokens,
-                        },
+                        page_content=get_text_of_chunk_range(parent_id, idx_pair),
+                        metadata=get_chunk_range_metadata(
+                            base_chunk,
+                            idx_pair,
+                            get_num_tokens_in_chunk_range(parent_id, idx_pair),
+                        ),
                     )
         final_chunks_by_id[parent_id] = new_chunks_in_parent
 
@@ -598,8 +1341,8 @@ def expand_chunks(
             idx_pair = idx_pairs[
                 bisect_right(
                     idx_pairs,
-                    base_chunk.metadata["start_index"],
-                    key=lambda x: x[0],  # use start index for comparisons
+                    base_chunk.metadata["chunk_idx"],
+                    key=lambda x: x[0],  # use start chunk index for comparisons
                 )
                 - 1
             ]
@@ -612,4 +1355,10 @@ def expand_chunks(
         for parent_id in final_chunks_by_id:
             final_chunks.extend(final_chunks_by_id[parent_id].values())
 
+    if recount_tokens:
+        for chunk in final_chunks:
+            chunk.metadata["num_tokens"] = get_num_tokens(
+                chunk.page_content, llm_for_token_counting
+            )
+
     return final_chunks
@@ -37,6 +37,12 @@ CHAT_DEPLOYMENT_NAME = os.getenv("CHAT_DEPLOYMENT_NAME")
 
 DEFAULT_COLLECTION_NAME = os.getenv("DEFAULT_COLLECTION_NAME", "docdocgo-documentation")
 
+# Name of the collection where the state of research agents (reports, fetched pages, etc.)
+# is stored, rather than in each collection's metadata. It's not listed by /db
+RESEARCH_STATE_COLLECTION_NAME = os.getenv(
+    "RESEARCH_STATE_COLLECTION_NAME", "docdocgo-research-state"
+)
+
 if USE_CHROMA_VIA_HTTP := bool(os.getenv("USE_CHROMA_VIA_HTTP")):
     os.environ["CHROMA_API_IMPL"] = "rest"
 
@@ -48,6 +54,29 @@ CHROMA_SERVER_AUTHN_CREDENTIALS = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "
 # The following variable is only used if USE_CHROMA_VIA_HTTP is False
 VECTORDB_DIR = os.getenv("VECTORDB_DIR", "chroma/")
 
+# Seconds a pooled Chroma client can go unused before it's health-checked on next use
+CHROMA_CLIENT_HEALTH_CHECK_INTERVAL = float(
+    os.getenv("CHROMA_CLIENT_HEALTH_CHECK_INTERVAL", 30)
+)
+
+# Max number of collection handles (with their metadata) cached in memory, and the
+# number of seconds a cached handle (or the fact that a collection doesn't exist) is used
+# before it's fetched again (0 = always fetch)
+COLLECTION_CACHE_MAX_ITEMS = int(os.getenv("COLLECTION_CACHE_MAX_ITEMS", 10_000))
+COLLECTION_METADATA_TTL = float(os.getenv("COLLECTION_METADATA_TTL", 10))
+
+# Seconds after which the in-memory catalog of collections (used to list and search them)
+# is reloaded from the db to pick up changes made by other processes
+COLLECTION_CATALOG_REFRESH_INTERVAL = float(
+    os.getenv("COLLECTION_CATALOG_REFRESH_INTERVAL", 60)
+)
+
+# Max number of collections with cached access roles of users/access codes, and the
+# number of seconds a cached role is used before the collection's permissions are
+# checked again (changes made by this process apply immediately, 0 = always check)
+ACCESS_ROLE_CACHE_MAX_ITEMS = int(os.getenv("ACCESS_ROLE_CACHE_MAX_ITEMS", 10_000))
+ACCESS_ROLE_CACHE_TTL = float(os.getenv("ACCESS_ROLE_CACHE_TTL", 30))
+
 MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")  # rename to DEFAULT_MODEL?
 CONTEXT_LENGTH = int(os.getenv("CONTEXT_LENGTH", 16000))  # it's actually more like max
 # size of what we think we can feed to the model so that it doesn't get overwhelmed
@@ -78,6 +107,69 @@ DOMAIN_NAME_FOR_SHARING = os.getenv("DOMAIN_NAME_FOR_SHARING", "shared")
 
 MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 100 * 1024 * 1024))
 
+# Max total size of the parent docs (or their chunks) the retriever caches in memory
+PARENT_DOC_CACHE_MAX_BYTES = int(
+    os.getenv("PARENT_DOC_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+
+# Max number of chat message pairs whose token counts are cached in memory, and an
+# optional path to an SQLite file to also persist them in (e.g. across restarts)
+CHAT_TOKEN_COUNT_CACHE_MAX_ITEMS = int(
+    os.getenv("CHAT_TOKEN_COUNT_CACHE_MAX_ITEMS", 100_000)
+)
+CHAT_TOKEN_COUNT_CACHE_DB_PATH = os.getenv("CHAT_TOKEN_COUNT_CACHE_DB_PATH", "")
+
+# Max number of texts whose token counts are cached in memory, the min total length of
+# texts to tokenize in a pool of processes rather than in threads (0 = never), and the
+# number of processes in that pool (0 = one per CPU)
+TOKEN_COUNT_CACHE_MAX_ITEMS = int(os.getenv("TOKEN_COUNT_CACHE_MAX_ITEMS", 100_000))
+TOKENIZER_PROCESS_POOL_MIN_CHARS = int(os.getenv("TOKENIZER_PROCESS_POOL_MIN_CHARS", 0))
+TOKENIZER_PROCESS_POOL_WORKERS = (
+    int(os.getenv("TOKENIZER_PROCESS_POOL_WORKERS", 0)) or os.cpu_count() or 1
+)
+
+# Whether to retrieve docs for the raw query while the standalone query is generated,
+# and how similar the two queries must be (Jaccard similarity of words) to use the results
+SPECULATIVE_RETRIEVAL = bool(os.getenv("SPECULATIVE_RETRIEVAL"))
+SPECULATIVE_RETRIEVAL_MIN_SIMILARITY = float(
+    os.getenv("SPECULATIVE_RETRIEVAL_MIN_SIMILARITY", 0.8)
+)
+
+# Whether to retrieve docs for both the standalone query and the raw query (in one
+# batch) and fuse the results, rather than only for the standalone query
+QUERY_FUSION = bool(os.getenv("QUERY_FUSION"))
+
+# Max number of collections searched at once with "/kb --collections ..." (if a prefix
+# matches more, the most recently updated ones are used)
+FEDERATED_SEARCH_MAX_COLLECTIONS = int(
+    os.getenv("FEDERATED_SEARCH_MAX_COLLECTIONS", 10)
+)
+
+# "always" to always condense the question using the chat history (an LLM call), or
+# "heuristic" to skip that for queries that look self-contained
+CONDENSE_QUESTION_MODE = os.getenv("CONDENSE_QUESTION_MODE", "always")
+if CONDENSE_QUESTION_MODE not in {"always", "heuristic"}:
+    raise ValueError("CONDENSE_QUESTION_MODE must be 'always' or 'heuristic'.")
+
+# "chars" to split docs into chunks of 400 characters (see utils/rag.py), or "tokens" to
+# split them on token boundaries and record each chunk's token count (so that retrieval
+# doesn't need to tokenize chunks again)
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "chars")
+if CHUNKING_MODE not in {"chars", "tokens"}:
+    raise ValueError("CHUNKING_MODE must be 'chars' or 'tokens'.")
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", 100))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 10))
+
+# Whether to drop the texts of fetched pages that research agents no longer need (those
+# that failed or have been processed and ingested or passed on), to save memory and space
+EVICT_UNUSED_LINK_TEXTS = bool(os.getenv("EVICT_UNUSED_LINK_TEXTS"))
+
+# Number of saves of a research agent's state (e.g. research iterations) after which the
+# journal of changes is compacted into a full record (1 = always save the full record)
+RESEARCH_STATE_COMPACTION_INTERVAL = int(
+    os.getenv("RESEARCH_STATE_COMPACTION_INTERVAL", 20)
+)
+
 INITIAL_TEST_QUERY_STREAMLIT = os.getenv("INITIAL_QUERY_STREAMLIT")
 
 # Check that the necessary environment variables are set
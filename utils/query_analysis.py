@@ -0,0 +1,93 @@
+import re
+
+from utils.type_utils import PairwiseChatHistory
+
+# Min number of words in a query for it to be considered self-contained
+MIN_WORDS_IN_STANDALONE_QUERY = 6
+
+# Words that usually refer to something earlier in the conversation
+REFERRING_WORDS = {
+    "it", "its", "itself", "they", "them", "their", "theirs", "themselves", "this",
+    "these", "those", "he", "him", "his", "she", "her", "hers", "above", "previous",
+    "previously", "earlier", "former", "latter", "same", "aforementioned", "again",
+    "else", "another", "more", "other", "others", "also", "too", "one", "ones",
+    "first", "second", "third", "last",
+}
+
+# Words that continue the previous turn when they start the query
+CONTINUATION_WORDS = {
+    "and", "but", "so", "or", "then", "also", "what about", "how about", "why",
+    "ok", "okay", "yes", "yeah", "no", "nope", "sure", "thanks", "thank you",
+    "great", "cool", "hm", "hmm", "wait", "really", "continue", "go on",
+}
+
+# "that" is a referring word unless it's a conjunction or relative pronoun
+REFERRING_THAT_REGEX = re.compile(
+    r"(?:^|\b(?:is|was|does|did|do|about)\s+)that\b"
+    r"|\bthat(?=\s*(?:[?.!,;:]|$|is\b|was\b|'s\b|means?\b|one\b|part\b|again\b))"
+)
+REFERENCE_TO_CONVERSATION_REGEX = re.compile(
+    r"\b(?:you|your|we|our|i|my)\b.*\b(?:said|say|mentioned|wrote|answer|response|"
+    r"message|reply|list|summary|discussed|asked|talked)\b"
+)
+WORD_REGEX = re.compile(r"\w+(?:'\w+)?")
+DEFINITE_NOUN_REGEX = re.compile(r"\bthe\s+(\w+)")
+
+STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "for", "with", "and", "or", "is",
+    "are", "was", "were", "be", "what", "how", "why", "who", "which", "when",
+    "where", "do", "does", "did", "can", "you", "i", "me", "my", "about", "from",
+    "by", "as", "at", "best", "most", "main", "way", "ways", "some", "any", "all",
+}
+
+
+def get_words(text: str) -> list[str]:
+    """Get the lowercase words in a text."""
+    return WORD_REGEX.findall(text.lower())
+
+
+def check_if_query_needs_condensing(
+    query: str, chat_history: PairwiseChatHistory
+) -> tuple[bool, str]:
+    """
+    Decide, using rules and lexical cues, whether a query needs to be rephrased into a
+    standalone query (using the chat history) before it can be used for retrieval.
+    Errs on the side of condensing. Returns the verdict and the reason for it.
+    """
+    if not chat_history:
+        return False, "no chat history"
+
+    query_lower = query.lower().strip()
+    words = get_words(query_lower)
+    if len(words) < MIN_WORDS_IN_STANDALONE_QUERY:
+        return True, "short query"
+
+    # Ellipsis or a query that continues the previous turn
+    if "..." in query_lower or "…" in query_lower:
+        return True, "ellipsis"
+    for continuation in CONTINUATION_WORDS:
+        if re.match(rf"{continuation}\b", query_lower):
+            return True, f"starts with '{continuation}'"
+
+    # Words referring to something earlier in the conversation
+    for word in words:
+        if word in REFERRING_WORDS:
+            return True, f"referring word '{word}'"
+    if REFERRING_THAT_REGEX.search(query_lower):
+        return True, "referring word 'that'"
+    if REFERENCE_TO_CONVERSATION_REGEX.search(query_lower):
+        return True, "reference to the conversation"
+
+    # Cues from the previous message pair
+    prev_msg, prev_answer = chat_history[-1]
+    prev_answer = (prev_answer or "").strip()
+    if prev_answer.endswith("?"):
+        return True, "previous answer ended with a question"
+    prev_words = set(get_words(f"{prev_msg or ''} {prev_answer}"))
+    for noun in DEFINITE_NOUN_REGEX.findall(query_lower):
+        if noun in STOPWORDS:
+            continue
+        if noun in prev_words or f"{noun}s" in prev_words or noun[:-1] in prev_words:
+            return True, f"'the {noun}' may refer to the previous message pair"
+
+    return False, "self-contained query"
@@ -83,6 +83,9 @@ share_revoke_subcommand_to_enum = {
 }
 HEATSEEKER_DEFAULT_NUM_ITERATIONS = 1
 
+# Option to chat with several collections at once: "/kb --collections a,b,c* <query>"
+COLLECTIONS_OPTIONS = {"--collections", "--colls"}
+
 ExportCommand = Enum("ExportCommand", "CHAT KB NONE")
 export_command_to_enum = {
     "chat": ExportCommand.CHAT,
@@ -109,6 +112,7 @@ class ParsedQuery(BaseModel):
 
     # Normally, only one of the following fields should be set
     search_params: Props | None = None
+    collection_names: list[str] | None = None  # to search instead of the current one
     research_params: ResearchParams | None = None
     db_command: DBCommand | None = None
     ingest_command: IngestCommand | None = None
@@ -284,6 +288,27 @@ def extract_search_params(query: str, mode="normal") -> tuple[str, Props]:
     return query, {"where_document": {"$and": filters}}
 
 
+def extract_collection_names(query: str) -> tuple[list[str] | None, str]:
+    """
+    Extract the names of the collections to search, if specified at the start of the
+    query as a comma-separated list after one of COLLECTIONS_OPTIONS (e.g.
+    "--collections my-notes,ingested-content-* What is X?"). A name ending with "*"
+    stands for all collections whose names start with the rest of it. Collection names
+    can't contain spaces, so there can be spaces around the commas (e.g. "--colls a, b
+    What is X?").
+
+    Returns the list of names (or None if not specified) and the rest of the query.
+    """
+    option, rest = get_command(query, COLLECTIONS_OPTIONS)
+    if option is None:
+        return None, query
+    names_match = re.match(r"[^\s,]*(?:\s*,\s*[^\s,]*)*", rest)
+    collection_names = [x for x in re.split(r"\s*,\s*", names_match.group()) if x]
+    if not collection_names:
+        return None, query
+    return collection_names, rest[names_match.end() :].lstrip()
+
+
 def standardize_search_queries(query: str) -> str:
     """
     Extract a list of search queries from the given query.
@@ -406,8 +431,11 @@ def parse_query(
         ChatMode.DETAILS_COMMAND_ID,
         ChatMode.QUOTES_COMMAND_ID,
     }:
+        c, query = extract_collection_names(query)
         m, s = extract_search_params(query)
-        return ParsedQuery(chat_mode=chat_mode, message=m, search_params=s)
+        return ParsedQuery(
+            chat_mode=chat_mode, message=m, search_params=s, collection_names=c
+        )
 
     if chat_mode == ChatMode.DB_COMMAND_ID:
         c, m = get_command(query, db_command_to_enum, DBCommand.NONE)
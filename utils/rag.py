@@ -1,3 +1,4 @@
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 rag_text_splitter = RecursiveCharacterTextSplitter(
@@ -5,3 +6,47 @@ rag_text_splitter = RecursiveCharacterTextSplitter(
     chunk_overlap=40,
     add_start_index=True,  # metadata will include start index of snippet in original doc
 )
+
+
+def split_text_into_positioned_chunks(text: str, metadata: dict) -> list[Document]:
+    """
+    Split a text into chunks using rag_text_splitter and record each chunk's position
+    in the text, so that neighboring chunks can later be found without re-splitting.
+
+    In addition to "start_index", each chunk's metadata will contain:
+    - "chunk_idx": the ordinal position of the chunk in the text
+    - "num_chunks_in_parent": the total number of chunks the text was split into
+    - "gap_before": the text between the end of the previous chunk and the start of
+    this one (usually whitespace removed by the splitter; empty if the chunks overlap)
+    """
+    chunks = rag_text_splitter.create_documents([text], [metadata])
+    prev_end_idx = None
+    for i, chunk in enumerate(chunks):
+        start_idx = chunk.metadata["start_index"]
+        chunk.metadata["chunk_idx"] = i
+        chunk.metadata["num_chunks_in_parent"] = len(chunks)
+        chunk.metadata["gap_before"] = (
+            text[prev_end_idx:start_idx] if prev_end_idx is not None else ""
+        )
+        end_idx = start_idx + len(chunk.page_content)
+        prev_end_idx = end_idx if prev_end_idx is None else max(prev_end_idx, end_idx)
+    return chunks
+
+
+def join_contiguous_chunks(chunks: list[Document]) -> str:
+    """
+    Reconstruct the text spanned by a list of contiguous chunks (in order) produced by
+    split_text_into_positioned_chunks. Overlapping parts are included only once.
+    """
+    if not chunks:
+        return ""
+    parts = [chunks[0].page_content]
+    end_idx = chunks[0].metadata["start_index"] + len(chunks[0].page_content)
+    for chunk in chunks[1:]:
+        start_idx = chunk.metadata["start_index"]
+        if start_idx < end_idx:
+            parts.append(chunk.page_content[end_idx - start_idx :])
+        else:
+            parts.append(chunk.metadata.get("gap_before", "") + chunk.page_content)
+        end_idx = max(end_idx, start_idx + len(chunk.page_content))
+    return "".join(parts)
@@ -55,6 +55,7 @@ def ingest_docs(docs: list[Document], chat_state: ChatState):
             chat_state=chat_state,
             is_new_collection=is_new_collection,
         )
+        chat_state.flush_collection_metadata()  # ingestion happens outside of a query
         if is_new_collection:
             # Switch to the newly created collection
             chat_state.vectorstore = vectorstore
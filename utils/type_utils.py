@@ -101,6 +101,7 @@ class AccessCodeSettings(BaseModel):
 
 
 COLLECTION_USERS_METADATA_KEY = "collection_users"
+RR_DATA_RECORD_ID_METADATA_KEY = "rr_data_id"  # see components/research_state_store.py
 
 
 class CollectionPermissions(BaseModel):
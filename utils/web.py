@@ -1,6 +1,8 @@
 import asyncio
+import base64
 import io
 import os
+import zlib
 from enum import Enum
 
 import aiohttp
@@ -12,7 +14,13 @@ from langchain_community.document_transformers import BeautifulSoupTransformer
 from langchain_community.document_loaders.async_html import default_header_template
 from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 from playwright.async_api import async_playwright
-from pydantic import BaseModel
+from pydantic import (
+    BaseModel,
+    SerializationInfo,
+    field_serializer,
+    field_validator,
+    model_validator,
+)
 
 from utils.async_utils import make_sync
 from utils.helpers import print_no_newline
@@ -324,10 +332,57 @@ def remove_failed_fetches(
 
 
 class LinkData(BaseModel):
-    text: str | None = None
+    """
+    Data for a fetched link. The text is kept zlib-compressed (in memory and when
+    serialized, as base64) and is only decompressed when accessed. For compatibility,
+    the constructor and model_validate accept the uncompressed "text" field as before.
+    """
+
+    text_compressed: bytes | None = None
     error: str | None = None
     num_tokens: int | None = None
     is_ingested: bool = False
+    text_hash: str | None = None  # set once the text is in the ResearchStateStore
+
+    @model_validator(mode="before")
+    @classmethod
+    def compress_text(cls, data):
+        if isinstance(data, dict) and "text" in data:
+            data = data.copy()
+            if (text := data.pop("text")) is not None:
+                data["text_compressed"] = zlib.compress(text.encode())
+        return data
+
+    @field_validator("text_compressed", mode="before")
+    @classmethod
+    def decode_text_compressed(cls, value):
+        return base64.b64decode(value) if isinstance(value, str) else value
+
+    @field_serializer("text_compressed")
+    def serialize_text_compressed(self, value: bytes | None, info: SerializationInfo):
+        # Leave out texts saved separately in the ResearchStateStore, if requested
+        if self.text_hash and (info.context or {}).get("exclude_stored_texts"):
+            return None
+        if value is not None and info.mode_is_json():
+            return base64.b64encode(value).decode()
+        return value
+
+    @property
+    def text(self) -> str | None:
+        if self.text_compressed is None:
+            return None
+        return zlib.decompress(self.text_compressed).decode()
+
+    @text.setter
+    def text(self, text: str | None) -> None:
+        self.text_compressed = None if text is None else zlib.compress(text.encode())
+
+    def evict_text(self) -> None:
+        """
+        Drop the text to save memory and space (if it's in the ResearchStateStore, it
+        can be loaded again, see ResearchReportData.load_link_texts).
+        """
+        self.text_compressed = None
 
     @classmethod
     def from_raw_content(cls, content: str):